@@ -0,0 +1,15 @@
+# Checksum of the models saved by scipionwrite. The bundle cannot import
+# the plugin: this must give the same result as
+# chimera.manifest.fileChecksum (checked by chimera/tests/test_manifest.py)
+import hashlib
+
+CHUNK_SIZE = 2 ** 24
+
+
+def fileChecksum(fileName, chunkSize=CHUNK_SIZE):
+    """ sha256 of a file """
+    digest = hashlib.sha256()
+    with open(fileName, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunkSize), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -1,6 +1,7 @@
 # When a test is executed the default working directory is tmp even if extra has been
 # passed as ChimeraX argument. The following hack bypasses that problem.
 from .constants import *
+from .checksum import fileChecksum
 
 # devel install /home/roberto/Software/Plugins3/scipion-em-chimera/chimera/Bundles/scipion
 from chimerax.core.commands import CmdDesc      # Command description
@@ -11,7 +12,7 @@ from chimerax.core.commands import run # execute chimera cli command
 from chimerax.map.volume import Volume # model type 3D map
 from chimerax.atomic.structure import AtomicStructure # model type atomic structure
 
-import os, time
+import os, time, json
 # import numpy as np
 import ntpath
 
@@ -240,6 +241,27 @@ def checkBundleEnabled(session, cmd="scipion"):
         return True
 
 
+def writeManifestEntry(session, model, modelFileName, modelType):
+    """ Append the saved model to the manifest read by the protocol
+    (see chimera.manifest) so that it does not list the extra folder
+    and read the map headers again. The header of maps that are not
+    Volume models is left to the protocol """
+    manifestFileName = getConfig(session, CHIMERA_MANIFEST_FILE_NAME)
+    if not manifestFileName:
+        return
+    entry = {'path': os.path.relpath(modelFileName,
+                                     os.path.dirname(manifestFileName)),
+             'type': modelType,
+             'sampling': None, 'origin': None, 'dims': None,
+             'checksum': fileChecksum(modelFileName)}
+    if modelType == 'map' and isinstance(model, Volume):
+        entry['sampling'] = float(model.data.step[0])
+        entry['origin'] = [float(x) for x in model.data.origin]
+        entry['dims'] = [int(n) for n in model.data.size]
+    with open(manifestFileName, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+
 def scipionwrite(session, model, prefix=None):
     # models is a tuple with all selected models but we are only
     # process the first one
@@ -258,8 +280,10 @@ def scipionwrite(session, model, prefix=None):
     if isinstance(model, AtomicStructure) or \
         (not isinstance(model, Volume) and modelName.find('cif')!= -1):
         modelFileName = getConfig(session, CHIMERA_PDB_TEMPLATE_FILE_NAME).replace("__", "__%s_" % (model.id)[0])
+        modelType = 'atomStruct'
     elif (isinstance(model, Volume) or modelName.find('mrc')!= -1):
         modelFileName = getConfig(session, CHIMERA_MAP_TEMPLATE_FILE_NAME).replace("__", "__%s_" % (model.id)[0])
+        modelType = 'map'
     else:
         session.logger.error("I do not know how to save model %s\n" % modelName)
         return
@@ -270,6 +294,7 @@ def scipionwrite(session, model, prefix=None):
     command = 'save %s #%s'%(modelFileName, str((model.id)[0]))
     session.logger.info(command)
     run(session, command)
+    writeManifestEntry(session, model, modelFileName, modelType)
 
     if not (prefix == "DONOTSAVESESSION_"):
         session.logger.info("Saving session")
@@ -2,4 +2,5 @@ SCIPIONPYTHON = "SCIPIONPYTHON"
 PROTID = 'PROTID'
 SESSIONFILE = "SESSIONFILE"
 CHIMERA_MAP_TEMPLATE_FILE_NAME = 'CHIMERA_MAP_TEMPLATE_FILE_NAME'
-CHIMERA_PDB_TEMPLATE_FILE_NAME = 'CHIMERA_PDB_TEMPLATE_FILE_NAME'
\ No newline at end of file
+CHIMERA_PDB_TEMPLATE_FILE_NAME = 'CHIMERA_PDB_TEMPLATE_FILE_NAME'
+CHIMERA_MANIFEST_FILE_NAME = 'CHIMERA_MANIFEST_FILE_NAME'
\ No newline at end of file
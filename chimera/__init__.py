@@ -25,11 +25,15 @@
 
 import os
 import tempfile
+import time
 
 import pwem
+import pyworkflow as pw
 import pyworkflow.utils as pwutils
 from glob import glob
 from .constants import (CHIMERA_HOME, ALPHAFOLD_HOME, ALPHAFOLD_DATABASE_DIR,
+                        CHIMERA_MAP_CACHE, CHIMERA_MAP_CACHE_SIZE,
+                        CHIMERA_WORKERS, CHIMERA_WORKERS_DIR,
                         V1_1, V1_2_5, V1_3, V1_4, chimeraTARs, V1_6_1)
 
 
@@ -44,6 +48,7 @@ class Plugin(pwem.Plugin):
     _supportedVersions = chimeraTARs.keys()
     _currentVersion = V1_6_1
     _fullVersion = 'chimerax-%s' % _currentVersion
+    _workerPool = None  # see getWorkerPool
 
     def __init__(self):
         super().__init__()
@@ -57,6 +62,38 @@ class Plugin(pwem.Plugin):
         cls._defineEmVar(CHIMERA_HOME, cls._fullVersion)
         cls._defineVar(ALPHAFOLD_HOME, None)
         cls._defineVar(ALPHAFOLD_DATABASE_DIR, None)
+        cls._defineVar(CHIMERA_MAP_CACHE,
+                       os.path.join(pw.Config.SCIPION_USER_DATA,
+                                    'chimerax-map-cache'))
+        cls._defineVar(CHIMERA_MAP_CACHE_SIZE, 10)
+        cls._defineVar(CHIMERA_WORKERS, 0)
+        cls._defineVar(CHIMERA_WORKERS_DIR,
+                       os.path.join(pw.Config.SCIPION_USER_DATA,
+                                    'chimerax-workers'))
+
+    @classmethod
+    def getMapCache(cls):
+        """ Cache of simulated maps and symmetrized structures shared by
+        all projects """
+        from .mapcache import MapCache
+        maxSize = float(cls.getVar(CHIMERA_MAP_CACHE_SIZE)) * 1024 ** 3
+        return MapCache(cls.getVar(CHIMERA_MAP_CACHE), maxSize)
+
+    @classmethod
+    def getWorkerPool(cls):
+        """ Pool of headless ChimeraX workers shared by all projects, None
+        if CHIMERA_WORKERS is 0. It is created once per process. """
+        size = int(cls.getVar(CHIMERA_WORKERS) or 0)
+        if size <= 0:
+            return None
+        directory = cls.getVar(CHIMERA_WORKERS_DIR)
+        pool = cls._workerPool
+        if pool is None or (pool.size, pool.directory) != (size, directory):
+            from .workers import ChimeraWorkerPool
+            cls._workerPool = ChimeraWorkerPool(cls.getProgram(), size,
+                                                directory,
+                                                env=cls.getEnviron())
+        return cls._workerPool
 
     @classmethod
     def getEnviron(cls):
@@ -70,14 +107,112 @@ class Plugin(pwem.Plugin):
         return environ
 
     @classmethod
-    def runChimeraProgram(cls, program, args="", cwd=None, extraEnv=None):
-        """ Internal shortcut function to launch chimera program. """
-        env = cls.getEnviron()
+    def runChimeraProgram(cls, program, args="", cwd=None, extraEnv=None,
+                          protocol=None, step=None):
+        """ Internal shortcut function to launch chimera program.
+        Scripts run without user interaction (--nogui) are sent to an idle
+        worker of the pool if there is one (see getWorkerPool).
+        The metrics of every launch (see chimera.launches) are appended to
+        the Logs folder of the project and, if the protocol is given,
+        written to the logs folder of the run and to its log. They are
+        also stored with the step of the protocol that calls the function
+        named step, if it is running. """
+        from . import launches
+
+        isChimeraX = program == cls.getProgram()
+        script = launches.scriptFile(args, cwd)
+        scriptSize = (os.path.getsize(script)
+                      if script and os.path.exists(script) else None)
+        # only ChimeraX scripts can be wrapped
+        marker = (launches.markerFileName()
+                  if isChimeraX and scriptSize is not None else None)
+        command = "%s %s" % (program, args)
+        workerPid, status, rss = None, 1, None  # if the launch fails
+        start = time.time()
+        try:
+            result = (cls._runInWorker(args, cwd, extraEnv, marker)
+                      if isChimeraX else None)
+            if result is not None:
+                workerPid, status = result
+                rss = launches.peakRss(workerPid)
+            else:
+                env = cls.getEnviron()
+
+                if extraEnv:
+                    env.update(extraEnv)
 
-        if extraEnv:
-            env.update(extraEnv)
+                wrapper = None
+                if marker is not None:
+                    runArgs, wrapper = launches.wrapScript(args, script,
+                                                           marker)
+                    command = "%s %s" % (program, runArgs)
+                print("** Running command: %s" % command)
+                try:
+                    status, rss = launches.runCommand(command, env=env,
+                                                      cwd=cwd)
+                finally:
+                    if wrapper is not None:
+                        os.remove(wrapper)
+        finally:
+            record = launches.launchRecord(
+                program, args, cwd, start, time.time(), status, rss,
+                scriptSize, launches.readMarker(marker) if marker else None,
+                worker=workerPid is not None, protocol=protocol, step=step)
+            projectFile = launches.projectLaunchesFile(protocol)
+            if projectFile is not None:
+                launches.writeRecord(projectFile, record)
+            if protocol is not None:
+                runningStep = launches.protocolStep(protocol, step)
+                if runningStep is not None:
+                    launches.addToStep(runningStep, record)
+                launches.writeRecord(
+                    protocol._getLogsPath(launches.LAUNCHES_FILE), record)
+                protocol._log.info(launches.formatRecord(record))
+        if status != 0:
+            raise Exception("Command '%s' returned non-zero exit status %d"
+                            % (command, status))
+
+    @classmethod
+    def runChimeraScripts(cls, scripts, fileName, protocol=None, step=None):
+        """ Run independent scripts (chimera.commands.Script) in a single
+        ChimeraX without user interaction, so that startup is paid once.
+        See chimera.commands.mergeScripts and runChimeraProgram. """
+        from .commands import mergeScripts
+
+        with open(fileName, 'w') as f:
+            f.write(mergeScripts(scripts))
+        cls.runChimeraProgram(cls.getProgram(),
+                              " --nogui --exit --script " + fileName,
+                              cwd=os.path.dirname(os.path.abspath(fileName)),
+                              protocol=protocol, step=step)
+
+    @classmethod
+    def _runInWorker(cls, args, cwd=None, extraEnv=None, marker=None):
+        """ Run a script in a worker. Return the pid of the worker and the
+        exit status (1 if the script failed), None if it was not
+        possible (no idle worker, or the worker failed or timed out). """
+        from .launches import scriptFile
+        from .workers import ChimeraWorkerError, ChimeraScriptError
 
-        pwutils.runJob(None, program, args, env=env, cwd=cwd)
+        pool = cls.getWorkerPool()
+        script = (scriptFile(args, cwd, headless=True)
+                  if pool is not None else None)
+        if script is None:
+            return None
+        try:
+            messages = pool.run(script, cwd, extraEnv, marker)
+        except ChimeraWorkerError as e:
+            print("ChimeraX worker failed, starting ChimeraX: %s" % e)
+            return None
+        except ChimeraScriptError as e:
+            print("Error in the ChimeraX worker: %s" % e)
+            return pool.lastPid, 1
+        if messages is None:  # all the workers are busy
+            return None
+        for level, lines in messages.items():
+            for line in lines:
+                print("%s: %s" % (level, line) if level != 'info' else line)
+        return pool.lastPid, 0
 
     @classmethod
     def getProgram(cls, progName="ChimeraX"):
@@ -0,0 +1,227 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Fast reader (and minimal mmCIF writer) of atom coordinates.
+
+Atoms are returned as a NumPy structured array (one row per atom) so that
+large structures can be selected and processed without ChimeraX or
+Biopython objects. Only the first alternate location of each atom is
+read, as the single location shown by ChimeraX.
+"""
+
+import re
+
+import numpy as np
+
+# version of the atoms given by the readers, part of the cache keys of
+# the maps and symmetry copies computed from them
+VERSION = 2
+# chains are wide enough for the ids of symmetry copies (ABCD11)
+ATOM_DTYPE = np.dtype([('model', np.int32),
+                       ('chain', 'U8'),
+                       ('resName', 'U4'),
+                       ('resSeq', np.int32),
+                       ('name', 'U4'),
+                       ('element', 'U2'),
+                       ('x', np.float32),
+                       ('y', np.float32),
+                       ('z', np.float32)])
+
+ATOMIC_NUMBER = {'H': 1, 'D': 1, 'HE': 2, 'LI': 3, 'BE': 4, 'B': 5, 'C': 6,
+                 'N': 7, 'O': 8, 'F': 9, 'NE': 10, 'NA': 11, 'MG': 12,
+                 'AL': 13, 'SI': 14, 'P': 15, 'S': 16, 'CL': 17, 'AR': 18,
+                 'K': 19, 'CA': 20, 'MN': 25, 'FE': 26, 'CO': 27, 'NI': 28,
+                 'CU': 29, 'ZN': 30, 'SE': 34, 'BR': 35, 'RB': 37, 'SR': 38,
+                 'CD': 48, 'I': 53, 'CS': 55, 'BA': 56, 'PT': 78, 'AU': 79,
+                 'HG': 80, 'PB': 82, 'U': 92}
+
+_CIF_TOKEN = re.compile(r"'[^']*'|\"[^\"]*\"|\S+")
+
+
+def readAtoms(fileName):
+    """ Read the atoms (ATOM and HETATM records) of a PDB or mmCIF file """
+    with open(fileName) as f:
+        lines = f.readlines()
+    if any(line.startswith('_atom_site.') for line in lines[:10000]) or \
+            fileName.endswith('.cif'):
+        return _readCif(lines)
+    return _readPdb(lines)
+
+
+def _firstAltlocs(keys, altlocs):
+    """ Mask of the atoms without alternate location or with the first
+    alternate location of their (model, chain, residue, name) key """
+    mask = []
+    seen = set()
+    for key, altloc in zip(keys, altlocs):
+        if altloc in ('', '.', '?'):
+            mask.append(True)
+        else:
+            mask.append(key not in seen)
+            seen.add(key)
+    return np.array(mask, dtype=bool)
+
+
+def _readPdb(lines):
+    rows = []
+    seen = set()
+    model = 1
+    for line in lines:
+        if line.startswith('MODEL'):
+            model = int(line[10:14])
+        elif line.startswith('ATOM') or line.startswith('HETATM'):
+            name = line[12:16].strip()
+            if line[16] != ' ':  # alternate location
+                key = (model, line[21], line[22:27], name)
+                if key in seen:
+                    continue
+                seen.add(key)
+            element = line[76:78].strip() or name.lstrip('0123456789')[:1]
+            rows.append((model, line[21].strip(), line[17:20].strip(),
+                         int(line[22:26]), name, element,
+                         float(line[30:38]), float(line[38:46]),
+                         float(line[46:54])))
+    return np.array(rows, dtype=ATOM_DTYPE)
+
+
+def _unquote(token):
+    if len(token) > 1 and token[0] == token[-1] and token[0] in '\'"':
+        return token[1:-1]
+    return token
+
+
+def _readCif(lines):
+    columns = []
+    rows = []
+    inLoop = False
+    for line in lines:
+        if line.startswith('_atom_site.'):
+            columns.append(line.split()[0][len('_atom_site.'):])
+            inLoop = True
+        elif inLoop and columns:
+            if line.startswith('ATOM') or line.startswith('HETATM'):
+                rows.append([_unquote(t) for t in _CIF_TOKEN.findall(line)])
+            elif line.startswith('#') or line.startswith('loop_') or \
+                    line.startswith('_'):
+                break
+
+    def column(*names, default=None):
+        for name in names:
+            if name in columns:
+                index = columns.index(name)
+                return [row[index] for row in rows]
+        return [default] * len(rows)
+
+    atoms = np.zeros(len(rows), dtype=ATOM_DTYPE)
+    if not rows:
+        return atoms
+    atoms['model'] = [int(v) for v in column('pdbx_PDB_model_num',
+                                             default='1')]
+    atoms['chain'] = column('auth_asym_id', 'label_asym_id')
+    atoms['resName'] = column('auth_comp_id', 'label_comp_id')
+    atoms['resSeq'] = [int(v) if v not in ('.', '?') else 0
+                       for v in column('auth_seq_id', 'label_seq_id',
+                                       default='0')]
+    atoms['name'] = column('auth_atom_id', 'label_atom_id')
+    atoms['element'] = column('type_symbol', default='C')
+    atoms['x'] = column('Cartn_x')
+    atoms['y'] = column('Cartn_y')
+    atoms['z'] = column('Cartn_z')
+    keys = zip(atoms['model'], atoms['chain'], atoms['resSeq'],
+               column('pdbx_PDB_ins_code', default='?'), atoms['name'])
+    return atoms[_firstAltlocs(keys, column('label_alt_id', default='.'))]
+
+
+CIF_COLUMNS = ['group_PDB', 'id', 'type_symbol', 'label_atom_id',
+               'label_alt_id', 'label_comp_id', 'label_asym_id',
+               'label_entity_id', 'label_seq_id', 'Cartn_x', 'Cartn_y',
+               'Cartn_z', 'occupancy', 'B_iso_or_equiv', 'auth_seq_id',
+               'auth_asym_id', 'pdbx_PDB_model_num']
+
+
+def _cifValue(value):
+    if not value:
+        return '.'
+    if "'" in value:
+        return '"%s"' % value
+    return value
+
+
+def writeCif(atoms, fileName, dataName='scipion'):
+    """ Write atoms as a minimal mmCIF file (atom_site loop only) """
+    with open(fileName, 'w') as f:
+        f.write('data_%s\n#\nloop_\n' % dataName)
+        for column in CIF_COLUMNS:
+            f.write('_atom_site.%s\n' % column)
+        for i, atom in enumerate(atoms):
+            chain = _cifValue(atom['chain'])
+            f.write('ATOM %d %s %s . %s %s ? %d %.3f %.3f %.3f 1.00 0.00 '
+                    '%d %s %d\n'
+                    % (i + 1, _cifValue(atom['element']),
+                       _cifValue(atom['name']), _cifValue(atom['resName']),
+                       chain, atom['resSeq'], atom['x'], atom['y'],
+                       atom['z'], atom['resSeq'], chain, atom['model']))
+        f.write('#\n')
+
+
+def coordinates(atoms):
+    """ (n, 3) float64 array with x, y, z """
+    return np.stack((atoms['x'], atoms['y'], atoms['z']),
+                    axis=-1).astype(np.float64)
+
+
+def atomicNumbers(atoms):
+    """ Atomic number of each atom, 0 for unknown elements """
+    return np.array([ATOMIC_NUMBER.get(e.upper(), 0) for e in atoms['element']],
+                    dtype=np.float32)
+
+
+def selectAtoms(atoms, modelIndex=None, chain=None):
+    """ Subset of atoms.
+
+    :param modelIndex: 0 for the first model in the file, 1 for the second...
+                       (as returned by the chain wizard)
+    :param chain: chain id
+    """
+    mask = np.ones(len(atoms), dtype=bool)
+    if modelIndex is not None:
+        models = np.unique(atoms['model'])
+        mask &= atoms['model'] == models[int(modelIndex)]
+    if chain is not None:
+        mask &= atoms['chain'] == chain
+    return atoms[mask]
+
+
+def chainGroups(atoms):
+    """ (chains, groups): sorted chain ids and the index in chains of the
+    chain of each atom """
+    return np.unique(atoms['chain'], return_inverse=True)
+
+
+def removeResidues(atoms, chain, first, last):
+    """ Remove residues first to last (both included) of a chain """
+    mask = (atoms['chain'] == chain) & \
+           (atoms['resSeq'] >= int(first)) & (atoms['resSeq'] <= int(last))
+    return atoms[~mask]
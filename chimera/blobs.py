@@ -0,0 +1,169 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Connected component (blob) analysis of difference maps.
+
+Voxels above a contour level are labeled in connected components (faces
+connectivity, as the surface pieces of ChimeraX). Volume, integrated
+density, maximum and centroid of all the blobs are accumulated slab by
+slab with bincount. The closest atom of each blob is found with a k-d
+tree query of the blob voxels, and the residues within contact with a
+ball query of the voxels that have an atom that close.
+"""
+
+import numpy as np
+
+from . import maps
+from .atoms import coordinates
+
+BLOB_DTYPE = np.dtype([('id', np.int32), ('voxels', np.int64),
+                       ('volume', np.float64), ('density', np.float64),
+                       ('maximum', np.float64), ('x', np.float64),
+                       ('y', np.float64), ('z', np.float64),
+                       ('distance', np.float64), ('residues', object)])
+
+
+def labelBlobs(mapFile, level, slabSize=maps.SLAB_SIZE):
+    """ (labels, n): int32 array with the blob number (1 to n) of each
+    voxel above level, 0 elsewhere """
+    from scipy import ndimage
+
+    mask = np.zeros(mapFile.shape, dtype=bool)
+    for z0, z1 in maps.iterSlabs(mapFile.shape[0], slabSize):
+        mask[z0:z1] = mapFile.slab(z0, z1) > level
+    labels, n = ndimage.label(mask)
+    return labels.astype(np.int32, copy=False), n
+
+
+def _residueNames(atoms):
+    return np.char.add(np.char.add(atoms['chain'], ':'),
+                       np.char.add(np.char.add(atoms['resName'], ' '),
+                                   atoms['resSeq'].astype(str)))
+
+
+def findBlobs(mapFile, level, atoms=None, minVolume=0., contact=4.,
+              slabSize=maps.SLAB_SIZE):
+    """ Blobs of a map above level, largest integrated density first.
+
+    :param mapFile: maps.MapFile
+    :param atoms: structured array as in chimera.atoms, to report the
+                  distance to the closest atom and the residues with atoms
+                  within contact Angstroms of the blob voxels
+    :param minVolume: smaller blobs (cubic Angstroms) are discarded
+    :return: array of BLOB_DTYPE
+    """
+    labels, n = labelBlobs(mapFile, level, slabSize)
+    size = n + 1
+    voxels = np.zeros(size, dtype=np.int64)
+    density = np.zeros(size)
+    maximum = np.full(size, -np.inf)
+    weighted = np.zeros((size, 3))
+    ny, nx = mapFile.shape[1:]
+    for z0, z1 in maps.iterSlabs(mapFile.shape[0], slabSize):
+        slabLabels = labels[z0:z1].ravel()
+        inside = slabLabels > 0
+        if not inside.any():
+            continue
+        ids = slabLabels[inside]
+        values = mapFile.slab(z0, z1).ravel()[inside].astype(np.float64)
+        k, j, i = np.unravel_index(np.flatnonzero(inside), (z1 - z0, ny, nx))
+        weights = values - level  # positive inside the blobs
+        voxels += np.bincount(ids, minlength=size)
+        density += np.bincount(ids, values, minlength=size)
+        np.maximum.at(maximum, ids, values)
+        for axis, index in enumerate((i, j, k + z0)):
+            weighted[:, axis] += np.bincount(ids, weights * index,
+                                             minlength=size)
+    totalWeights = density - level * voxels
+    voxelVolume = float(np.prod(mapFile.voxelSize))
+    blobs = np.zeros(n, dtype=BLOB_DTYPE)
+    blobs['id'] = np.arange(1, size)
+    blobs['voxels'] = voxels[1:]
+    blobs['volume'] = voxels[1:] * voxelVolume
+    blobs['density'] = density[1:] * voxelVolume
+    blobs['maximum'] = maximum[1:]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        centroids = mapFile.gridToXyz(weighted[1:] /
+                                      totalWeights[1:, None])
+    blobs['x'], blobs['y'], blobs['z'] = centroids.T
+    blobs['distance'] = np.nan
+    blobs['residues'] = ''
+    blobs = blobs[blobs['volume'] >= minVolume]
+    if atoms is not None and len(atoms) and len(blobs):
+        _nearResidues(blobs, labels, mapFile, atoms, contact)
+    return blobs[np.argsort(-blobs['density'], kind='stable')]
+
+
+def _nearResidues(blobs, labels, mapFile, atoms, contact):
+    """ Fill distance and residues of the blobs """
+    from scipy.spatial import cKDTree
+
+    keep = np.zeros(labels.max() + 1, dtype=bool)
+    keep[blobs['id']] = True
+    index = np.flatnonzero(keep[labels.ravel()])
+    ids = labels.ravel()[index]
+    k, j, i = np.unravel_index(index, labels.shape)
+    points = mapFile.gridToXyz(np.stack((i, j, k), axis=-1))
+    tree = cKDTree(coordinates(atoms))
+    distances, _ = tree.query(points, workers=-1)
+    # closest atom of each blob
+    closest = np.full(labels.max() + 1, np.inf)
+    np.minimum.at(closest, ids, distances)
+    blobs['distance'] = closest[blobs['id']]
+    # residues with any atom within contact of a blob voxel
+    close = distances <= contact
+    names = _residueNames(atoms)
+    residues = {}
+    for blobId, atomIndices in zip(ids[close],
+                                   tree.query_ball_point(points[close],
+                                                         contact,
+                                                         workers=-1)):
+        residues.setdefault(blobId, set()).update(names[atomIndices])
+    for blob in blobs:
+        blob['residues'] = ' '.join(sorted(residues.get(blob['id'], ())))
+
+
+def writeBlobs(fileName, blobs):
+    """ Write the blobs as comma separated values """
+    with open(fileName, 'w') as f:
+        f.write('rank,' + ','.join(BLOB_DTYPE.names) + '\n')
+        for rank, blob in enumerate(blobs, 1):
+            f.write('%d,%d,%d,%.6g,%.6g,%.6g,%.3f,%.3f,%.3f,%.3f,"%s"\n'
+                    % ((rank,) + tuple(blob)))
+
+
+def writeMarkers(fileName, blobs, name='blobs', color=(1., 0.5, 0.)):
+    """ Write a ChimeraX marker file (.cmm) with a marker at the centroid
+    of each blob, with the radius of a sphere of the same volume """
+    with open(fileName, 'w') as f:
+        f.write('<marker_set name="%s">\n' % name)
+        for rank, blob in enumerate(blobs, 1):
+            radius = (3. * blob['volume'] / (4. * np.pi)) ** (1. / 3)
+            f.write('<marker id="%d" x="%.3f" y="%.3f" z="%.3f" '
+                    'r="%g" g="%g" b="%g" radius="%.3f" '
+                    'note="blob %d: %.1f A^3"/>\n'
+                    % ((rank, blob['x'], blob['y'], blob['z']) + tuple(color)
+                       + (radius, rank, blob['volume'])))
+        f.write('</marker_set>\n')
@@ -0,0 +1,272 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" ChimeraX commands as objects.
+
+Commands are built from typed arguments and written either as a command
+script (.cxc) or as a Python script (run(session, ...) calls). Scripts
+of independent jobs can be merged in a single Python script so that a
+pipeline starts ChimeraX once: every job runs in its own working
+directory and environment and the session is closed between jobs.
+
+    script = Script([Open('model.cif'),
+                     Sym(1, 'C3', copies=True),
+                     Save('sym.cif', models=2)])
+    script.write('job.cxc')
+"""
+
+import re
+
+PYTHON_HEADER = 'from chimerax.core.commands import run\n'
+
+# runs the jobs of mergeScripts, the errors are raised after the last job.
+# A job command is a command line or, for NewModel, a pair (command line,
+# rename command with %s for the id of the new model)
+MERGED_TEMPLATE = '''import os
+from chimerax.core.commands import run
+
+environ, cwd = dict(os.environ), os.getcwd()
+errors = []
+for jobCwd, jobEnv, jobCommands in %(jobs)r:
+    os.environ.update(jobEnv)
+    os.chdir(jobCwd or cwd)
+    try:
+        for command in jobCommands:
+            if isinstance(command, tuple):
+                command, rename = command
+                run(session, rename %% run(session, command).id_string)
+            else:
+                run(session, command)
+    except Exception as e:
+        errors.append('%%s: %%s' %% (jobCwd, e))
+    finally:
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+        run(session, 'close session')
+if errors:
+    raise RuntimeError('\\n'.join(errors))
+'''
+
+
+def quote(path):
+    """ File name as a ChimeraX command argument """
+    path = str(path)
+    if re.search(r'[\s;#"\']', path):
+        return '"%s"' % path.replace('"', '\\"')
+    return path
+
+
+def spec(models):
+    """ Model specification: 1 -> '#1', (1, 2) -> '#1,2', strings are
+    kept ('#1/A', 'sel') """
+    if isinstance(models, str):
+        return models
+    if isinstance(models, int):
+        return '#%d' % models
+    return '#' + ','.join(str(m) for m in models)
+
+
+def value(arg):
+    """ Option value: booleans as true/false, sequences comma separated """
+    if isinstance(arg, bool):
+        return 'true' if arg else 'false'
+    if isinstance(arg, float):
+        return '%g' % arg
+    if isinstance(arg, (list, tuple)):
+        return ','.join(value(a) for a in arg)
+    return str(arg)
+
+
+class Command:
+    """ A ChimeraX command: name, positional arguments and keyword
+    options. Options that are None are omitted. """
+
+    def __init__(self, command, *args, **options):
+        self.name = command
+        self.args = [value(a) for a in args if a is not None]
+        self.options = options
+
+    def text(self):
+        words = [self.name] + self.args
+        for key, option in self.options.items():
+            if option is not None:
+                words += [key, value(option)]
+        return ' '.join(words)
+
+    def python(self):
+        return 'run(session, %r)' % self.text()
+
+    def job(self):
+        """ Command as run by the jobs of mergeScripts """
+        return self.text()
+
+    def __str__(self):
+        return self.text()
+
+    def __eq__(self, other):
+        return isinstance(other, Command) and self.text() == other.text()
+
+
+class Open(Command):
+    def __init__(self, path, format=None, name=None, **options):
+        Command.__init__(self, 'open', quote(path), format=format,
+                         name=name and quote(name), **options)
+
+
+class Close(Command):
+    def __init__(self, models=None):
+        Command.__init__(self, 'close', models and spec(models))
+
+
+class Volume(Command):
+    """ volume command, for instance Volume(2, voxelSize=1.2,
+    origin=(0., 0., 0.), style='surface', level=0.01) """
+    def __init__(self, models, **options):
+        Command.__init__(self, 'volume', spec(models), **options)
+
+
+class Sym(Command):
+    """ sym command, group as in ChimeraX ('C3', 'D7', 'i,222'...) """
+    def __init__(self, models, group, **options):
+        Command.__init__(self, 'sym', spec(models), group, **options)
+
+
+class Molmap(Command):
+    def __init__(self, atoms, resolution, **options):
+        Command.__init__(self, 'molmap', spec(atoms), float(resolution),
+                         **options)
+
+
+class Contacts(Command):
+    """ contacts command, saveFile is quoted """
+    def __init__(self, atoms, saveFile=None, **options):
+        Command.__init__(self, 'contacts', spec(atoms),
+                         saveFile=saveFile and quote(saveFile), **options)
+
+
+class Save(Command):
+    def __init__(self, path, models=None, format=None, **options):
+        Command.__init__(self, 'save', quote(path),
+                         models=models and spec(models), format=format,
+                         **options)
+
+
+class Rename(Command):
+    def __init__(self, models, modelId):
+        Command.__init__(self, 'rename', spec(models), id=spec(modelId))
+
+
+class NewModel(Command):
+    """ Command that opens a model (molmap...) renamed to modelId. The id
+    given by ChimeraX is only known when the command runs, so it can only
+    be written in Python scripts and merged jobs. """
+
+    def __init__(self, command, modelId):
+        Command.__init__(self, command.name)
+        self.args, self.options = command.args, command.options
+        self.modelId = modelId
+
+    def text(self):
+        raise ValueError("%s can only be written in Python scripts"
+                         % Command.text(self))
+
+    def python(self):
+        return 'run(session, %r %% run(session, %r).id_string)' % (
+            Rename('#%s', self.modelId).text(), Command.text(self))
+
+    def job(self):
+        return Command.text(self), Rename('#%s', self.modelId).text()
+
+    def __str__(self):
+        return self.python()
+
+    def __eq__(self, other):
+        return isinstance(other, NewModel) and \
+            self.python() == other.python()
+
+
+class ScipionWrite(Command):
+    """ scipionwrite command of the Scipion bundle """
+    def __init__(self, models, prefix=None):
+        Command.__init__(self, 'scipionwrite', spec(models), prefix=prefix)
+
+
+def symGroup(symName, order=1):
+    """ Group of the sym command for a symmetry of CHIMERA_SYM_NAME, None
+    for C1 and D1 """
+    if symName in ('Cn', 'Dn'):
+        return None if int(order) == 1 else '%s%d' % (symName[0], int(order))
+    if symName in ('T222', 'TZ3'):
+        return 't,%s' % symName[1:]
+    if symName == 'O':
+        return 'O'
+    if symName in ('I222', 'I222r', 'In25', 'In25r', 'I2n3', 'I2n3r',
+                   'I2n5', 'I2n5r'):
+        return 'i,%s' % symName[1:]
+    return None
+
+
+class Script:
+    """ Commands of one ChimeraX job, with the working directory and
+    environment used when it is merged with other jobs """
+
+    def __init__(self, commands=(), cwd=None, env=None):
+        self.commands = []
+        self.cwd = cwd
+        self.env = dict(env or {})
+        for command in commands:
+            self.add(command)
+
+    def add(self, command, *args, **options):
+        """ Append a Command or a command line (name and arguments as
+        for Command if args or options are given) """
+        if not isinstance(command, Command):
+            command = (Command(command, *args, **options)
+                       if args or options else Command(command))
+        self.commands.append(command)
+        return self
+
+    def cxc(self):
+        return ''.join(c.text() + '\n' for c in self.commands)
+
+    def python(self):
+        return PYTHON_HEADER + ''.join(c.python() + '\n'
+                                       for c in self.commands)
+
+    def write(self, fileName):
+        """ Write the script as .cxc or .py depending on the extension """
+        with open(fileName, 'w') as f:
+            f.write(self.python() if fileName.endswith('.py')
+                    else self.cxc())
+        return fileName
+
+
+def mergeScripts(scripts):
+    """ Python code that runs independent scripts in one session, each
+    in its working directory and with its environment variables """
+    jobs = [(s.cwd, s.env, [c.job() for c in s.commands])
+            for s in scripts]
+    return MERGED_TEMPLATE % {'jobs': jobs}
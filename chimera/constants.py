@@ -27,6 +27,10 @@
 CHIMERA_HOME = 'CHIMERA_HOME'
 ALPHAFOLD_HOME = 'ALPHAFOLD_HOME'
 ALPHAFOLD_DATABASE_DIR = 'ALPHAFOLD_DATABASE_DIR'
+CHIMERA_MAP_CACHE = 'CHIMERA_MAP_CACHE'
+CHIMERA_MAP_CACHE_SIZE = 'CHIMERA_MAP_CACHE_SIZE'  # in GB
+CHIMERA_WORKERS = 'CHIMERA_WORKERS'  # headless workers, 0 to disable
+CHIMERA_WORKERS_DIR = 'CHIMERA_WORKERS_DIR'
 CLUSTALO = 'clustalo'
 MUSCLE = 'muscle'
 CHIMERAX=True
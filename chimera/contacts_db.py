@@ -0,0 +1,329 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Typed, read only access to the overlaps.sqlite database created by the
+contacts protocol (ChimeraProtContacts).
+
+Queries are parameterized (values are never formatted into the SQL text),
+column names are checked against the table schema and results are
+fetched lazily as NumPy structured arrays or pandas DataFrames.
+
+    db = ContactsDB(protocol.getDataBaseName())
+    for chunk in db.select(['chainId_1', 'chainId_2', 'distance'],
+                           where={'protId_1': 'h1',
+                                  'distance': ('<', 3.0)}).arrays():
+        ...
+"""
+
+import collections
+import os
+import pathlib
+import sqlite3
+
+import numpy as np
+
+# columns of the contacts table and the views derived from it
+CONTACT_COLUMNS = collections.OrderedDict([
+    ('id', np.int64),
+    ('modelId_1', 'U16'),
+    ('protId_1', 'U16'),
+    ('chainId_1', 'U16'),
+    ('aaName_1', 'U8'),
+    ('aaNumber_1', np.int64),
+    ('atomId_1', 'U8'),
+    ('modelId_2', 'U16'),
+    ('protId_2', 'U16'),
+    ('chainId_2', 'U16'),
+    ('aaName_2', 'U8'),
+    ('aaNumber_2', np.int64),
+    ('atomId_2', 'U8'),
+    ('overlap', np.float64),
+    ('distance', np.float64),
+    ('salineBridge', np.int64),
+])
+
+# table with all the contacts and view without duplicates (see
+# ChimeraProtContacts.removeDuplicates)
+CONTACTS_TABLE = 'contacts'
+CONTACTS_VIEW = 'view_ND_2'
+
+OPERATORS = ['=', '!=', '<', '<=', '>', '>=', 'IN', 'LIKE']
+AGGREGATES = ['count', 'min', 'max', 'avg', 'sum']
+
+CHUNK_SIZE = 65536
+
+
+class Query:
+    """ Lazy, parameterized SELECT. Nothing is read from the database
+    until the query is iterated. """
+
+    def __init__(self, conn, sql, params, columns, dtype):
+        self.conn = conn
+        self.sql = sql
+        self.params = tuple(params)
+        self.columns = columns
+        self.dtype = np.dtype(dtype)
+
+    def __iter__(self):
+        """ Iterate over the result rows as tuples """
+        return self.conn.execute(self.sql, self.params)
+
+    def fetchall(self):
+        return self.conn.execute(self.sql, self.params).fetchall()
+
+    def arrays(self, chunkSize=CHUNK_SIZE):
+        """ Yield the result as NumPy structured arrays of at most
+        chunkSize rows """
+        cursor = self.conn.execute(self.sql, self.params)
+        while True:
+            rows = cursor.fetchmany(chunkSize)
+            if not rows:
+                break
+            yield np.array(rows, dtype=self.dtype)
+
+    def array(self):
+        """ Whole result as a single structured array """
+        chunks = list(self.arrays())
+        if not chunks:
+            return np.empty(0, dtype=self.dtype)
+        return np.concatenate(chunks)
+
+    def dataFrames(self, chunkSize=CHUNK_SIZE):
+        """ Yield the result as pandas DataFrames of at most chunkSize rows """
+        import pandas as pd  # optional dependency
+        for chunk in self.arrays(chunkSize):
+            yield pd.DataFrame(chunk)
+
+    def dataFrame(self):
+        import pandas as pd  # optional dependency
+        return pd.DataFrame(self.array())
+
+
+class ContactsDB:
+    """ Read only access to an overlaps.sqlite database """
+
+    def __init__(self, fileName, source=None):
+        """
+        :param fileName: overlaps.sqlite path
+        :param source: table or view used by default, view_ND_2 (contacts
+                       without duplicates) if it exists, otherwise contacts
+        """
+        self.fileName = os.path.abspath(fileName)
+        # quoted, the path may contain '?', '#' or '%'
+        self.conn = sqlite3.connect(
+            pathlib.Path(self.fileName).as_uri() + '?mode=ro', uri=True)
+        self._columns = {}
+        self._cache = {}
+        sources = self.sources()
+        if source is None:
+            source = CONTACTS_VIEW if CONTACTS_VIEW in sources \
+                else CONTACTS_TABLE
+        self._checkSource(source)
+        self.source = source
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def sources(self):
+        """ Tables and views available in the database """
+        rows = self.conn.execute("SELECT name FROM sqlite_master "
+                                 "WHERE type IN ('table', 'view')")
+        return [row[0] for row in rows]
+
+    def _checkSource(self, source):
+        if source not in self.sources():
+            raise ValueError("Unknown table or view %s in %s"
+                             % (source, self.fileName))
+
+    def columns(self, source=None):
+        """ Column names of a table or view """
+        source = source or self.source
+        if source not in self._columns:
+            self._checkSource(source)
+            # source has been validated, it is safe to quote it
+            rows = self.conn.execute('PRAGMA table_info("%s")' % source)
+            self._columns[source] = [row[1] for row in rows]
+        return self._columns[source]
+
+    def _checkColumns(self, columns, source):
+        known = self.columns(source)
+        for column in columns:
+            if column not in known:
+                raise ValueError("Unknown column %s in %s" % (column, source))
+
+    def _normalizeWhere(self, where):
+        """ Hashable form of a where dictionary: sorted (column, operator,
+        value) tuples, the values of IN as a tuple. A list value is
+        read as ('IN', list) """
+        items = []
+        for column, value in (where or {}).items():
+            operator = '='
+            if isinstance(value, list):
+                operator = 'IN'
+            elif isinstance(value, tuple):
+                operator, value = value
+                operator = operator.upper()
+                if operator not in OPERATORS:
+                    raise ValueError("Unknown operator %s" % operator)
+            if operator == 'IN':
+                value = tuple(value)
+            items.append((column, operator, value))
+        return tuple(sorted(items))
+
+    def _where(self, where, source):
+        """ Translate a normalized where (see _normalizeWhere) into a
+        WHERE clause with placeholders and its parameters """
+        if not where:
+            return "", []
+        self._checkColumns([column for column, _, _ in where], source)
+        clauses = []
+        params = []
+        for column, operator, value in where:
+            if operator == 'IN':
+                clauses.append('"%s" IN (%s)' % (column,
+                                                 ", ".join("?" * len(value))))
+                params.extend(value)
+            else:
+                clauses.append('"%s" %s ?' % (column, operator))
+                params.append(value)
+        return " WHERE " + " AND ".join(clauses), params
+
+    def _dtype(self, columns):
+        return [(column, CONTACT_COLUMNS.get(column, object))
+                for column in columns]
+
+    def select(self, columns=None, where=None, orderBy=None, source=None):
+        """ Return a lazy Query over a table or view.
+
+        :param columns: list of columns to project, all if None
+        :param where: dictionary {column: value} or
+                      {column: (operator, value)}, clauses are ANDed,
+                      a list value means ('IN', list)
+        :param orderBy: list of columns
+        :param source: table or view, self.source if None
+        """
+        source = source or self.source
+        columns = list(columns or self.columns(source))
+        self._checkColumns(columns, source)
+        whereSql, params = self._where(self._normalizeWhere(where), source)
+        sql = 'SELECT %s FROM "%s"%s' % (
+            ", ".join('"%s"' % c for c in columns), source, whereSql)
+        if orderBy:
+            self._checkColumns(orderBy, source)
+            sql += " ORDER BY " + ", ".join('"%s"' % c for c in orderBy)
+        return Query(self.conn, sql, params, columns, self._dtype(columns))
+
+    def aggregate(self, groupBy, function='count', column=None, where=None,
+                  source=None):
+        """ Cached aggregate query, returns a structured array with the
+        groupBy columns plus a column named after the function.
+        The cache is invalidated when the database file changes. """
+        function = function.lower()
+        if function not in AGGREGATES:
+            raise ValueError("Unknown aggregate function %s" % function)
+        source = source or self.source
+        groupBy = list(groupBy)
+        self._checkColumns(groupBy + ([column] if column else []), source)
+        where = self._normalizeWhere(where)
+        key = ('aggregate', tuple(groupBy), function, column, where, source,
+               os.path.getmtime(self.fileName))
+        if key not in self._cache:
+            whereSql, params = self._where(where, source)
+            target = '"%s"' % column if column else '*'
+            sql = 'SELECT %s, %s(%s) FROM "%s"%s GROUP BY %s ORDER BY %s' % (
+                ", ".join('"%s"' % c for c in groupBy), function, target,
+                source, whereSql,
+                ", ".join('"%s"' % c for c in groupBy),
+                ", ".join('"%s"' % c for c in groupBy))
+            dtype = self._dtype(groupBy) + \
+                [(function, np.int64 if function == 'count' else np.float64)]
+            self._cache[key] = Query(self.conn, sql, params,
+                                     groupBy + [function], dtype).array()
+        return self._cache[key]
+
+    def pairChains(self):
+        """ Pairs of interacting chains and number of atom contacts,
+        without the symmetric duplicates (A-B, B-A).
+        Rows: (AAs, modelId_1, protId_1, chainId_1,
+               modelId_2, protId_2, chainId_2) """
+        key = ('pairChains', self.source, os.path.getmtime(self.fileName))
+        if key not in self._cache:
+            sql = """
+WITH pairs AS (
+    SELECT count(*) as AAs, modelId_1, protId_1, chainId_1,
+           modelId_2, protId_2, chainId_2
+    FROM "%s"
+    GROUP BY modelId_1, protId_1, chainId_1, modelId_2, protId_2, chainId_2)
+SELECT *
+FROM pairs
+
+EXCEPT
+
+SELECT ca.*
+FROM pairs ca, pairs cb
+WHERE
+      ca.protId_1    = cb.protId_2
+  AND cb.protId_1    = ca.protId_2
+  AND ca.chainId_1   = cb.chainId_2
+  AND cb.chainId_1   = ca.chainId_2
+  AND ca.AAs  = cb.AAs
+  AND ca.protId_1 > cb.protId_1
+
+ORDER BY modelId_1, protId_1, chainId_1, modelId_2, protId_2,  chainId_2;
+""" % self.source
+            self._cache[key] = self.conn.execute(sql).fetchall()
+        return self._cache[key]
+
+    def interactions(self, modelId_1, protId_1, chainId_1,
+                     modelId_2, protId_2, chainId_2, invert=False):
+        """ Residue contacts between two chains.
+        Rows: (atoms, protId, modelId, chainId, residue, protId, modelId,
+               chainId, residue, salineBridge), first chain first unless
+        invert is set. Residue is aaName followed by aaNumber, e.g. His87 """
+        first, second = ('1', '2') if not invert else ('2', '1')
+        sql = """
+SELECT count(*), protId_{a}, modelId_{a}, chainId_{a},
+       aaName_{a} || aaNumber_{a}, protId_{b}, modelId_{b},
+       chainId_{b},  aaName_{b} || aaNumber_{b}, salineBridge
+FROM   "{source}"
+WHERE modelId_1=? AND protId_1=? AND chainId_1=?
+  AND modelId_2=? AND protId_2=? AND chainId_2=?
+GROUP BY protId_1, modelId_1, chainId_1,
+         aaNumber_1, aaName_1, protId_2,
+         modelId_2, chainId_2, aaNumber_2,
+         aaName_2, salineBridge
+ORDER BY protId_{a}, modelId_{a}, chainId_{a},
+         protId_{b}, modelId_{b}, chainId_{b},
+         aaNumber_{a}, aaName_{a},  aaNumber_{b}, aaName_{b};
+""".format(a=first, b=second, source=self.source)
+        return self.conn.execute(sql, (modelId_1, protId_1, chainId_1,
+                                       modelId_2, protId_2, chainId_2)
+                                 ).fetchall()
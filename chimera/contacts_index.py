@@ -0,0 +1,329 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Library of interface fingerprints extracted from the overlaps.sqlite
+databases created by the contacts protocol (ChimeraProtContacts).
+
+Each pair of interacting chains is reduced to a set of hashed tokens
+(residue-type pairs and per-residue contact patterns). The set is stored
+together with a MinHash signature and its LSH band buckets, so similarity
+queries over hundreds of databases only touch a few candidate rows.
+
+usage:
+    python -m chimera.contacts_index add library.sqlite overlaps.sqlite ...
+    python -m chimera.contacts_index query library.sqlite overlaps.sqlite
+"""
+
+import argparse
+import collections
+import hashlib
+import os
+import sqlite3
+
+import numpy as np
+
+from .contacts_db import ContactsDB
+
+NUM_PERM = 64  # MinHash signature length
+BAND_ROWS = 4  # rows per LSH band, NUM_PERM / BAND_ROWS bands
+_PRIME = (1 << 31) - 1
+_rng = np.random.RandomState(1970)
+_PERM_A = _rng.randint(1, _PRIME, size=NUM_PERM).astype(np.uint64)
+_PERM_B = _rng.randint(0, _PRIME, size=NUM_PERM).astype(np.uint64)
+
+INTERFACE_COLUMNS = ['modelId_1', 'protId_1', 'chainId_1',
+                     'modelId_2', 'protId_2', 'chainId_2',
+                     'aaName_1', 'aaNumber_1', 'aaName_2', 'aaNumber_2',
+                     'salineBridge']
+
+
+def hashToken(token):
+    """ Stable 31 bit hash of a string token """
+    digest = hashlib.blake2b(token.encode(), digest_size=4).digest()
+    return int.from_bytes(digest, 'little') % _PRIME
+
+
+def interfaceTokens(contacts):
+    """ Return the set of tokens that describes an interface.
+
+    :param contacts: iterable of (aaName_1, aaNumber_1, aaName_2, aaNumber_2,
+                     salineBridge) tuples, one per atom contact
+    """
+    pairs = set()
+    partners1 = collections.defaultdict(set)
+    partners2 = collections.defaultdict(set)
+    bridges = set()
+    for aaName1, aaNumber1, aaName2, aaNumber2, salineBridge in contacts:
+        aaName1 = aaName1.upper()
+        aaName2 = aaName2.upper()
+        pairs.add((aaName1, aaNumber1, aaName2, aaNumber2))
+        partners1[(aaName1, aaNumber1)].add(aaName2)
+        partners2[(aaName2, aaNumber2)].add(aaName1)
+        if salineBridge:
+            bridges.add((aaName1, aaNumber1, aaName2, aaNumber2))
+
+    tokens = set()
+    # residue-type pairs, counted so that the set behaves as a multiset
+    counter = collections.Counter("-".join(sorted((p[0], p[2])))
+                                  for p in pairs)
+    for typePair, n in counter.items():
+        for i in range(n):
+            tokens.add("pair:%s:%d" % (typePair, i))
+    # contact pattern of each residue: its type and its partner types
+    for partners in (partners1, partners2):
+        counter = collections.Counter(
+            "%s>%s" % (res[0], ",".join(sorted(types)))
+            for res, types in partners.items())
+        for pattern, n in counter.items():
+            for i in range(n):
+                tokens.add("patch:%s:%d" % (pattern, i))
+    counter = collections.Counter("-".join(sorted((p[0], p[2])))
+                                  for p in bridges)
+    for typePair, n in counter.items():
+        for i in range(n):
+            tokens.add("bridge:%s:%d" % (typePair, i))
+    return tokens
+
+
+def fingerprint(tokens):
+    """ Sorted array with the hashes of the tokens """
+    return np.unique(np.fromiter((hashToken(t) for t in tokens),
+                                 dtype=np.uint32, count=len(tokens)))
+
+
+def minHash(hashes):
+    """ MinHash signature (NUM_PERM values) of an array of token hashes """
+    if len(hashes) == 0:
+        return np.full(NUM_PERM, _PRIME, dtype=np.uint32)
+    x = hashes.astype(np.uint64)[None, :]
+    values = (_PERM_A[:, None] * x + _PERM_B[:, None]) % _PRIME
+    return values.min(axis=1).astype(np.uint32)
+
+
+def bandBuckets(signature):
+    """ One bucket id per LSH band """
+    bands = signature.reshape(-1, BAND_ROWS)
+    return [int.from_bytes(hashlib.blake2b(band.tobytes(),
+                                           digest_size=7).digest(), 'little')
+            for band in bands]
+
+
+def jaccard(hashes1, hashes2):
+    """ Exact Jaccard similarity of two sorted hash arrays """
+    union = np.union1d(hashes1, hashes2).size
+    if union == 0:
+        return 0.
+    return np.intersect1d(hashes1, hashes2, assume_unique=True).size / union
+
+
+def readInterfaces(sqliteFN):
+    """ Read overlaps.sqlite and return a dictionary
+    {(modelId_1, protId_1, chainId_1, modelId_2, protId_2, chainId_2): tokens}
+    """
+    contacts = collections.defaultdict(list)
+    with ContactsDB(sqliteFN) as db:
+        for row in db.select(INTERFACE_COLUMNS):
+            contacts[tuple(row[:6])].append(row[6:])
+    return {key: interfaceTokens(value) for key, value in contacts.items()}
+
+
+class InterfaceLibrary:
+    """ Indexed collection of interface fingerprints stored in a sqlite file.
+
+    library = InterfaceLibrary('interfaces.sqlite')
+    library.addDatabase('Runs/000123_ChimeraProtContacts/extra/overlaps.sqlite')
+    hits = library.query('other/overlaps.sqlite', top=10)
+    """
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.conn = sqlite3.connect(fileName)
+        self._createTables()
+
+    def _createTables(self):
+        c = self.conn.cursor()
+        c.execute("""CREATE TABLE IF NOT EXISTS sources(
+                     id integer primary key autoincrement,
+                     path text unique,
+                     mtime float)""")
+        c.execute("""CREATE TABLE IF NOT EXISTS interfaces(
+                     id integer primary key autoincrement,
+                     sourceId int,
+                     modelId_1 char(8), protId_1 char(8), chainId_1 char(8),
+                     modelId_2 char(8), protId_2 char(8), chainId_2 char(8),
+                     nTokens int,
+                     hashes blob,
+                     signature blob)""")
+        c.execute("""CREATE TABLE IF NOT EXISTS bands(
+                     band int,
+                     bucket int,
+                     interfaceId int)""")
+        c.execute("CREATE INDEX IF NOT EXISTS bands_idx ON bands(band, bucket)")
+        c.execute("CREATE INDEX IF NOT EXISTS interfaces_source_idx "
+                  "ON interfaces(sourceId)")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def addDatabase(self, sqliteFN, force=False):
+        """ Add (or refresh) the interfaces of an overlaps.sqlite file.
+        Unchanged files are skipped unless force is set.
+        Return the number of interfaces stored. """
+        path = os.path.abspath(sqliteFN)
+        mtime = os.path.getmtime(path)
+        c = self.conn.cursor()
+        c.execute("SELECT id, mtime FROM sources WHERE path=?", (path,))
+        row = c.fetchone()
+        if row is not None:
+            if row[1] == mtime and not force:
+                return 0
+            self._removeSource(c, row[0])
+        c.execute("INSERT INTO sources(path, mtime) VALUES (?, ?)",
+                  (path, mtime))
+        sourceId = c.lastrowid
+        counter = 0
+        for key, tokens in readInterfaces(path).items():
+            hashes = fingerprint(tokens)
+            signature = minHash(hashes)
+            c.execute("""INSERT INTO interfaces(sourceId,
+                             modelId_1, protId_1, chainId_1,
+                             modelId_2, protId_2, chainId_2,
+                             nTokens, hashes, signature)
+                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                      (sourceId,) + key + (len(hashes), hashes.tobytes(),
+                                           signature.tobytes()))
+            interfaceId = c.lastrowid
+            c.executemany("INSERT INTO bands(band, bucket, interfaceId) "
+                          "VALUES (?, ?, ?)",
+                          [(band, bucket, interfaceId) for band, bucket
+                           in enumerate(bandBuckets(signature))])
+            counter += 1
+        self.conn.commit()
+        return counter
+
+    def _removeSource(self, c, sourceId):
+        c.execute("""DELETE FROM bands WHERE interfaceId IN
+                     (SELECT id FROM interfaces WHERE sourceId=?)""",
+                  (sourceId,))
+        c.execute("DELETE FROM interfaces WHERE sourceId=?", (sourceId,))
+        c.execute("DELETE FROM sources WHERE id=?", (sourceId,))
+
+    def removeDatabase(self, sqliteFN):
+        c = self.conn.cursor()
+        c.execute("SELECT id FROM sources WHERE path=?",
+                  (os.path.abspath(sqliteFN),))
+        row = c.fetchone()
+        if row is not None:
+            self._removeSource(c, row[0])
+            self.conn.commit()
+
+    def __len__(self):
+        return self.conn.execute("SELECT count(*) FROM interfaces").fetchone()[0]
+
+    def queryTokens(self, tokens, top=10, minSimilarity=0.0, exhaustive=False,
+                    excludePath=None):
+        """ Return the interfaces most similar to the given token set as a
+        list of (similarity, path, interface key) sorted by similarity.
+        Candidates share at least one LSH band with the query unless
+        exhaustive is set, interfaces of the file excludePath are not
+        candidates. """
+        hashes = fingerprint(tokens)
+        c = self.conn.cursor()
+        columns = """i.id, s.path, i.modelId_1, i.protId_1, i.chainId_1,
+                     i.modelId_2, i.protId_2, i.chainId_2, i.hashes"""
+        if exhaustive:
+            c.execute("""SELECT %s FROM interfaces i
+                         JOIN sources s ON s.id = i.sourceId
+                         WHERE s.path IS NOT ?""" % columns, (excludePath,))
+        else:
+            buckets = bandBuckets(minHash(hashes))
+            where = " OR ".join(["(b.band=? AND b.bucket=?)"] * len(buckets))
+            params = [v for item in enumerate(buckets) for v in item]
+            c.execute("""SELECT DISTINCT %s FROM bands b
+                         JOIN interfaces i ON i.id = b.interfaceId
+                         JOIN sources s ON s.id = i.sourceId
+                         WHERE (%s) AND s.path IS NOT ?""" % (columns, where),
+                      params + [excludePath])
+        hits = []
+        for row in c:
+            similarity = jaccard(hashes, np.frombuffer(row[8], dtype=np.uint32))
+            if similarity >= minSimilarity:
+                hits.append((similarity, row[1], tuple(row[2:8])))
+        hits.sort(key=lambda hit: hit[0], reverse=True)
+        return hits[:top]
+
+    def query(self, sqliteFN, top=10, minSimilarity=0.0, exhaustive=False):
+        """ Query every interface of an overlaps.sqlite file.
+        Return {interface key: hits}, hits from the same file are skipped """
+        path = os.path.abspath(sqliteFN)
+        results = {}
+        for key, tokens in readInterfaces(path).items():
+            results[key] = self.queryTokens(tokens, top=top,
+                                            minSimilarity=minSimilarity,
+                                            exhaustive=exhaustive,
+                                            excludePath=path)
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Interface fingerprint library of contacts databases")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    addParser = subparsers.add_parser('add', help="add overlaps.sqlite files")
+    addParser.add_argument('library')
+    addParser.add_argument('databases', nargs='+')
+    addParser.add_argument('--force', action='store_true')
+    queryParser = subparsers.add_parser('query', help="search similar interfaces")
+    queryParser.add_argument('library')
+    queryParser.add_argument('database')
+    queryParser.add_argument('--top', type=int, default=10)
+    queryParser.add_argument('--min', type=float, default=0.0)
+    queryParser.add_argument('--exhaustive', action='store_true')
+    args = parser.parse_args()
+
+    with InterfaceLibrary(args.library) as library:
+        if args.command == 'add':
+            for database in args.databases:
+                n = library.addDatabase(database, force=args.force)
+                print("%s: %d interfaces" % (database, n))
+        else:
+            results = library.query(args.database, top=args.top,
+                                    minSimilarity=args.min,
+                                    exhaustive=args.exhaustive)
+            for key, hits in results.items():
+                print("# %s" % ", ".join(key))
+                for similarity, path, hitKey in hits:
+                    print("%6.3f %s %s" % (similarity, path, ", ".join(hitKey)))
+
+
+if __name__ == '__main__':
+    main()
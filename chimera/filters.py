@@ -0,0 +1,173 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" FFT Gaussian and Laplacian filters for 3D maps.
+
+Both filters are separable, so their transfer functions are products
+(Gaussian) or sums (Laplacian) of 1D transfer functions that are cached
+and reused for every map with the same padded size. Maps are zero padded
+so that the result is the same as the real space filters of
+scipy.ndimage with mode='constant' (the truncated sampled Gaussian and the
+6 neighbour discrete Laplacian). scipy.fft caches its own plans.
+"""
+
+import os
+from functools import lru_cache
+
+import numpy as np
+from scipy import fft
+
+TRUNCATE = 4.0  # gaussian radius in standard deviations, as scipy.ndimage
+SMALL_SIGMA = 2.0  # in voxels, smaller gaussians are applied in real space
+
+
+def gaussianRadius(sigma, truncate=TRUNCATE):
+    """ Half width in voxels of the truncated gaussian kernel """
+    return int(truncate * float(sigma) + 0.5)
+
+
+@lru_cache(maxsize=64)
+def gaussianTransfer(n, sigma, truncate=TRUNCATE, real=False):
+    """ DFT of length n of the normalized, truncated and sampled gaussian
+    kernel of sigma voxels centered at index 0. Half spectrum if real. """
+    radius = gaussianRadius(sigma, truncate)
+    x = np.arange(-radius, radius + 1)
+    weights = np.exp(-0.5 * (x / sigma) ** 2)
+    kernel = np.zeros(n)
+    np.add.at(kernel, x % n, weights / weights.sum())
+    transfer = fft.rfft(kernel) if real else fft.fft(kernel)
+    return transfer.real.astype(np.float32)  # symmetric kernel
+
+
+@lru_cache(maxsize=64)
+def laplacianTransfer(n, real=False):
+    """ DFT of length n of the 1D second difference [1, -2, 1] """
+    frequencies = fft.rfftfreq(n) if real else fft.fftfreq(n)
+    return (2 * np.cos(2 * np.pi * frequencies) - 2).astype(np.float32)
+
+
+def _paddedShape(shape, margin):
+    return tuple(fft.next_fast_len(int(n) + int(m), real=True)
+                 for n, m in zip(shape, margin))
+
+
+def fftFilter(data, filterType='gaussian', sigma=None, workers=None):
+    """ Filtered copy of a 3D array (zero outside the array).
+
+    :param filterType: 'gaussian' or 'laplacian'
+    :param sigma: (z, y, x) standard deviations of the gaussian in voxels
+    :param workers: number of FFT threads, all cores if None
+    """
+    workers = workers or os.cpu_count() or 1
+    shape = data.shape
+    if filterType == 'gaussian':
+        sigma = np.broadcast_to(np.asarray(sigma, dtype=np.float64), (3,))
+        margin = [gaussianRadius(s) for s in sigma]
+    elif filterType == 'laplacian':
+        margin = (1, 1, 1)
+    else:
+        raise ValueError("Unknown filter %s" % filterType)
+    padded = _paddedShape(shape, margin)
+    spectrum = fft.rfftn(data.astype(np.float32, copy=False), s=padded,
+                         workers=workers)
+    nz, ny, nx = padded
+    if filterType == 'gaussian':
+        spectrum *= gaussianTransfer(nz, sigma[0])[:, None, None]
+        spectrum *= gaussianTransfer(ny, sigma[1])[None, :, None]
+        spectrum *= gaussianTransfer(nx, sigma[2], real=True)[None, None, :]
+    else:
+        tz = laplacianTransfer(nz)
+        tyx = laplacianTransfer(ny)[:, None] + \
+            laplacianTransfer(nx, real=True)[None, :]
+        for z in range(nz):  # avoid a full size transfer function
+            spectrum[z] *= tz[z] + tyx
+    result = fft.irfftn(spectrum, s=padded, workers=workers)
+    return np.ascontiguousarray(result[:shape[0], :shape[1], :shape[2]],
+                                dtype=np.float32)
+
+
+def realFilter(data, filterType='gaussian', sigma=None):
+    """ Same as fftFilter with separable real space convolutions, faster
+    for small gaussians """
+    from scipy import ndimage
+
+    if filterType == 'gaussian':
+        return ndimage.gaussian_filter(data, sigma, mode='constant',
+                                       truncate=TRUNCATE)
+    elif filterType == 'laplacian':
+        return ndimage.laplace(data, mode='constant')
+    raise ValueError("Unknown filter %s" % filterType)
+
+
+def useFFT(filterType, sigma):
+    """ True if the FFT is expected to be faster than real space """
+    return filterType == 'gaussian' and np.max(sigma) > SMALL_SIGMA
+
+
+def shellCorrelation(data1, data2, workers=None):
+    """ Fourier shell correlation of two 3D arrays of the same shape.
+
+    Shells are one Fourier voxel of the largest dimension n wide. Return
+    the shell frequencies in cycles per voxel (0 to 0.5) and the
+    correlation of each shell. The half spectra are weighted so that every
+    coefficient of the full spectrum counts once.
+
+    :param workers: number of FFT threads, all cores if None
+    """
+    workers = workers or os.cpu_count() or 1
+    if data1.shape != data2.shape:
+        raise ValueError("Maps of different shape %s and %s"
+                         % (data1.shape, data2.shape))
+    nz, ny, nx = data1.shape
+    n = max(data1.shape)
+    nShells = n // 2 + 1
+    spectrum1 = fft.rfftn(data1.astype(np.float32, copy=False),
+                          workers=workers)
+    spectrum2 = fft.rfftn(data2.astype(np.float32, copy=False),
+                          workers=workers)
+    # coefficients with a conjugate that is not stored count twice
+    weights = np.full(spectrum1.shape[2], 2.)
+    weights[0] = 1.
+    if nx % 2 == 0:
+        weights[-1] = 1.
+    fy = fft.fftfreq(ny)[:, None]
+    fx = fft.rfftfreq(nx)[None, :]
+    sums = np.zeros((3, nShells))  # cross, power 1 and power 2
+    for z, fz in enumerate(fft.fftfreq(nz)):
+        shells = np.rint(np.sqrt(fz ** 2 + fy ** 2 + fx ** 2) * n).astype(
+            np.intp).ravel()
+        inside = shells < nShells
+        shells = shells[inside]
+        s1, s2 = spectrum1[z], spectrum2[z]
+        products = weights * np.stack([(s1 * s2.conj()).real,
+                                       np.abs(s1) ** 2, np.abs(s2) ** 2])
+        for shellSums, values in zip(sums, products):
+            shellSums += np.bincount(shells, values.reshape(-1)[inside],
+                                     nShells)
+    cross, power1, power2 = sums
+    denominator = np.sqrt(power1 * power2)
+    fsc = np.divide(cross, denominator, out=np.zeros(nShells),
+                    where=denominator > 0)
+    return np.arange(nShells) / n, fsc
@@ -0,0 +1,266 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Metrics of the ChimeraX launches.
+
+Every launch of Plugin.runChimeraProgram is recorded as a JSON line with
+the startup latency (launch until the script begins), the wall time, the
+peak RSS of the child process, the exit status and the size of the
+script. Scripts sent to a worker of the pool report the peak RSS of the
+worker since it started (workerPeakRss) instead. The script is started
+through a small wrapper that writes the time at which it begins in a
+marker file. The records of a launch made from a protocol step, given
+by the caller, are also stored with the step (see addToStep).
+"""
+
+import json
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+LAUNCHES_FILE = 'chimerax_launches.jsonl'
+SCRIPT_EXTENSIONS = ('.py', '.cxc')
+# options of the ChimeraX command line that do not need a user
+HEADLESS_OPTIONS = {'--nogui', '--exit', '--script', '--offscreen',
+                    '--silent', '--nostatus'}
+
+# runs the script of a launch, after writing the time at which it begins
+WRAPPER_TEMPLATE = '''import time
+with open(%(marker)r, 'w') as f:
+    f.write(repr(time.time()))
+%(body)s'''
+
+# run a script as --script or open would (see scriptBody), also used by
+# the jobs of the workers
+PYTHON_BODY = '''with open(%(script)r) as f:
+    code = compile(f.read(), %(script)r, 'exec')
+exec(code, {'session': session, '__name__': '__main__',
+            '__file__': %(script)r})
+'''
+
+COMMAND_BODY = '''from chimerax.core.commands import run
+run(session, 'open %%s' %% %(quotedScript)r)
+'''
+
+
+def scriptFile(args, cwd=None, headless=False):
+    """ Absolute path of the .py or .cxc script of a ChimeraX command line
+    made of options and a single script, None for anything else (sessions,
+    background jobs...). If headless, also None unless the script runs
+    without user interaction (--nogui and only HEADLESS_OPTIONS). """
+    try:
+        tokens = shlex.split(args)
+    except ValueError:
+        return None
+    options = {t for t in tokens if t.startswith('--')}
+    if headless and ('--nogui' not in options
+                     or not options <= HEADLESS_OPTIONS):
+        return None
+    files = [t for t in tokens if not t.startswith('--')]
+    if len(files) != 1 or not files[0].endswith(SCRIPT_EXTENSIONS):
+        return None
+    return os.path.join(os.path.abspath(cwd or os.getcwd()), files[0])
+
+
+def markerFileName():
+    fd, fileName = tempfile.mkstemp(prefix='chimerax_start_', suffix='.txt')
+    os.close(fd)
+    os.remove(fileName)
+    return fileName
+
+
+def scriptBody(script):
+    """ Python code that runs script in the ChimeraX session """
+    template = PYTHON_BODY if script.endswith('.py') else COMMAND_BODY
+    return template % {'script': script, 'quotedScript': shlex.quote(script)}
+
+
+def wrapperCode(script, marker):
+    """ Python code that writes the time to marker and runs script """
+    return WRAPPER_TEMPLATE % {'marker': marker, 'body': scriptBody(script)}
+
+
+def wrapScript(args, script, marker):
+    """ Command line args with the script replaced by a wrapper that
+    writes the time at which it begins to marker. Return the new args and
+    the wrapper file name. """
+    wrapper = marker[:-len('.txt')] + '.py'
+    with open(wrapper, 'w') as f:
+        f.write(wrapperCode(script, marker))
+    tokens = [wrapper if not t.startswith('--') else t
+              for t in shlex.split(args)]
+    return ' '.join(shlex.quote(t) for t in tokens), wrapper
+
+
+def readMarker(marker):
+    """ Time written by the wrapper, None if the script did not begin """
+    try:
+        with open(marker) as f:
+            return float(f.read())
+    except (OSError, ValueError):
+        return None
+    finally:
+        if os.path.exists(marker):
+            os.remove(marker)
+
+
+def _maxRss(rusage):
+    """ ru_maxrss in bytes (kilobytes in Linux, bytes in macOS) """
+    return rusage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+
+def runCommand(command, env=None, cwd=None):
+    """ Run a shell command as pyworkflow.utils.runCommand does. Return
+    the exit status and the peak RSS (bytes) of the child process and its
+    descendants. """
+    process = subprocess.Popen(command, shell=True, stdout=sys.stdout,
+                               stderr=sys.stderr, env=env, cwd=cwd)
+    while True:
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+            break
+        except InterruptedError:
+            continue
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return process.returncode, _maxRss(rusage)
+
+
+def peakRss(pid):
+    """ Peak RSS (bytes) of a running process, None if unknown (Linux
+    only) """
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def protocolStep(protocol, stepName):
+    """ Running step of the protocol that calls the function stepName,
+    None if there is none """
+    for step in getattr(protocol, '_steps', None) or []:
+        funcName = getattr(step, 'funcName', None)
+        if (funcName is not None and funcName.get() == stepName
+                and step.isRunning()):
+            return step
+    return None
+
+
+def stepLaunches(step):
+    """ Records stored with a step, [] if none """
+    launches = getattr(step, 'chimeraxLaunches', None)
+    return json.loads(launches.get()) if launches is not None else []
+
+
+def addToStep(step, record):
+    """ Append a record to the chimeraxLaunches attribute (a JSON list) of
+    a step, it is saved in the run database with the step """
+    from pyworkflow.object import String
+
+    records = stepLaunches(step) + [record]
+    if getattr(step, 'chimeraxLaunches', None) is None:
+        step.chimeraxLaunches = String()
+    step.chimeraxLaunches.set(json.dumps(records))
+
+
+def launchRecord(program, args, cwd, start, end, status, rss=None,
+                 scriptSize=None, scriptStart=None, worker=None,
+                 protocol=None, step=None):
+    """ Dictionary with the metrics of a launch. The rss of a worker is
+    the peak of its whole life, it is stored as workerPeakRss """
+    record = {'time': start,
+              'host': socket.gethostname(),
+              'program': program,
+              'args': args,
+              'cwd': os.path.abspath(cwd or os.getcwd()),
+              'startup': (scriptStart - start
+                          if scriptStart is not None else None),
+              'wallTime': end - start,
+              'peakRss': rss if not worker else None,
+              'workerPeakRss': rss if worker else None,
+              'exitStatus': status,
+              'scriptSize': scriptSize,
+              'worker': worker}
+    if protocol is not None:
+        record.update({'protId': protocol.getObjId(),
+                       'protocol': protocol.getClassName(),
+                       'step': step})
+    return record
+
+
+def writeRecord(fileName, record):
+    """ Append a record to a JSON lines file """
+    os.makedirs(os.path.dirname(os.path.abspath(fileName)), exist_ok=True)
+    with open(fileName, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def readRecords(fileName):
+    """ Records of a JSON lines file, [] if it does not exist """
+    if not os.path.exists(fileName):
+        return []
+    with open(fileName) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def projectLaunchesFile(protocol=None):
+    """ Launches file in the Logs folder of the project of the protocol,
+    or of the working directory (protocols run in the project folder).
+    None if there is no Logs folder (ChimeraX launched outside a
+    project) """
+    project = protocol.getProject() if protocol is not None else None
+    if project is not None:
+        return project.getLogPath(LAUNCHES_FILE)
+    if os.path.isdir('Logs'):
+        return os.path.abspath(os.path.join('Logs', LAUNCHES_FILE))
+    return None
+
+
+def formatRecord(record):
+    """ One line summary of a launch for the run log """
+    def seconds(value):
+        return '%0.1f s' % value if value is not None else 'unknown'
+    def megabytes(value):
+        return '%0.0f MB' % (value / 1024 ** 2) if value else 'unknown'
+    if record['worker']:
+        rss = 'worker peak RSS since it started %s' % megabytes(
+            record.get('workerPeakRss'))
+    else:
+        rss = 'peak RSS %s' % megabytes(record['peakRss'])
+    return ("ChimeraX %s: startup %s, wall time %s, %s, exit status %s, "
+            "script %s bytes"
+            % ('worker' if record['worker'] else 'launch',
+               seconds(record['startup']), seconds(record['wallTime']), rss,
+               record['exitStatus'], record['scriptSize']))
@@ -0,0 +1,134 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Manifest of the models saved in the extra folder of a protocol.
+
+The scipionwrite command of the bundle appends a JSON line for every model
+it saves with the path (relative to the folder of the manifest), the type
+('map' or 'atomStruct'), the sampling, origin and dimensions (x, y, z) of
+maps and the sha256 of the file, so that the outputs are registered and
+shown without listing the folder and reading the map headers again.
+Folders without manifest (older bundles) are listed as before.
+"""
+
+import hashlib
+import json
+import os
+
+MANIFEST_FILE = 'outputs.jsonl'
+MAP = 'map'
+ATOM_STRUCT = 'atomStruct'
+MAP_SUFFIXES = ('.mrc',)
+ATOM_STRUCT_SUFFIXES = ('.pdb', '.cif')
+CHUNK_SIZE = 2 ** 24
+
+
+def manifestFileName(directory):
+    return os.path.join(directory, MANIFEST_FILE)
+
+
+def fileChecksum(fileName, chunkSize=CHUNK_SIZE):
+    """ sha256 of a file, as written by scipionwrite """
+    digest = hashlib.sha256()
+    with open(fileName, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunkSize), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def fileType(fileName):
+    """ MAP or ATOM_STRUCT from the suffix of the file, None otherwise """
+    if fileName.endswith(MAP_SUFFIXES):
+        return MAP
+    if fileName.endswith(ATOM_STRUCT_SUFFIXES):
+        return ATOM_STRUCT
+    return None
+
+
+def fileEntry(fileName, directory, checksum=True):
+    """ Manifest entry of a map or atomic structure, the map header is read
+    with chimera.maps """
+    entry = {'path': os.path.relpath(fileName, directory),
+             'type': fileType(fileName),
+             'sampling': None, 'origin': None, 'dims': None,
+             'checksum': fileChecksum(fileName) if checksum else None}
+    if entry['type'] == MAP:
+        from . import maps
+        with maps.openMap(fileName) as mapFile:
+            entry['sampling'] = float(mapFile.voxelSize[0])
+            entry['origin'] = [float(x) for x in mapFile.origin]
+            entry['dims'] = [int(n) for n in mapFile.shape[::-1]]
+    return entry
+
+
+def writeEntry(directory, entry):
+    """ Append an entry to the manifest of a folder """
+    with open(manifestFileName(directory), 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+
+def readManifest(directory):
+    """ Entries of the manifest of a folder sorted by path, the last one of
+    each path and only if the file exists. None if there is no manifest """
+    entries = {}
+    try:
+        with open(manifestFileName(directory)) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:  # interrupted write
+                    continue
+                entries[entry['path']] = entry
+    except FileNotFoundError:
+        return None
+    return [entries[path] for path in sorted(entries)
+            if os.path.exists(os.path.join(directory, path))]
+
+
+def scanDirectory(directory):
+    """ Entries of the maps and atomic structures of a folder without
+    manifest, without checksum """
+    return [fileEntry(os.path.join(directory, fileName), directory,
+                      checksum=False)
+            for fileName in sorted(os.listdir(directory))
+            if fileType(fileName) is not None]
+
+
+def outputEntries(directory):
+    """ Entries of the manifest of a folder, or of its files if there is
+    no manifest. The header is only read for maps saved without it """
+    entries = readManifest(directory)
+    if entries is None:
+        return scanDirectory(directory)
+    return [fileEntry(os.path.join(directory, entry['path']), directory,
+                      checksum=False)
+            if entry['type'] == MAP and entry['sampling'] is None else entry
+            for entry in entries]
+
+
+def outputName(entry):
+    """ Name of the output registered for an entry """
+    name = os.path.splitext(os.path.basename(entry['path']))[0]
+    return name if entry['type'] == MAP else name.replace('.', '_')
@@ -0,0 +1,159 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Content addressed cache of simulated maps and symmetrized structures.
+
+Entries are plain files named after the SHA-256 of the parameters that
+produced them (see cacheKey), including the version of the code that
+computes them (molmap.VERSION...). The modification time of an entry is
+updated on every hit and the least recently used entries are removed
+when the cache grows over its size quota.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+HASH_BLOCK = 1024 * 1024
+
+
+def fileHash(fileName):
+    """ SHA-256 of the content of a file """
+    sha = hashlib.sha256()
+    with open(fileName, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _jsonValue(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("%r cannot be part of a cache key" % value)
+
+
+def cacheKey(**fields):
+    """ Key for the given fields (numbers, strings, lists, None...).
+    Numbers are compared as floats rounded to 4 decimals so that, for
+    instance, sampling rates read from different headers give the same
+    key. """
+    def normalize(value):
+        if isinstance(value, (int, float, np.number)) and \
+                not isinstance(value, bool):
+            return round(float(value), 4)
+        if isinstance(value, (list, tuple, np.ndarray)):
+            return [normalize(v) for v in value]
+        return value
+    text = json.dumps({k: normalize(v) for k, v in fields.items()},
+                      sort_keys=True, default=_jsonValue)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+class MapCache:
+    """ Directory with cached files and LRU eviction """
+
+    def __init__(self, directory, maxSize=10 * 1024 ** 3):
+        """
+        :param maxSize: quota in bytes
+        """
+        self.directory = directory
+        self.maxSize = maxSize
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    def get(self, key, suffix='.mrc'):
+        """ Path of the cached file or None. A hit marks the entry as
+        recently used. """
+        path = self._path(key, suffix)
+        if not os.path.exists(path):
+            return None
+        try:
+            os.utime(path)
+        except OSError:  # removed by another process
+            return None
+        return path
+
+    def fetch(self, key, outFn, suffix='.mrc'):
+        """ Copy the cached file to outFn, return False on a miss """
+        path = self.get(key, suffix)
+        if path is None:
+            return False
+        try:
+            shutil.copyfile(path, outFn)
+        except FileNotFoundError:  # evicted by another process meanwhile
+            return False
+        return True
+
+    def put(self, key, fileName, suffix='.mrc'):
+        """ Store a copy of fileName. The copy is renamed atomically so
+        that concurrent runs never read partial entries. """
+        fd, tmpFn = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        os.close(fd)
+        try:
+            shutil.copyfile(fileName, tmpFn)
+            os.replace(tmpFn, self._path(key, suffix))
+        finally:
+            if os.path.exists(tmpFn):
+                os.remove(tmpFn)
+        self.evict()
+        return self._path(key, suffix)
+
+    def entries(self):
+        """ (mtime, size, path) of every entry, least recently used first """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, maxSize=None):
+        """ Remove least recently used entries until the cache fits in
+        maxSize bytes (the quota of the cache by default) """
+        maxSize = self.maxSize if maxSize is None else maxSize
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= maxSize:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        self.evict(0)
@@ -0,0 +1,864 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Native (ChimeraX free) operations on 3D maps.
+
+Maps are MRC files opened as memory maps and processed in slabs of
+consecutive z sections so that only a few sections are in memory at a
+time. Grid conventions follow ChimeraX: data arrays are indexed (z, y, x),
+voxel sizes and origins are (x, y, z) in Angstroms and the origin is the
+position of the voxel with index (0, 0, 0). Axis permutations (mapc, mapr,
+maps) and non orthogonal cells are not supported.
+
+Maps can be written in half precision (MRC mode 12) and gzip compressed
+(file names ending in .gz). Compressed maps are built in a temporary
+memory map and compressed in independent chunks when they are closed;
+they are decompressed in memory when opened. Only maps that are not
+registered as Scipion outputs are compressed, Scipion and most programs
+read Volumes as plain MRC files.
+"""
+
+import collections
+import itertools
+import json
+import os
+import zlib
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import mrcfile
+
+SLAB_SIZE = 32  # number of z sections processed at a time
+FLOAT32 = 2  # MRC mode
+FLOAT16 = 12  # MRC mode, half precision
+GZIP_SUFFIX = '.gz'
+GZIP_CHUNK = 64 * 1024 ** 2  # bytes compressed independently
+# output formats of the maps: (label, MRC mode, gzip compressed)
+OUTPUT_FORMATS = [('float32', FLOAT32, False),
+                  ('float16', FLOAT16, False),
+                  ('float16 compressed', FLOAT16, True)]
+# working memory per voxel of a slab, including temporaries (interpolation
+# on another grid needs float64 coordinates)
+VOXEL_BYTES = 96
+FFT_VOXEL_BYTES = 24  # padded half spectrum and result of a whole map FFT
+HISTOGRAM_BINS = 1024
+PERCENTILES = (1, 5, 25, 50, 75, 95, 99, 99.9)
+STATS_SUFFIX = '.stats.json'  # sidecar with the statistics of a map
+
+
+class MapFile:
+    """ MRC file opened as a memory map, see openMap and createMap """
+
+    def __init__(self, fileName, mrc, voxelSize, origin, tmpFileName=None):
+        self.fileName = fileName
+        self.mrc = mrc
+        self.voxelSize = np.array(voxelSize, dtype=np.float64)
+        self.origin = np.array(origin, dtype=np.float64)
+        self.tmpFileName = tmpFileName  # uncompressed map being written
+        self.stats = None  # RunningStats saved in the sidecar on close
+
+    @property
+    def data(self):
+        return self.mrc.data
+
+    @property
+    def shape(self):
+        """ (nz, ny, nx) """
+        return self.mrc.data.shape
+
+    def close(self):
+        if self.mrc is None:
+            return
+        self.mrc.close()
+        self.mrc = None
+        if self.tmpFileName is not None:
+            compressFile(self.tmpFileName, self.fileName)
+            os.remove(self.tmpFileName)
+        if self.stats is not None:
+            writeStats(self.fileName, self.stats)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def sameGrid(self, other, tolerance=1e-3):
+        """ True if both maps have the same grid points """
+        return (self.shape == other.shape and
+                np.allclose(self.voxelSize, other.voxelSize, atol=tolerance) and
+                np.allclose(self.origin, other.origin, atol=tolerance))
+
+    def slab(self, z0, z1):
+        """ Copy of sections z0 to z1 (excluded) as float32 """
+        return np.array(self.data[z0:z1], dtype=np.float32)
+
+    def haloSlab(self, z0, z1, halo):
+        """ Sections z0 - halo to z1 + halo, sections outside the map are
+        0 """
+        nz = self.shape[0]
+        block = np.zeros((z1 - z0 + 2 * halo,) + self.shape[1:],
+                         dtype=np.float32)
+        low, high = max(z0 - halo, 0), min(z1 + halo, nz)
+        start = low - (z0 - halo)
+        block[start:start + high - low] = self.data[low:high]
+        return block
+
+    def gridToXyz(self, ijk):
+        """ Convert (..., 3) grid indices (x, y, z order) to Angstroms """
+        return self.origin + np.asarray(ijk) * self.voxelSize
+
+    def xyzToGrid(self, xyz):
+        """ Convert (..., 3) coordinates in Angstroms to fractional grid
+        indices (x, y, z order) """
+        return (np.asarray(xyz) - self.origin) / self.voxelSize
+
+
+def _headerOrigin(mrc, voxelSize):
+    origin = np.array([mrc.header.origin.x, mrc.header.origin.y,
+                       mrc.header.origin.z], dtype=np.float64)
+    if not origin.any():
+        # ChimeraX uses the start indices when the origin is not set
+        start = np.array([mrc.header.nxstart, mrc.header.nystart,
+                          mrc.header.nzstart], dtype=np.float64)
+        origin = start * voxelSize
+    return origin
+
+
+def openMap(fileName, voxelSize=None, origin=None, mode='r'):
+    """ Open a MRC file as a memory map (read in memory if compressed).
+
+    :param voxelSize: (x, y, z) or scalar, read from the header if None
+    :param origin: (x, y, z) in Angstroms, read from the header if None.
+                   Scipion volumes provide it with getShiftsFromOrigin()
+    """
+    if isCompressed(fileName):
+        mrc = mrcfile.open(fileName, mode='r', permissive=True)
+    else:
+        mrc = mrcfile.mmap(fileName, mode=mode, permissive=True)
+    if voxelSize is None:
+        voxelSize = np.array([mrc.voxel_size.x, mrc.voxel_size.y,
+                              mrc.voxel_size.z], dtype=np.float64)
+    else:
+        voxelSize = np.broadcast_to(np.asarray(voxelSize, dtype=np.float64),
+                                    (3,)).copy()
+    if origin is None:
+        origin = _headerOrigin(mrc, voxelSize)
+    return MapFile(fileName, mrc, voxelSize, origin)
+
+
+def createMap(fileName, shape, voxelSize, origin, mrcMode=FLOAT32):
+    """ Create an empty MRC file (memory mapped) with the given grid. The
+    file is compressed when it is closed if its name ends in .gz. """
+    tmpFileName = None
+    if isCompressed(fileName):
+        tmpFileName = fileName[:-len(GZIP_SUFFIX)] + '.tmp'
+    mrc = mrcfile.new_mmap(tmpFileName or fileName,
+                           tuple(int(n) for n in shape),
+                           mrc_mode=mrcMode, overwrite=True)
+    voxelSize = np.broadcast_to(np.asarray(voxelSize, dtype=np.float64),
+                                (3,)).copy()
+    mrc.voxel_size = tuple(voxelSize)
+    mrc.header.origin = tuple(origin)
+    return MapFile(fileName, mrc, voxelSize, origin, tmpFileName)
+
+
+def isCompressed(fileName):
+    return fileName.endswith(GZIP_SUFFIX)
+
+
+def outputFileName(fileName, outputFormat=0, output=True):
+    """ File name of a map written in OUTPUT_FORMATS[outputFormat]. Maps
+    registered as outputs (output=True) are never compressed """
+    if OUTPUT_FORMATS[outputFormat][2] and not output:
+        return fileName + GZIP_SUFFIX
+    return fileName
+
+
+def compressedMaps(directory):
+    """ Sorted names of the compressed maps of a folder """
+    return sorted(fileName for fileName in os.listdir(directory)
+                  if fileName.endswith('.mrc' + GZIP_SUFFIX))
+
+
+def outputMode(outputFormat=0):
+    """ MRC mode of OUTPUT_FORMATS[outputFormat] """
+    return OUTPUT_FORMATS[outputFormat][1]
+
+
+def boundedMap(executor, function, iterable, window):
+    """ Results of function for the items of iterable in order, as
+    executor.map, with at most window calls submitted at a time so that
+    the items and results waiting in memory stay bounded """
+    iterator = iter(iterable)
+    pending = collections.deque(executor.submit(function, item)
+                                for item in itertools.islice(iterator, window))
+    while pending:
+        future = pending.popleft()
+        for item in itertools.islice(iterator, 1):
+            pending.append(executor.submit(function, item))
+        yield future.result()
+
+
+def compressFile(inFn, outFn, chunkSize=GZIP_CHUNK, threads=None):
+    """ Gzip a file compressing chunks in parallel. Each chunk is a gzip
+    member, the result is a standard gzip file. """
+    def compress(chunk):
+        compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(chunk) + compressor.flush()
+
+    def chunks(f):
+        while True:
+            chunk = f.read(chunkSize)
+            if not chunk:
+                return
+            yield chunk
+
+    threads = threads or os.cpu_count() or 1
+    with open(inFn, 'rb') as fIn, open(outFn, 'wb') as fOut, \
+            ThreadPoolExecutor(max_workers=threads) as executor:
+        for member in boundedMap(executor, compress, chunks(fIn), threads):
+            fOut.write(member)
+
+
+def slabSizeForMemory(shape, memory, halo=0, voxelBytes=VOXEL_BYTES):
+    """ Number of sections per slab so that processing a slab (with its
+    halo sections) takes about memory bytes. At least 1. """
+    sectionBytes = int(shape[1]) * int(shape[2]) * voxelBytes
+    return max(1, int(memory // sectionBytes) - 2 * halo)
+
+
+def _slabSize(shape, slabSize, memory, halo=0):
+    if memory:
+        return slabSizeForMemory(shape, memory, halo)
+    return slabSize
+
+
+def iterSlabs(nz, slabSize=SLAB_SIZE):
+    """ Yield (z0, z1) section ranges """
+    for z0 in range(0, nz, slabSize):
+        yield z0, min(z0 + slabSize, nz)
+
+
+class Histogram:
+    """ Streaming histogram with a fixed number of bins whose range grows
+    (merging pairs of bins) to include new values """
+
+    def __init__(self, bins=HISTOGRAM_BINS):
+        self.bins = bins + bins % 2
+        self.counts = np.zeros(self.bins, dtype=np.int64)
+        self.low = None
+        self.width = None
+
+    @property
+    def high(self):
+        return self.low + self.bins * self.width
+
+    def _grow(self, left):
+        """ Double the bin width, keeping the range in the left or right
+        half """
+        merged = self.counts.reshape(-1, 2).sum(axis=1)
+        self.counts[:] = 0
+        if left:  # values below the range
+            self.counts[self.bins // 2:] = merged
+            self.low -= self.bins * self.width
+        else:
+            self.counts[:self.bins // 2] = merged
+        self.width *= 2
+
+    def update(self, values, vMin, vMax):
+        """ Count values, all finite, in the range vMin to vMax """
+        if self.low is None:
+            self.low = vMin
+            self.width = (vMax - vMin) / self.bins or 1e-6
+        while vMin < self.low:
+            self._grow(left=True)
+        while vMax >= self.high:
+            self._grow(left=False)
+        index = ((values.ravel() - self.low) / self.width).astype(np.int64)
+        self.counts += np.bincount(np.clip(index, 0, self.bins - 1),
+                                   minlength=self.bins)
+
+    def edges(self):
+        return self.low + self.width * np.arange(self.bins + 1)
+
+    def percentiles(self, q):
+        """ Percentiles q (0 to 100) interpolated in the bins """
+        cumulative = np.concatenate(([0], np.cumsum(self.counts)))
+        return np.interp(np.asarray(q) / 100. * cumulative[-1], cumulative,
+                         self.edges())
+
+
+class RunningStats:
+    """ Streaming min, max, mean, rms and histogram of a map written in
+    slabs. Infinite and NaN values (float16 overflows to inf above 65504)
+    are only counted in nonFinite. """
+
+    def __init__(self):
+        self.min = np.inf
+        self.max = -np.inf
+        self.sum = 0.
+        self.sum2 = 0.
+        self.n = 0
+        self.nonFinite = 0
+        self.histogram = Histogram()
+
+    def update(self, values):
+        finite = np.isfinite(values)
+        if not finite.all():
+            self.nonFinite += int(values.size - np.count_nonzero(finite))
+            values = values[finite]
+        if values.size == 0:
+            return
+        vMin, vMax = float(values.min()), float(values.max())
+        self.min = min(self.min, vMin)
+        self.max = max(self.max, vMax)
+        self.sum += float(values.sum(dtype=np.float64))
+        self.sum2 += float(np.dot(values.ravel().astype(np.float64),
+                                  values.ravel()))
+        self.n += values.size
+        self.histogram.update(values, vMin, vMax)
+
+    @property
+    def mean(self):
+        return self.sum / self.n if self.n else 0.
+
+    @property
+    def rms(self):
+        """ Standard deviation from the mean, as stored in MRC headers """
+        if not self.n:
+            return 0.
+        return float(np.sqrt(max(self.sum2 / self.n - self.mean ** 2, 0.)))
+
+    def toDict(self):
+        """ Statistics as stored in the sidecar file. level encloses 1% of
+        the grid points, as the initial level chosen by ChimeraX. """
+        if not self.n:
+            return {'n': 0, 'nonFinite': self.nonFinite}
+        percentiles = self.histogram.percentiles(PERCENTILES)
+        return {'n': self.n, 'nonFinite': self.nonFinite,
+                'min': self.min, 'max': self.max,
+                'mean': self.mean, 'rms': self.rms,
+                'percentiles': {'%g' % q: float(v)
+                                for q, v in zip(PERCENTILES, percentiles)},
+                'level': float(self.histogram.percentiles(99.)),
+                'histogram': {'low': self.histogram.low,
+                              'width': self.histogram.width,
+                              'counts': self.histogram.counts.tolist()}}
+
+    def setHeader(self, mapFile):
+        """ Write the statistics in the MRC header, and in the sidecar file
+        of the map when it is closed """
+        header = mapFile.mrc.header
+        header.dmin = self.min if self.n else 0.
+        header.dmax = self.max if self.n else 0.
+        header.dmean = self.mean
+        header.rms = self.rms
+        mapFile.stats = self
+
+
+def statsFileName(fileName):
+    return fileName + STATS_SUFFIX
+
+
+def writeStats(fileName, stats):
+    """ Write the sidecar with the RunningStats of a map """
+    with open(statsFileName(fileName), 'w') as f:
+        json.dump(stats.toDict(), f)
+
+
+def readStats(fileName):
+    """ Statistics of a map from its sidecar (see RunningStats.toDict),
+    None if there is no sidecar or the map is newer """
+    sidecar = statsFileName(fileName)
+    try:
+        if os.path.getmtime(sidecar) < os.path.getmtime(fileName):
+            return None
+        with open(sidecar) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def mapStats(fileName, slabSize=SLAB_SIZE):
+    """ Statistics of a map (for instance written by ChimeraX) from its
+    sidecar, computed in a single pass and saved if needed """
+    stats = readStats(fileName)
+    if stats is None:
+        running = RunningStats()
+        with openMap(fileName) as mapFile:
+            for z0, z1 in iterSlabs(mapFile.shape[0], slabSize):
+                running.update(mapFile.slab(z0, z1))
+        writeStats(fileName, running)
+        stats = running.toDict()
+    return stats
+
+
+def resampleSlab(source, target, z0, z1):
+    """ Values of the source map at the grid points of target sections
+    z0 to z1 (trilinear interpolation, 0 outside the source map) """
+    if source.sameGrid(target):
+        return source.slab(z0, z1)
+    from scipy.ndimage import map_coordinates
+
+    ny, nx = target.shape[1:]
+    k, j, i = np.meshgrid(np.arange(z0, z1), np.arange(ny), np.arange(nx),
+                          indexing='ij')
+    xyz = target.origin + np.stack((i, j, k), axis=-1) * target.voxelSize
+    ijk = source.xyzToGrid(xyz)  # (..., 3) fractional x, y, z indices
+    # read only the source sections needed by this slab
+    zMin = int(np.floor(ijk[..., 2].min()))
+    zMax = int(np.ceil(ijk[..., 2].max())) + 1
+    zMin = max(zMin, 0)
+    zMax = min(zMax, source.shape[0])
+    if zMax <= zMin:
+        return np.zeros((z1 - z0, ny, nx), dtype=np.float32)
+    block = source.slab(zMin, zMax)
+    coordinates = np.stack((ijk[..., 2] - zMin, ijk[..., 1], ijk[..., 0]))
+    return map_coordinates(block, coordinates, order=1, mode='constant',
+                           cval=0.).astype(np.float32)
+
+
+def minRmsScale(minuend, subtrahend, slabSize=SLAB_SIZE):
+    """ Factor f that minimizes the rms of minuend - f * subtrahend
+    (subtrahend interpolated on the minuend grid), computed in a single
+    streaming pass with float64 accumulators """
+    sumMS = 0.
+    sumSS = 0.
+    for z0, z1 in iterSlabs(minuend.shape[0], slabSize):
+        m = minuend.slab(z0, z1).ravel()
+        s = resampleSlab(subtrahend, minuend, z0, z1).ravel()
+        sumMS += float(np.dot(m.astype(np.float64), s))
+        sumSS += float(np.dot(s.astype(np.float64), s))
+    if sumSS == 0.:
+        return 1.
+    return sumMS / sumSS
+
+
+def subtractMaps(minuendFn, subtrahendFn, outFn, minRms=True,
+                 minuendVoxelSize=None, minuendOrigin=None,
+                 subtrahendVoxelSize=None, subtrahendOrigin=None,
+                 slabSize=SLAB_SIZE, memory=None, mrcMode=FLOAT32):
+    """ Write outFn = minuend - f * subtrahend on the minuend grid.
+    Equivalent to ChimeraX
+    'volume subtract #minuend #subtrahend minRms true onGrid #minuend'.
+
+    f is 1 unless minRms is set, in which case it minimizes the rms of the
+    difference. Both input maps are memory mapped and the output is
+    written section by section. Return f.
+
+    :param memory: budget in bytes, overrides slabSize
+    :param mrcMode: FLOAT32 or FLOAT16
+    """
+    with openMap(minuendFn, minuendVoxelSize, minuendOrigin) as minuend, \
+            openMap(subtrahendFn, subtrahendVoxelSize,
+                    subtrahendOrigin) as subtrahend:
+        slabSize = _slabSize(minuend.shape, slabSize, memory)
+        scale = minRmsScale(minuend, subtrahend, slabSize) if minRms else 1.
+        stats = RunningStats()
+        with createMap(outFn, minuend.shape, minuend.voxelSize,
+                       minuend.origin, mrcMode) as out:
+            for z0, z1 in iterSlabs(minuend.shape[0], slabSize):
+                diff = minuend.slab(z0, z1)
+                diff -= np.float32(scale) * resampleSlab(subtrahend, minuend,
+                                                         z0, z1)
+                out.data[z0:z1] = diff
+                stats.update(diff)
+            stats.setHeader(out)
+    return scale
+
+
+def maskMap(minuendFn, maskFn, outFn, level, invert=True,
+            minuendVoxelSize=None, minuendOrigin=None,
+            maskVoxelSize=None, maskOrigin=None, slabSize=SLAB_SIZE,
+            memory=None, mrcMode=FLOAT32):
+    """ Write the minuend with the voxels where the mask map (interpolated
+    on the minuend grid) is above level set to 0, or only those voxels if
+    invert is False. Voxel based version of ChimeraX
+    'volume mask #minuend surfaces #mask invertMask true'.
+
+    :param level: contour level of the mask, see defaultLevel if None
+    :param memory: budget in bytes, overrides slabSize
+    """
+    with openMap(minuendFn, minuendVoxelSize, minuendOrigin) as minuend, \
+            openMap(maskFn, maskVoxelSize, maskOrigin) as mask:
+        slabSize = _slabSize(minuend.shape, slabSize, memory)
+        if level is None:
+            level = defaultLevel(mask)
+        stats = RunningStats()
+        with createMap(outFn, minuend.shape, minuend.voxelSize,
+                       minuend.origin, mrcMode) as out:
+            for z0, z1 in iterSlabs(minuend.shape[0], slabSize):
+                masked = minuend.slab(z0, z1)
+                inside = resampleSlab(mask, minuend, z0, z1) > level
+                masked[inside if invert else ~inside] = 0.
+                out.data[z0:z1] = masked
+                stats.update(masked)
+            stats.setHeader(out)
+
+
+def zoneMask(mapFile, tree, radius, z0, z1):
+    """ Boolean mask of the grid points of sections z0 to z1 within radius
+    (Angstroms) of any atom.
+
+    :param tree: scipy cKDTree of the atom coordinates. Only the grid points
+                 inside the bounding box of the atoms are queried.
+    """
+    ny, nx = mapFile.shape[1:]
+    mask = np.zeros((z1 - z0, ny, nx), dtype=bool)
+    if tree.n == 0:
+        return mask
+    low = np.floor(mapFile.xyzToGrid(tree.mins - radius)).astype(int)
+    high = np.ceil(mapFile.xyzToGrid(tree.maxes + radius)).astype(int) + 1
+    low = np.maximum(low, (0, 0, z0))
+    high = np.minimum(high, (nx, ny, z1))
+    if np.any(high <= low):
+        return mask
+    k, j, i = np.meshgrid(*[np.arange(low[a], high[a]) for a in (2, 1, 0)],
+                          indexing='ij')
+    points = mapFile.gridToXyz(np.stack((i, j, k), axis=-1).reshape(-1, 3))
+    distances, _ = tree.query(points, distance_upper_bound=radius,
+                              workers=-1)
+    mask[low[2] - z0:high[2] - z0, low[1]:high[1], low[0]:high[0]] = \
+        np.isfinite(distances).reshape(k.shape)
+    return mask
+
+
+def zoneMap(inFn, outFn, xyz, radius, voxelSize=None, origin=None,
+            slabSize=SLAB_SIZE, memory=None, mrcMode=FLOAT32):
+    """ Write a copy of a map with the grid points farther than radius
+    (Angstroms) from every atom set to 0. Equivalent to ChimeraX
+    'volume zone #map nearAtoms #atoms range radius newMap true'.
+
+    :param xyz: (n, 3) atom coordinates in Angstroms
+    """
+    from scipy.spatial import cKDTree
+
+    tree = cKDTree(np.asarray(xyz, dtype=np.float64).reshape(-1, 3))
+    with openMap(inFn, voxelSize, origin) as inMap:
+        slabSize = _slabSize(inMap.shape, slabSize, memory)
+        stats = RunningStats()
+        with createMap(outFn, inMap.shape, inMap.voxelSize,
+                       inMap.origin, mrcMode) as out:
+            for z0, z1 in iterSlabs(inMap.shape[0], slabSize):
+                zone = inMap.slab(z0, z1)
+                zone[~zoneMask(inMap, tree, radius, z0, z1)] = 0.
+                out.data[z0:z1] = zone
+                stats.update(zone)
+            stats.setHeader(out)
+
+
+def binMap(inFn, outFn, factor, voxelSize=None, origin=None,
+           slabSize=SLAB_SIZE, memory=None, mrcMode=FLOAT32):
+    """ Write the map binned by factor (mean of blocks of factor^3 voxels,
+    the last sections, rows and columns that do not fill a block are
+    dropped). The origin is the center of the first block. Return the
+    voxel size and origin of the binned map. """
+    factor = int(factor)
+    with openMap(inFn, voxelSize, origin) as inMap:
+        nz, ny, nx = [n // factor for n in inMap.shape]
+        binVoxelSize = inMap.voxelSize * factor
+        binOrigin = inMap.origin + (factor - 1) / 2. * inMap.voxelSize
+        slabSize = max(1, _slabSize(inMap.shape, slabSize, memory) // factor)
+        stats = RunningStats()
+        with createMap(outFn, (nz, ny, nx), binVoxelSize, binOrigin,
+                       mrcMode) as out:
+            for b0, b1 in iterSlabs(nz, slabSize):
+                block = inMap.slab(b0 * factor, b1 * factor)
+                block = block[:, :ny * factor, :nx * factor]
+                binned = block.reshape(b1 - b0, factor, ny, factor, nx,
+                                       factor).mean(axis=(1, 3, 5),
+                                                    dtype=np.float32)
+                out.data[b0:b1] = binned
+                stats.update(binned)
+            stats.setHeader(out)
+    return binVoxelSize, binOrigin
+
+
+def cropBox(mapFile, xyz, padding):
+    """ (low, high) (z, y, x) grid indices of the box around the atoms xyz
+    plus padding (Angstroms), clipped to the map. low == high on some axis
+    if the box is outside the map. """
+    xyz = np.asarray(xyz, dtype=np.float64).reshape(-1, 3)
+    low = np.floor(mapFile.xyzToGrid(xyz.min(axis=0) - padding)).astype(int)
+    high = np.ceil(mapFile.xyzToGrid(xyz.max(axis=0) + padding)).astype(int)
+    shape = np.array(mapFile.shape)
+    low = np.clip(low[::-1], 0, shape)
+    high = np.clip(high[::-1] + 1, low, shape)
+    return low, high
+
+
+def cropMap(inFn, outFn, low, high, voxelSize=None, origin=None,
+            slabSize=SLAB_SIZE, memory=None, mrcMode=FLOAT32):
+    """ Write the sub-box low to high (z, y, x grid indices, see cropBox)
+    of a map, with the origin of its first voxel. Return the origin. """
+    with openMap(inFn, voxelSize, origin) as inMap:
+        z0, y0, x0 = low
+        z1, y1, x1 = high
+        cropOrigin = inMap.gridToXyz((x0, y0, z0))
+        slabSize = _slabSize(inMap.shape, slabSize, memory)
+        stats = RunningStats()
+        with createMap(outFn, tuple(np.subtract(high, low)),
+                       inMap.voxelSize, cropOrigin, mrcMode) as out:
+            for s0, s1 in iterSlabs(z1 - z0, slabSize):
+                block = np.array(inMap.data[z0 + s0:z0 + s1, y0:y1, x0:x1],
+                                 dtype=np.float32)
+                out.data[s0:s1] = block
+                stats.update(block)
+            stats.setHeader(out)
+    return cropOrigin
+
+
+def pasteMap(cropFn, gridFn, outFn, background=True, gridVoxelSize=None,
+             gridOrigin=None, slabSize=SLAB_SIZE, memory=None,
+             mrcMode=FLOAT32):
+    """ Write a map on the grid of gridFn with the values of cropFn (a
+    crop of that grid, see cropMap) inside the crop and those of gridFn
+    (or 0 if not background) outside """
+    with openMap(gridFn, gridVoxelSize, gridOrigin) as grid, \
+            openMap(cropFn, gridVoxelSize) as crop:
+        x0, y0, z0 = np.round(grid.xyzToGrid(crop.origin)).astype(int)
+        nz, ny, nx = crop.shape
+        slabSize = _slabSize(grid.shape, slabSize, memory)
+        stats = RunningStats()
+        with createMap(outFn, grid.shape, grid.voxelSize, grid.origin,
+                       mrcMode) as out:
+            for s0, s1 in iterSlabs(grid.shape[0], slabSize):
+                if background:
+                    block = grid.slab(s0, s1)
+                else:
+                    block = np.zeros((s1 - s0,) + grid.shape[1:],
+                                     dtype=np.float32)
+                c0, c1 = max(s0, z0), min(s1, z0 + nz)
+                if c0 < c1:
+                    block[c0 - s0:c1 - s0, y0:y0 + ny, x0:x0 + nx] = \
+                        crop.data[c0 - z0:c1 - z0]
+                out.data[s0:s1] = block
+                stats.update(block)
+            stats.setHeader(out)
+
+
+def defaultLevel(mapFile, fraction=0.01, samples=10 ** 6):
+    """ Contour level enclosing a fraction of the grid points, as the
+    initial level chosen by ChimeraX. Taken from the histogram of the
+    sidecar if the map has one, otherwise estimated on a regular subsample
+    of the map. """
+    stats = readStats(mapFile.fileName)
+    if stats is not None and stats['n']:
+        histogram = stats['histogram']
+        counts = np.asarray(histogram['counts'])
+        cumulative = np.concatenate(([0], np.cumsum(counts)))
+        edges = histogram['low'] + histogram['width'] * \
+            np.arange(len(counts) + 1)
+        return float(np.interp((1. - fraction) * cumulative[-1], cumulative,
+                               edges))
+    step = max(1, int(np.ceil((np.prod(mapFile.shape) / samples) ** (1 / 3))))
+    sample = np.asarray(mapFile.data[::step, ::step, ::step])
+    return float(np.quantile(sample, 1. - fraction))
+
+
+def filterMap(inFn, outFn, filterType='gaussian', sd=1.5,
+              slabSize=SLAB_SIZE, memory=None, method='auto', workers=None,
+              mrcMode=FLOAT32):
+    """ Write a filtered copy of a map (zero padded as in ChimeraX).
+
+    Large gaussians are applied with FFTs on the whole map (see
+    chimera.filters) when it fits in the memory budget. Otherwise slabs
+    are filtered in real space with halo sections, which gives the same
+    result as filtering the whole map.
+
+    :param filterType: 'gaussian' (ChimeraX volume gaussian) or
+                       'laplacian' (ChimeraX volume laplacian)
+    :param sd: standard deviation of the gaussian in Angstroms
+    :param memory: budget in bytes, overrides slabSize
+    :param method: 'fft', 'real' or 'auto'
+    :param workers: number of FFT threads, all cores if None
+    """
+    from . import filters
+
+    with openMap(inFn) as inMap:
+        if filterType == 'gaussian':
+            sigma = sd / inMap.voxelSize[::-1]  # z, y, x
+            halo = filters.gaussianRadius(sigma[0])
+        elif filterType == 'laplacian':
+            sigma = None
+            halo = 1
+        else:
+            raise ValueError("Unknown filter %s" % filterType)
+        if method == 'auto':
+            fits = (memory is None or
+                    np.prod(inMap.shape) * FFT_VOXEL_BYTES <= memory)
+            useFFT = fits and filters.useFFT(filterType, sigma)
+        else:
+            useFFT = method == 'fft'
+        stats = RunningStats()
+        with createMap(outFn, inMap.shape, inMap.voxelSize,
+                       inMap.origin, mrcMode) as out:
+            if useFFT:
+                filtered = filters.fftFilter(inMap.data, filterType, sigma,
+                                             workers)
+                out.data[:] = filtered
+                stats.update(filtered)
+            else:
+                slabSize = _slabSize(inMap.shape, slabSize, memory, halo)
+                for z0, z1 in iterSlabs(inMap.shape[0], slabSize):
+                    block = filters.realFilter(inMap.haloSlab(z0, z1, halo),
+                                               filterType, sigma)
+                    filtered = block[halo:halo + z1 - z0]
+                    out.data[z0:z1] = filtered
+                    stats.update(filtered)
+            stats.setHeader(out)
+
+
+def _localMoments(block, filterType, size):
+    """ Local mean and standard deviation of the sections of a (halo)
+    slab, normalized by the filtered weight of the voxels inside the map
+    so that the borders are not biased by the zero padding """
+    from scipy import ndimage
+
+    if filterType == 'box':
+        def smooth(array):
+            return ndimage.uniform_filter(array, size, mode='constant')
+    elif filterType == 'gaussian':
+        def smooth(array):
+            return ndimage.gaussian_filter(array, size, mode='constant')
+    else:
+        raise ValueError("Unknown filter %s" % filterType)
+    data, inside = block
+    weight = smooth(inside)
+    mean = smooth(data) / weight
+    square = smooth(data * data) / weight
+    variance = square - mean * mean
+    # flat regions (e.g. outside a zone) have no noise estimate
+    sd = np.sqrt(np.where(variance > 1e-10 * square, variance, 0.))
+    return mean, sd
+
+
+def localZscoreMap(inFn, outFn, window=20., filterType='box', sdFn=None,
+                   slabSize=SLAB_SIZE, memory=None, threads=None,
+                   mrcMode=FLOAT32):
+    """ Write the local z-score (value - local mean) / local standard
+    deviation of a map, so that the same level means the same
+    significance in maps with different noise.
+
+    Slabs with halo sections are processed in parallel threads (the
+    scipy.ndimage filters release the GIL). The result does not depend on
+    the slab size. Voxels without noise estimate are set to 0.
+
+    :param window: box size or 2 x standard deviation of the gaussian, in
+                   Angstroms
+    :param filterType: 'box' or 'gaussian'
+    :param sdFn: optional map of the local standard deviation
+    :param memory: budget in bytes, shared by the threads
+    """
+    from . import filters
+
+    threads = threads or os.cpu_count() or 1
+    with openMap(inFn) as inMap:
+        voxels = window / inMap.voxelSize[::-1]  # z, y, x
+        if filterType == 'box':
+            size = tuple(2 * int(round(v / 2)) + 1 for v in voxels)
+            halo = size[0] // 2
+        else:
+            size = voxels / 2
+            halo = filters.gaussianRadius(size[0])
+        slabSize = _slabSize(inMap.shape, slabSize,
+                             memory and memory / threads, halo)
+
+        def slab(z0z1):
+            z0, z1 = z0z1
+            data = inMap.haloSlab(z0, z1, halo).astype(np.float64)
+            z = np.arange(z0 - halo, z1 + halo)
+            inside = np.broadcast_to(
+                ((z >= 0) & (z < inMap.shape[0]))[:, None, None],
+                data.shape).astype(np.float64)
+            mean, sd = _localMoments((data, inside), filterType, size)
+            section = slice(halo, halo + z1 - z0)
+            data, mean, sd = data[section], mean[section], sd[section]
+            zscore = np.divide(data - mean, sd, out=np.zeros_like(data),
+                               where=sd > 0)
+            return z0, z1, zscore.astype(np.float32), sd.astype(np.float32)
+
+        stats, sdStats = RunningStats(), RunningStats()
+        sdMap = (createMap(sdFn, inMap.shape, inMap.voxelSize, inMap.origin,
+                           mrcMode) if sdFn else nullcontext())
+        with createMap(outFn, inMap.shape, inMap.voxelSize, inMap.origin,
+                       mrcMode) as out, sdMap as sdOut, \
+                ThreadPoolExecutor(max_workers=threads) as executor:
+            for z0, z1, zscore, sd in boundedMap(
+                    executor, slab, iterSlabs(inMap.shape[0], slabSize),
+                    threads):
+                out.data[z0:z1] = zscore
+                stats.update(zscore)
+                if sdOut is not None:
+                    sdOut.data[z0:z1] = sd
+                    sdStats.update(sd)
+            stats.setHeader(out)
+            if sdOut is not None:
+                sdStats.setHeader(sdOut)
+
+
+def mapFsc(fn1, fn2, workers=None):
+    """ Fourier shell correlation of two maps on the same grid. Return the
+    frequencies (1/A) and the correlations (see filters.shellCorrelation).
+    Both maps are read in memory. """
+    from . import filters
+
+    with openMap(fn1) as map1, openMap(fn2) as map2:
+        if not map1.sameGrid(map2):
+            raise ValueError("%s and %s are not on the same grid"
+                             % (fn1, fn2))
+        frequencies, fsc = filters.shellCorrelation(map1.data, map2.data,
+                                                    workers)
+        return frequencies / map1.voxelSize[0], fsc
+
+
+def fscResolution(frequencies, fsc, threshold=0.143):
+    """ Resolution (A) where the FSC first falls below threshold,
+    interpolated between shells. None if it never does. """
+    below = np.flatnonzero(fsc[1:] < threshold) + 1
+    if not len(below):
+        return None
+    i = below[0]
+    f0, f1 = frequencies[i - 1], frequencies[i]
+    t = (fsc[i - 1] - threshold) / (fsc[i - 1] - fsc[i])
+    frequency = f0 + t * (f1 - f0)
+    return 1. / frequency if frequency > 0 else None
+
+
+def writeFsc(fileName, frequencies, fsc):
+    """ Write an FSC curve as comma separated values """
+    with open(fileName, 'w') as f:
+        f.write('frequency,resolution,fsc\n')
+        for frequency, value in zip(frequencies, fsc):
+            resolution = 1. / frequency if frequency > 0 else float('inf')
+            f.write('%.6f,%.3f,%.6f\n' % (frequency, resolution, value))
+
+
+def readFsc(fileName):
+    """ Frequencies and FSC of a file written by writeFsc """
+    data = np.loadtxt(fileName, delimiter=',', skiprows=1, ndmin=2)
+    return data[:, 0], data[:, 2]
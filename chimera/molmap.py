@@ -0,0 +1,247 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Native simulated maps from atomic structures (ChimeraX molmap).
+
+Each atom is described as a 3D Gaussian of standard deviation
+SIGMA_FACTOR * resolution and amplitude equal to its atomic number,
+normalized as in ChimeraX so that each Gaussian integrates to the atomic
+number. Gaussians are separable, so the contribution of a chunk of atoms
+to its local windows is an outer product of three 1D profiles that is
+accumulated with a single unbuffered add. The grid is split in z slabs
+that are computed in a thread pool and written directly on the target
+grid. Atoms may be split in groups (for instance chains) that are
+accumulated in the same pass, one map per group. The number of atoms
+splatted at a time is limited by the size of their windows so that the
+temporaries of all the threads fit in a memory budget.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from . import maps
+from .atoms import readAtoms, coordinates, atomicNumbers
+
+# version of the simulated maps, part of their cache keys: increase it
+# when the maps computed for the same atoms change
+VERSION = 1
+SIGMA_FACTOR = 1 / (np.pi * np.sqrt(2))  # ChimeraX molmap default
+CUTOFF_RANGE = 5  # in standard deviations, ChimeraX molmap default
+ATOM_CHUNK = 8192  # maximum number of atoms splatted at a time
+# bytes per voxel of the window of an atom: float32 values, int32 indices,
+# the temporaries of their products and the float64 and intp copies made
+# by np.bincount
+WINDOW_VOXEL_BYTES = 32
+MEMORY = 512 * 1024 ** 2  # default budget of the atom chunks in bytes
+
+
+def atomChunk(radius, memory=None, threads=1):
+    """ Number of atoms whose windows of half widths radius (in voxels)
+    fit in memory bytes shared by threads, between 1 and ATOM_CHUNK """
+    windowVoxels = int(np.prod([2 * r + 2 for r in radius]))
+    perThread = (memory or MEMORY) / max(1, threads)
+    return int(max(1, min(ATOM_CHUNK,
+                          perThread // (windowVoxels * WINDOW_VOXEL_BYTES))))
+
+
+def _splatSlab(ijk, weights, sigma, voxelSize, radius, z0, z1, ny, nx,
+               groups=None, nGroups=1, chunkSize=ATOM_CHUNK):
+    """ Sum of the Gaussians of the atoms on sections z0 to z1.
+
+    :param ijk: (n, 3) fractional grid indices (x, y, z) of the atoms,
+                sorted by z
+    :param sigma: standard deviation in Angstroms
+    :param radius: (x, y, z) window half widths in voxels
+    :param groups: (n,) group index of each atom, sorted as ijk
+    :param chunkSize: number of atoms splatted at a time (see atomChunk)
+    :return: (nGroups, z1 - z0, ny, nx) array
+    """
+    slabShape = (nGroups, z1 - z0, ny, nx)
+    slabVoxels = (z1 - z0) * ny * nx
+    slab = np.zeros(nGroups * slabVoxels, dtype=np.float32)
+    # atoms whose window intersects this slab
+    first = np.searchsorted(ijk[:, 2], z0 - radius[2] - 1, side='left')
+    last = np.searchsorted(ijk[:, 2], z1 + radius[2], side='right')
+    offsets = [np.arange(-r, r + 2) for r in radius]  # x, y, z
+    factors = -0.5 * (voxelSize / sigma) ** 2
+    limits = (nx, ny, z1)
+    for start in range(first, last, chunkSize):
+        end = min(start + chunkSize, last)
+        chunk = ijk[start:end]
+        profiles = []
+        indices = []
+        for axis in range(3):
+            index = np.floor(chunk[:, axis]).astype(np.int64)[:, None] + \
+                    offsets[axis][None, :]
+            profile = np.exp(factors[axis] *
+                             (index - chunk[:, axis:axis + 1]) ** 2)
+            low = z0 if axis == 2 else 0
+            outside = (index < low) | (index >= limits[axis])
+            profile[outside] = 0.
+            profiles.append(profile.astype(np.float32))
+            indices.append((np.clip(index, low, limits[axis] - 1) -
+                            low).astype(np.int32))
+        px, py, pz = profiles
+        ix, iy, iz = indices
+        values = (weights[start:end, None, None, None] * pz[:, :, None, None] *
+                  py[:, None, :, None] * px[:, None, None, :])
+        rows = (iz[:, :, None] * ny + iy[:, None, :]) * nx
+        flat = rows[:, :, :, None] + ix[:, None, None, :]
+        if groups is not None:
+            flat += (groups[start:end] * slabVoxels)[:, None, None, None]
+        # summed with np.bincount rather than np.add.at, which holds the
+        # GIL while the threads of the other slabs wait
+        slab += np.bincount(flat.ravel(), values.ravel(),
+                            minlength=slab.size)
+    return slab.reshape(slabShape)
+
+
+def molmapOnGrid(xyz, weights, resolution, shape, voxelSize, origin,
+                 out=None, sigmaFactor=SIGMA_FACTOR, cutoffRange=CUTOFF_RANGE,
+                 slabSize=maps.SLAB_SIZE, threads=None, memory=None):
+    """ Simulated map of atoms on a given grid.
+
+    :param xyz: (n, 3) atom coordinates in Angstroms
+    :param weights: (n,) amplitudes, usually atomic numbers
+    :param shape: (nz, ny, nx) of the grid
+    :param voxelSize, origin: (x, y, z) in Angstroms
+    :param out: array (it may be a memory map) where the map is written,
+                a new float32 array if None
+    :param memory: budget in bytes of the atom chunks, MEMORY if None
+    :return: out
+    """
+    if out is None:
+        out = np.zeros(shape, dtype=np.float32)
+    molmapGroupsOnGrid(xyz, weights, None, resolution, shape, voxelSize,
+                       origin, outs=[out], sigmaFactor=sigmaFactor,
+                       cutoffRange=cutoffRange, slabSize=slabSize,
+                       threads=threads, memory=memory)
+    return out
+
+
+def molmapGroupsOnGrid(xyz, weights, groups, resolution, shape, voxelSize,
+                       origin, outs=None, complement=False,
+                       sigmaFactor=SIGMA_FACTOR, cutoffRange=CUTOFF_RANGE,
+                       slabSize=maps.SLAB_SIZE, threads=None, memory=None):
+    """ Simulated maps of groups of atoms computed in a single pass.
+
+    :param groups: (n,) group index (0 to number of groups - 1) of each
+                   atom, a single group if None
+    :param outs: one array per group where the maps are written, new
+                 float32 arrays if None
+    :param complement: write the map of all the atoms except those of each
+                       group instead of the map of the group
+    :param memory: budget in bytes of the atom chunks, MEMORY if None
+    :return: outs
+    """
+    voxelSize = np.broadcast_to(np.asarray(voxelSize, dtype=np.float64),
+                                (3,))
+    origin = np.asarray(origin, dtype=np.float64)
+    sigma = sigmaFactor * resolution
+    nz, ny, nx = shape
+    ijk = (np.asarray(xyz, dtype=np.float64) - origin) / voxelSize
+    order = np.argsort(ijk[:, 2], kind='stable')
+    ijk = ijk[order]
+    weights = np.asarray(weights, dtype=np.float32)[order]
+    if groups is None:
+        nGroups = 1
+    else:
+        groups = np.asarray(groups, dtype=np.int64)[order]
+        nGroups = int(groups.max()) + 1 if len(groups) else 1
+    if outs is None:
+        outs = [np.zeros(shape, dtype=np.float32) for _ in range(nGroups)]
+    radius = np.ceil(cutoffRange * sigma / voxelSize).astype(int)
+    normalization = (2 * np.pi) ** -1.5 * sigma ** -3
+    threads = threads or os.cpu_count() or 1
+    chunkSize = atomChunk(radius, memory, threads)
+
+    def compute(zRange):
+        z0, z1 = zRange
+        slab = _splatSlab(ijk, weights, sigma, voxelSize, radius,
+                          z0, z1, ny, nx, groups, nGroups, chunkSize)
+        if complement:
+            slab = slab.sum(axis=0) - slab
+        for out, groupSlab in zip(outs, slab):
+            out[z0:z1] = groupSlab * normalization
+
+    # the slabs of all the groups are in memory at the same time
+    slabSize = max(1, slabSize // nGroups)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(compute, maps.iterSlabs(nz, slabSize)))
+    return outs
+
+
+def molmap(atoms, resolution, outFn, gridMap, threads=None,
+           mrcMode=maps.FLOAT32, memory=None):
+    """ Write the simulated map of atoms on the grid of gridMap.
+    Equivalent to ChimeraX 'molmap #n resolution gridSpacing s' followed
+    by an interpolation on the grid of the minuend.
+
+    :param atoms: structured array from chimera.atoms.readAtoms or the
+                  file name of an atomic structure
+    :param gridMap: maps.MapFile that defines the output grid
+    """
+    if isinstance(atoms, str):
+        atoms = readAtoms(atoms)
+    with maps.createMap(outFn, gridMap.shape, gridMap.voxelSize,
+                        gridMap.origin, mrcMode) as out:
+        molmapOnGrid(coordinates(atoms), atomicNumbers(atoms), resolution,
+                     gridMap.shape, gridMap.voxelSize, gridMap.origin,
+                     out=out.data, threads=threads, memory=memory)
+        stats = maps.RunningStats()
+        for z0, z1 in maps.iterSlabs(gridMap.shape[0]):
+            stats.update(out.data[z0:z1])
+        stats.setHeader(out)
+
+
+def molmapGroups(atoms, groups, resolution, outFns, gridMap,
+                 complement=False, threads=None, mrcMode=maps.FLOAT32,
+                 memory=None):
+    """ Write one simulated map per group of atoms (see molmapGroupsOnGrid)
+    on the grid of gridMap.
+
+    :param groups: (n,) group index of each atom
+    :param outFns: output file name of each group
+    """
+    if isinstance(atoms, str):
+        atoms = readAtoms(atoms)
+    outs = [maps.createMap(outFn, gridMap.shape, gridMap.voxelSize,
+                           gridMap.origin, mrcMode) for outFn in outFns]
+    try:
+        molmapGroupsOnGrid(coordinates(atoms), atomicNumbers(atoms), groups,
+                           resolution, gridMap.shape, gridMap.voxelSize,
+                           gridMap.origin, outs=[out.data for out in outs],
+                           complement=complement, threads=threads,
+                           memory=memory)
+        for out in outs:
+            stats = maps.RunningStats()
+            for z0, z1 in maps.iterSlabs(gridMap.shape[0]):
+                stats.update(out.data[z0:z1])
+            stats.setHeader(out)
+    finally:
+        for out in outs:
+            out.close()
@@ -30,4 +30,9 @@ from .protocol_base import ChimeraProtBase
 from .protocol_modeller_search import ChimeraModelFromTemplate
 from .protocol_contacts import ChimeraProtContacts
 from .protocol_subtraction_maps import ChimeraSubtractionMaps
+from .protocol_subtraction_maps_batch import ChimeraSubtractionMapsBatch
+from .protocol_subtraction_maps_chains import ChimeraSubtractionMapsChains
+from .protocol_subtraction_maps_scan import ChimeraSubtractionMapsScan
+from .protocol_difference_blobs import ChimeraDifferenceBlobs
+from .protocol_subtraction_maps_sweep import ChimeraSubtractionMapsSweep
 from .protocol_alphafold import ChimeraImportAtomStructAlphafold
@@ -53,6 +53,7 @@ from chimera.utils import getEnvDictionary
 from pwem.convert import AtomicStructHandler
 from chimera.colabs.browser import createColabScript
 from chimera.objects import PAE
+from chimera.commands import Script, Open, spec
 
 class ChimeraImportAtomStructAlphafold(EMProtocol):
     """ Protocol to import atomic structures generated by alphafold.\n
@@ -464,12 +465,12 @@ cd {ALPHAFOLD_HOME}
                                          sampling=sampling)
         
         f = open(self._getTmpPath(chimeraPythonFileName), "w")
-        f.write('from chimerax.core.commands import run\n')
-
-        f.write("run(session, 'open %s')\n" % tmpFileName)
-        f.write("run(session, 'cofr 0,0,0')\n")  # set center of coordinates
+        script = Script([Open(tmpFileName)])
+        script.add('cofr', (0, 0, 0))  # set center of coordinates
         matrix = self.matrixDict[similarityMatrix]
-        f.write(f"run(session, 'alphafold search {sequence_data} matrix {matrix} cutoff {cutoff}')\n")
+        script.add('alphafold search', sequence_data, matrix=matrix,
+                   cutoff=cutoff)
+        f.write(script.python())
         # Show help window
         if not hideMessage:
             msg = """Select desired homologous sequence and save the
@@ -495,7 +496,8 @@ session.logger.error('''{msg}''')
         # run in the background
         cwd = os.path.abspath(self._getExtraPath())
         Plugin.runChimeraProgram(Plugin.getProgram(), args, 
-                                 cwd=cwd, extraEnv=getEnvDictionary(self))
+                                 cwd=cwd, extraEnv=getEnvDictionary(self),
+                                 protocol=self, step='_getModelFromBlast')
         outFileNames = []
         searchPattern = self._getExtraPath("*.cif")
         for outFileName in glob.glob(searchPattern):
@@ -637,7 +639,8 @@ session.logger.error('''{msg}''')
             args = colabScriptFileName
             cwd = os.path.abspath(self._getExtraPath())
             Plugin.runChimeraProgram(program=Plugin.getPython(), args=args, 
-                                    cwd=cwd, extraEnv=getEnvDictionary(self))
+                                    cwd=cwd, extraEnv=getEnvDictionary(self),
+                                    protocol=self, step='_getModelFromColab')
         # uncompress Data
         self.uncompress(resultsFile)
 
@@ -653,24 +656,25 @@ session.logger.error('''{msg}''')
         if showChimera:
             # go to results directory and load all files called model_*_unrelaxed.pdb
             fnCmd = self._getExtraPath(os.path.join('results','results.cxc'))
-            f = open(fnCmd, 'w')
+            script = Script()
             if colabID == self.CHIMERA21:
                 modelsFns = _findDownloadDirAndGetModels(os.path.abspath(self._getExtraPath('results')), 
                                                          filePattern='*_relaxed*model_*.pdb')
                 for modelFn in modelsFns:
-                    f.write(f"open {modelFn}\n")
+                    script.add(Open(modelFn))
                 modelsFns = sorted(_findDownloadDirAndGetModels(os.path.abspath(self._getExtraPath('results')), 
                                                      filePattern='*_unrelaxed*model_*.pdb'))
                 for modelFn in modelsFns:
-                    f.write(f"open {modelFn}\n")
-                f.write("matchmaker #2-%d to #1\n" % (len(modelsFns)+1))
+                    script.add(Open(modelFn))
+                script.add('matchmaker', '#2-%d' % (len(modelsFns) + 1),
+                           to=spec(1))
                 paeFns = [os.path.abspath(self._getExtraPath(os.path.join('results', 'best_model_pae.json')))]
             elif colabID == self.PHENIX:
                 objId = self.getObjId()
                 modelsFns = _findDownloadDirAndGetModels(os.path.abspath(self._getExtraPath('results')), 
                                                          filePattern='%d*.pdb' % objId)
                 for modelFn in modelsFns:
-                    f.write(f"open {modelFn}\n")
+                    script.add(Open(modelFn))
                 paeFns = _findDownloadDirAndGetModels(os.path.abspath(self._getExtraPath('results')), 
                                                          filePattern='%d*.jsn' % objId)
 
@@ -679,30 +683,32 @@ session.logger.error('''{msg}''')
                 modelsFns = _findDownloadDirAndGetModels(os.path.abspath(self._getExtraPath('results')), 
                                                          filePattern='model_*_relaxed.pdb')
                 for modelFn in modelsFns:
-                    f.write(f"open {modelFn}\n")
+                    script.add(Open(modelFn))
                 modelsFns = sorted(_findDownloadDirAndGetModels(os.path.abspath(self._getExtraPath('results')),
                                                      filePattern='model_*_unrelaxed.pdb'))
                 for modelFn in modelsFns:
-                    f.write(f"open {modelFn}\n")
-                f.write("matchmaker #2-%d to #1\n" % (len(modelsFns)+1))
+                    script.add(Open(modelFn))
+                script.add('matchmaker', '#2-%d' % (len(modelsFns) + 1),
+                           to=spec(1))
                 paeFns = [os.path.abspath(self._getExtraPath(os.path.join('results', 'best_model_pae.json')))]
                 # phenix
                 #objId = 913
                 #modelsFns = _findDownloadDirAndGetModels(os.path.abspath(self._getExtraPath('results')),
                 #                                         filePattern='%d*.pdb' % objId)
                 #for modelFn in modelsFns:
-                #    f.write(f"open {modelFn}\n")
+                #    script.add(Open(modelFn))
                 # paeFns = _findDownloadDirAndGetModels(os.path.abspath(self._getExtraPath('results')), 
                 #                                         filePattern='%d*.jsn' % objId)
 
-            f.write("color bfactor palette alphafold\n")
-            f.write("key red:low orange: yellow: cornflowerblue: blue:high\n")
-            f.close()
+            script.add('color', 'bfactor', palette='alphafold')
+            script.add('key', 'red:low orange: yellow: cornflowerblue: blue:high')
+            script.write(fnCmd)
             # add files saved with scipionwrite to outputs
             args = fnCmd
             Plugin.runChimeraProgram(Plugin.getProgram(), 
                                      extraEnv=getEnvDictionary(self), 
-                                     args=args)
+                                     args=args, protocol=self,
+                                     step='_getModelFromColab')
             modelsFns = _findDownloadDirAndGetModels(os.path.abspath(self._getExtraPath()), 
                                                      filePattern='*Atom_struct__*_*.cif')
             outFileNames += modelsFns
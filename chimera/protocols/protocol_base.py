@@ -38,7 +38,6 @@ except ImportError:
 from pwem.objects import Volume
 from pwem.emlib.image import ImageHandler
 from pwem.objects import Transform
-from pwem.convert.headers import Ccp4Header
 from pwem.protocols import EMProtocol
 
 from pwem.viewers.viewer_chimera import (Chimera,
@@ -52,7 +51,9 @@ from pyworkflow.protocol.params import (MultiPointerParam,
                                         StringParam)
 from pyworkflow.utils.properties import Message
 
-from .. import Plugin
+from .. import Plugin, maps, manifest
+from .. import commands
+from ..commands import Script, Open, spec
 import configparser
 import shutil
 
@@ -117,7 +118,7 @@ class ChimeraProtBase(EMProtocol):
     def runChimeraStep(self):
         # building script file including the coordinate axes and the input
         # volume with samplingRate and Origin information
-        f = open(self._getTmpPath(chimeraScriptFileName), "w")
+        script = Script()
         _inputVol = None
         if (hasattr(self, 'inputVolume') and
                 (self.inputVolume.get() is None) and
@@ -139,106 +140,92 @@ class ChimeraProtBase(EMProtocol):
         Chimera.createCoordinateAxisFile(dim,
                                          bildFileName=tmpFileName,
                                          sampling=sampling)
-        f.write("open %s\n" % tmpFileName)
-        f.write("cofr 0,0,0\n")  # set center of coordinates
+        script.add(Open(tmpFileName))
+        script.add('cofr', (0, 0, 0))  # set center of coordinates
 
         # input vol with its origin coordinates
         pdbModelCounter = 1
         if _inputVol is not None:
             pdbModelCounter += 1
-            x_input, y_input, z_input = _inputVol.getShiftsFromOrigin()
             inputVolFileName = os.path.abspath(ImageHandler.removeFileType(
                 _inputVol.getFileName()))
-            f.write("open %s\n" % inputVolFileName)
-            f.write("volume #%d style surface voxelSize %f\n"
-                    % (pdbModelCounter, _inputVol.getSamplingRate()))
-            f.write("volume #%d origin %0.2f,%0.2f,%0.2f\n"
-                    % (pdbModelCounter, x_input, y_input, z_input))
+            script.add(Open(inputVolFileName))
+            script.add(commands.Volume(pdbModelCounter, style='surface',
+                                       voxelSize=_inputVol.getSamplingRate()))
+            script.add(commands.Volume(pdbModelCounter,
+                                       origin=_inputVol.getShiftsFromOrigin()))
 
         if hasattr(self, 'inputVolumes') and \
                 self.inputVolumes is not None:
             for vol in self.inputVolumes:
                 pdbModelCounter += 1
-                f.write("open %s\n" % os.path.abspath(vol.get().getFileName()))
-                x, y, z = vol.get().getShiftsFromOrigin()
-                f.write("volume #%d style surface voxelSize %f\n"
-                        % (pdbModelCounter, vol.get().getSamplingRate()))
-                f.write("volume #%d origin %0.2f,%0.2f,%0.2f\n"
-                        % (pdbModelCounter, x, y, z))
+                script.add(Open(os.path.abspath(vol.get().getFileName())))
+                script.add(commands.Volume(pdbModelCounter, style='surface',
+                                           voxelSize=vol.get().getSamplingRate()))
+                script.add(commands.Volume(pdbModelCounter,
+                                           origin=vol.get().getShiftsFromOrigin()))
 
         if self.pdbFileToBeRefined.get() is not None:
             pdbModelCounter += 1
             pdbFileToBeRefined = self.pdbFileToBeRefined.get()
-            f.write("open %s\n" % os.path.abspath(
-                pdbFileToBeRefined.getFileName()))
+            script.add(Open(os.path.abspath(
+                pdbFileToBeRefined.getFileName())))
             if pdbFileToBeRefined.hasOrigin():
-                x, y, z = (pdbFileToBeRefined.getOrigin().getShifts())
-                f.write("move %0.2f,%0.2f,%0.2f model #%d "
-                        "coord #0\n" % (x, y, z, pdbModelCounter))
+                script.add('move', pdbFileToBeRefined.getOrigin().getShifts(),
+                           model=spec(pdbModelCounter), coord='#0')
 
         # other pdb files
         if hasattr(self, 'inputPdbFiles'):
             for pdb in self.inputPdbFiles:
                 pdbModelCounter += 1
-                f.write("open %s\n" % os.path.abspath(pdb.get(
-                ).getFileName()))
+                script.add(Open(os.path.abspath(pdb.get().getFileName())))
                 if pdb.get().hasOrigin():
-                    x, y, z = pdb.get().getOrigin().getShifts()
-                    f.write("move %0.2f,%0.2f,%0.2f model #%d "
-                            "coord #0\n" % (x, y, z, pdbModelCounter))
+                    script.add('move', pdb.get().getOrigin().getShifts(),
+                               model=spec(pdbModelCounter), coord='#0')
 
         # run the text:
         _chimeraScriptFileName = os.path.abspath(
             self._getTmpPath(chimeraScriptFileName))
         if len(self.extraCommands.get()) > 2:
-            f.write(self.extraCommands.get())
             args = " --nogui " + _chimeraScriptFileName
         else:
             args = " " + _chimeraScriptFileName
 
-        f.close()
+        with open(_chimeraScriptFileName, "w") as f:
+            f.write(script.cxc())
+            if len(self.extraCommands.get()) > 2:
+                f.write(self.extraCommands.get())
 
         self._log.info('Launching: ' + Plugin.getProgram() + ' ' + args)
 
         # run in the background
         cwd = os.path.abspath(self._getExtraPath())
-        Plugin.runChimeraProgram(Plugin.getProgram(), args, cwd=cwd, extraEnv=getEnvDictionary(self))
+        Plugin.runChimeraProgram(Plugin.getProgram(), args, cwd=cwd,
+                                 extraEnv=getEnvDictionary(self), protocol=self,
+                                 step='runChimeraStep')
 
     def createOutput(self):
-        """ Copy the PDB structure and register the output object.
+        """ Register the maps and atomic structures saved by scipionwrite
+        (see chimera.manifest).
         """
-        # Check vol and pdb files
         directory = self._getExtraPath()
-        for filename in sorted(os.listdir(directory)):
-            if not filename.startswith("tmp"):
-                # files starting with "tmp" will not be converted in scipion objects
-                if filename.endswith(".mrc"):
-                    volFileName = os.path.join(directory, filename)
-                    vol = Volume()
-                    vol.setFileName(volFileName)
-
-                    # fix mrc header
-                    ccp4header = Ccp4Header(volFileName, readHeader=True)
-                    sampling = ccp4header.computeSampling()
-                    origin = Transform()
-                    shifts = ccp4header.getOrigin()
-                    origin.setShiftsTuple(shifts)
-                    vol.setOrigin(origin)
-                    vol.setSamplingRate(sampling)
-                    keyword = filename.split(".mrc")[0]
-                    kwargs = {keyword: vol}
-                    self._defineOutputs(**kwargs)
-
-                if filename.endswith(".pdb") or filename.endswith(".cif"):
-                    path = os.path.join(directory, filename)
-                    pdb = AtomStruct()
-                    pdb.setFileName(path)
-                    if filename.endswith(".cif"):
-                        keyword = filename.split(".cif")[0].replace(".","_")
-                    else:
-                        keyword = filename.split(".pdb")[0].replace(".", "_")
-                    kwargs = {keyword: pdb}
-                    self._defineOutputs(**kwargs)
+        for entry in manifest.outputEntries(directory):
+            # files starting with "tmp" will not be converted in scipion objects
+            if os.path.basename(entry['path']).startswith("tmp"):
+                continue
+            fileName = os.path.join(directory, entry['path'])
+            if entry['type'] == manifest.MAP:
+                maps.mapStats(fileName)  # sidecar used by viewers
+                output = Volume()
+                output.setFileName(fileName)
+                origin = Transform()
+                origin.setShiftsTuple(entry['origin'])
+                output.setOrigin(origin)
+                output.setSamplingRate(entry['sampling'])
+            else:
+                output = AtomStruct()
+                output.setFileName(fileName)
+            self._defineOutputs(**{manifest.outputName(entry): output})
 
     # --------------------------- INFO functions ----------------------------
     def _validate(self):
@@ -265,15 +252,11 @@ class ChimeraProtBase(EMProtocol):
         # Think on how to update this summary with created PDB
         summary = []
         if self.getOutputsSize() > 0:
-            directory = self._getExtraPath()
-            counter = 1
+            entries = manifest.outputEntries(self._getExtraPath())
             summary.append("Produced files:")
-            for filename in sorted(os.listdir(directory)):
-                if filename.endswith(".pdb"):
-                    summary.append(filename)
-            for filename in sorted(os.listdir(directory)):
-                if filename.endswith(".mrc"):
-                    summary.append(filename)
+            for outputType in (manifest.ATOM_STRUCT, manifest.MAP):
+                summary.extend(entry['path'] for entry in entries
+                               if entry['type'] == outputType)
             summary.append("we have some result")
         else:
             summary.append(Message.TEXT_NO_OUTPUT_FILES)
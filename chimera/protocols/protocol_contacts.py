@@ -41,8 +41,9 @@ import sqlite3
 import json
 import collections
 import os
-from pwem.viewers.viewer_chimera import Chimera
 from .. import Plugin
+from ..commands import (Script, Open, Sym, Save, Close, Contacts, spec,
+                        symGroup)
 from operator import itemgetter
 
 from pyworkflow.utils import red
@@ -161,34 +162,23 @@ class ChimeraProtContacts(EMProtocol):
         # first element of dictionary
         firstValue = labelDict[list(labelDict)[0]]
         outFiles = []
-        f = open(self.getChimeraScriptFileName1(), "w")
-        f.write("from chimerax.core.commands import run\n")
-        f.write("run(session, 'open {}')\n".format(pdbFileName))
-        if self.sym == "Cn" and self.symOrder != 1:
-            f.write("run(session,'sym #1 C%d copies t')\n" % self.symOrder)
-        elif self.sym == "Dn" and self.symOrder != 1:
-            f.write("run(session,'sym #1 d%d copies t')\n" % self.symOrder)
-        elif self.sym == "T222" or self.sym == "TZ3":
-            f.write("run(session,'sym #1 t,%s copies t')\n" % self.sym[1:])
-        elif self.sym == "O":
-            f.write("run(session,'sym #1 O copies t')\n")
-        elif self.sym == "I222" or self.sym == "I222r" or self.sym == "In25" or \
-                self.sym == "In25r" or self.sym == "I2n3" or self.sym == "I2n3r" or \
-                self.sym == "I2n5" or self.sym == "I2n5r":
-            f.write("run(session,'sym #1 i,%s copies t')\n" % self.sym[1:])
+        script = Script([Open(pdbFileName)])
+        symGroup = self.getChimeraSymGroup()
+        if symGroup is not None:
+            script.add(Sym(1, symGroup, copies=True))
         self.SYMMETRY = self.SYMMETRY.get()
         if self.SYMMETRY:
-            f.write("run(session,'delete #2 & #1 #>3')\n")
-            f.write("run(session,'save {symmetrizedModelName} #2')\n".format(
-                symmetrizedModelName=self.getSymmetrizedModelName()))
-            f.write("run(session, 'close #1')\n")
-            f.write("run(session, 'rename #2 id #1')\n")
-        self.endChimeraScript(firstValue, labelDict, outFiles, f)
-        f.write("run(session, 'exit')\n")
-        f.close()
+            script.add('delete', '#2 & #1 #>3')
+            script.add(Save(self.getSymmetrizedModelName(), models=2))
+            script.add(Close(1))
+            script.add('rename', spec(2), id=spec(1))
+        self.endChimeraScript(firstValue, labelDict, outFiles, script)
+        script.add('exit')
+        script.write(self.getChimeraScriptFileName1())
         args = " --nogui --script " + self.getChimeraScriptFileName1()
         self._log.info('Launching: ' + Plugin.getProgram() + ' ' + args)
-        Chimera.runProgram(Plugin.getProgram(), args)
+        Plugin.runChimeraProgram(Plugin.getProgram(), args, protocol=self,
+                                 step='chimeraClashesStep')
 
         if self.SYMMETRY and not os.path.exists(self.getSymmetrizedModelName()):
             # When self.SYMMETRY = TRUE and no one neighbor unit cell has not been
@@ -199,15 +189,14 @@ class ChimeraProtContacts(EMProtocol):
                       "Is the symmetry center equal to the origin of "
                       "coordinates?"))
             self.SYMMETRY = False
-            f = open(self.getChimeraScriptFileName2(), "w")
-            f.write("from chimerax.core.commands import run\n")
-            f.write("session, run('open {}')\n".format(pdbFileName))
-            self.endChimeraScript(firstValue, labelDict, outFiles, f)
-            f.write("run(session, 'exit')\n")
-            f.close()
+            script = Script([Open(pdbFileName)])
+            self.endChimeraScript(firstValue, labelDict, outFiles, script)
+            script.add('exit')
+            script.write(self.getChimeraScriptFileName2())
             args = " --nogui --script " + self.getChimeraScriptFileName2()
             self._log.info('Launching: ' + Plugin.getProgram() + ' ' + args)
-            Chimera.runProgram(Plugin.getProgram(), args)
+            Plugin.runChimeraProgram(Plugin.getProgram(), args, protocol=self,
+                                     step='chimeraClashesStep')
 
         # parse all files created by chimera
         c, conn = self.prepareDataBase()
@@ -356,7 +345,11 @@ class ChimeraProtContacts(EMProtocol):
     def getChimeraScriptFileName2(self):
         return os.path.abspath(self._getTmpPath("chimera2.py"))
 
-    def endChimeraScript(self, firstValue, labelDict, outFiles, f):
+    def getChimeraSymGroup(self):
+        """ Group of the ChimeraX sym command, None without symmetry """
+        return symGroup(self.sym, self.symOrder)
+
+    def endChimeraScript(self, firstValue, labelDict, outFiles, script):
         protId = firstValue
         chains = ""
         comma = ''
@@ -371,12 +364,7 @@ class ChimeraProtContacts(EMProtocol):
                 outFile = os.path.abspath(self._getExtraPath("{}.over".format(outFileBase)))
                 # outFile = self._getExtraPath("{}.over".format(outFileBase))
                 outFiles.append(outFile)
-                f.write("run(session,'echo {}')\nrun(session, 'contacts  #1{} "
-                         "intersubmodel true "
-                         "intramol False "
-                         "restrict any "
-                         "saveFile {} overlapCutoff {} hbondAllowance {} namingStyle simple')\n".
-                         format(chains, chains, outFile, self.cutoff, self.allowance))
+                self._addContacts(script, chains, outFile)
                 protId = v
                 # chains = "/{}".format(k)
                 chains = "{}".format(k)
@@ -386,15 +374,15 @@ class ChimeraProtContacts(EMProtocol):
         outFile = os.path.abspath(self._getExtraPath("{}.over".format(outFileBase)))
         # outFile = self._getExtraPath("{}.over".format(outFileBase))
         outFiles.append(outFile)
-
-        f.write(
-            "run(session,'echo {}')\nrun(session, 'contacts  #1{} "
-            "intersubmodel true "
-            "intramol False "
-            "restrict any "
-            "savefile {} overlap {} hbond {} namingStyle simple')\n".format(
-                chains, chains, outFile, self.cutoff, self.allowance))
-        # f.write("run('save %s')\n" % os.path.abspath(self._getExtraPath(sessionFile)))
+        self._addContacts(script, chains, outFile)
+
+    def _addContacts(self, script, chains, outFile):
+        script.add('echo', chains)
+        script.add(Contacts('#1' + chains, intersubmodel=True, intramol=False,
+                            restrict='any', saveFile=outFile,
+                            overlapCutoff=self.cutoff.get(),
+                            hbondAllowance=self.allowance.get(),
+                            namingStyle='simple'))
 
     def removeDuplicates(self, c):
         # Remove duplicate contacts
@@ -0,0 +1,135 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+
+from pwem.emlib.image import ImageHandler
+from pwem.objects import EMFile
+from pwem.protocols import EMProtocol
+from pyworkflow import VERSION_3_0
+from pyworkflow.protocol.constants import LEVEL_ADVANCED
+from pyworkflow.protocol.params import PointerParam, FloatParam
+
+from chimera import maps, atoms, blobs
+
+
+class ChimeraDifferenceBlobs(EMProtocol):
+    """Protocol to find the density blobs of a difference map, for
+        instance the filtered map of a map subtraction, that may
+        correspond to unmodeled ligands or subunits.
+        Voxels above the contour level are grouped in connected
+        components. The volume, integrated density, centroid and nearby
+        residues of each blob are written in a table ranked by integrated
+        density, and the centroids in a ChimeraX marker file."""
+    _label = 'difference map blobs'
+    _program = ""
+    _version = VERSION_3_0
+
+    @classmethod
+    def getClassPackageName(cls):
+        return "chimerax"
+
+    # --------------------------- DEFINE param functions --------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputVolume', PointerParam, pointerClass="Volume",
+                      label='Difference 3D map',
+                      important=True,
+                      help="Map where the blobs are searched, usually the "
+                           "filtered difference map of a map subtraction.")
+        form.addParam('level', FloatParam, allowsNull=True,
+                      label='Contour level',
+                      help="Voxels above this level belong to the blobs. "
+                           "If empty, the level enclosing 1% of the voxels "
+                           "(the initial level of ChimeraX) is used.")
+        form.addParam('minVolume', FloatParam, default=10.,
+                      label='Minimum blob volume (A^3)',
+                      help="Smaller blobs are discarded.")
+        form.addParam('pdbFileToBeRefined', PointerParam,
+                      pointerClass="AtomStruct", allowsNull=True,
+                      label='Atomic structure (optional)',
+                      help="If given, the closest atom and the residues "
+                           "near each blob are reported.")
+        form.addParam('contactDistance', FloatParam, default=4.,
+                      expertLevel=LEVEL_ADVANCED,
+                      condition='pdbFileToBeRefined',
+                      label='Contact distance (A)',
+                      help="Residues with an atom within this distance of a "
+                           "blob voxel are reported for that blob.")
+
+    # --------------------------- INSERT steps functions --------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('blobStep')
+        self._insertFunctionStep('createOutputStep')
+
+    # --------------------------- STEPS functions ---------------------------
+    def blobStep(self):
+        vol = self.inputVolume.get()
+        structure = None
+        if self.pdbFileToBeRefined.get() is not None:
+            structure = atoms.readAtoms(
+                self.pdbFileToBeRefined.get().getFileName())
+        with maps.openMap(ImageHandler.removeFileType(vol.getFileName()),
+                          vol.getSamplingRate(),
+                          vol.getShiftsFromOrigin()) as mapFile:
+            level = self.level.get()
+            if level is None:
+                level = maps.defaultLevel(mapFile)
+            self._log.info("Blobs above level %g" % level)
+            result = blobs.findBlobs(mapFile, level, structure,
+                                     self.minVolume.get(),
+                                     self.contactDistance.get())
+        blobs.writeBlobs(self._getTableFileName(), result)
+        blobs.writeMarkers(self._getMarkersFileName(), result)
+        self._log.info("%d blobs found" % len(result))
+
+    def createOutputStep(self):
+        self._defineOutputs(blobTable=EMFile(self._getTableFileName()),
+                            blobMarkers=EMFile(self._getMarkersFileName()))
+        self._defineSourceRelation(self.inputVolume, self.blobTable)
+        self._defineSourceRelation(self.inputVolume, self.blobMarkers)
+
+    # --------------------------- UTILS functions ---------------------------
+    def _getTableFileName(self):
+        return os.path.abspath(self._getExtraPath('blobs.csv'))
+
+    def _getMarkersFileName(self):
+        return os.path.abspath(self._getExtraPath('blobs.cmm'))
+
+    # --------------------------- INFO functions ----------------------------
+    def _summary(self):
+        summary = []
+        if self.hasAttribute('blobTable'):
+            with open(self._getTableFileName()) as f:
+                rows = f.read().splitlines()[1:]
+            summary.append("%d blobs, table %s and ChimeraX markers %s"
+                           % (len(rows), self._getTableFileName(),
+                              self._getMarkersFileName()))
+            for row in rows[:5]:
+                fields = row.split(',')
+                summary.append("  blob %s: %s A^3, integrated density %s"
+                               % (fields[0], fields[3], fields[4]))
+        return summary
@@ -670,7 +670,9 @@ class ChimeraModelFromTemplate(ChimeraProtBase):
 
         # run in the background
         cwd = os.path.abspath(self._getExtraPath())
-        Plugin.runChimeraProgram(Plugin.getProgram(), args, cwd=cwd, extraEnv=getEnvDictionary(self))
+        Plugin.runChimeraProgram(Plugin.getProgram(), args, cwd=cwd,
+                                 extraEnv=getEnvDictionary(self), protocol=self,
+                                 step='runChimeraStep')
 
     def _validate(self):
         # Check that CLUSTALO or MUSCLE program exists
@@ -104,7 +104,9 @@ class ChimeraProtRestore(ChimeraProtBase):
 
         # run in the background
         cwd = os.path.abspath(self._getExtraPath())
-        Plugin.runChimeraProgram(Plugin.getProgram(), os.path.abspath(parentSessionFileName), cwd=cwd, extraEnv=getEnvDictionary(self))
+        Plugin.runChimeraProgram(Plugin.getProgram(), os.path.abspath(parentSessionFileName), cwd=cwd,
+                                 extraEnv=getEnvDictionary(self), protocol=self,
+                                 step='runChimeraStep')
 
     def _validate(self):
         errors = super(ChimeraProtRestore, self)._validate()
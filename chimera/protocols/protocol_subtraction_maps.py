@@ -26,10 +26,13 @@
 # **************************************************************************
 
 import json
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+import numpy as np
 
 from pwem import *
-from pwem.convert import Ccp4Header
-from pwem.objects import Volume
+from pwem.objects import Volume, FSC
 from pwem.objects import Transform
 #try:
 from pwem.objects import AtomStruct
@@ -53,12 +56,57 @@ try: # TODO: TO REMOVE when pwem updated
     from pwem.viewers.viewer_chimera import chimeraPythonFileName
 except:
     chimeraPytonFileName = "chimeraPythonScript.py"
-from pwem.viewers.viewer_chimera import Chimera
+from pwem.viewers.viewer_chimera import (Chimera, chimeraMapTemplateFileName,
+                                         chimeraPdbTemplateFileName)
+from pwem.emlib.image import ImageHandler
 from pyworkflow.protocol.constants import LEVEL_ADVANCED
 from chimera import Plugin
 from pyworkflow.utils.properties import Message
 
 from chimera.utils import getEnvDictionary
+from chimera import maps, molmap, atoms, mapcache, symmetry, manifest
+from chimera import commands
+from chimera.commands import (Script, Open, Close, Save, Sym, Molmap, Rename,
+                              NewModel, ScipionWrite, spec, symGroup)
+
+
+def subtractHalfMap(task):
+    """ Binning, cropping, zone and subtraction (or masking) of a half map,
+    as done for the full map, run in a worker process. Return the minRms
+    scale (None when masking). """
+    fileName, origin = task['minuend'], task['origin']
+    sampling, memory = task['sampling'], task['memory']
+    if task['binning'] > 1:
+        binnedFileName = task['tmpPrefix'] + '_bin.mrc'
+        _, origin = maps.binMap(fileName, binnedFileName, task['binning'],
+                                sampling, origin, memory=memory)
+        fileName, sampling = binnedFileName, sampling * task['binning']
+    if task['cropXyz'] is not None:
+        with maps.openMap(fileName, sampling, origin) as mapFile:
+            low, high = maps.cropBox(mapFile, task['cropXyz'],
+                                     task['cropPadding'])
+        cropFileName = task['tmpPrefix'] + '_crop.mrc'
+        origin = maps.cropMap(fileName, cropFileName, low, high, sampling,
+                              origin, memory=memory)
+        fileName = cropFileName
+    if task['zoneXyz'] is not None:
+        zoneFileName = task['tmpPrefix'] + '_zone.mrc'
+        maps.zoneMap(fileName, zoneFileName, task['zoneXyz'], task['radius'],
+                     sampling, origin, memory=memory)
+        fileName = zoneFileName
+    if task['subtractOrMask'] == 0:
+        return maps.subtractMaps(
+            fileName, task['subtrahend'], task['difference'], minRms=True,
+            minuendVoxelSize=sampling, minuendOrigin=origin,
+            subtrahendVoxelSize=sampling,
+            subtrahendOrigin=task['subtrahendOrigin'], memory=memory,
+            mrcMode=task['mrcMode'])
+    maps.maskMap(fileName, task['subtrahend'], task['difference'],
+                 task['level'], minuendVoxelSize=sampling,
+                 minuendOrigin=origin, maskVoxelSize=sampling,
+                 maskOrigin=task['subtrahendOrigin'], memory=memory,
+                 mrcMode=task['mrcMode'])
+    return None
 
 
 class ChimeraSubtractionMaps(EMProtocol):
@@ -79,6 +127,8 @@ class ChimeraSubtractionMaps(EMProtocol):
     PROTOCOL_OPTIONS = ['Subtraction', 'Mask']
     MAP_OPTIONS = ['3D map', 'atomic structure']
     CHIMERA_FILTERS = ['Gaussian', 'Fourier Transform']
+    ZSCORE_FILTERS = ['Box', 'Gaussian']
+    PREVIEW_BINNING = [1, 2, 4]
     # --------------------------- DEFINE param functions --------------------
     def _defineParams(self, form, doHelp=False):
 
@@ -251,6 +301,158 @@ class ChimeraSubtractionMaps(EMProtocol):
                       label="Gaussian filter width",
                       default=1.5,
                       help="Set the width of the Gaussian filter.")
+        form.addParam('zScore', BooleanParam,
+                      expertLevel=LEVEL_ADVANCED,
+                      label="Compute local z-score map?",
+                      default=False,
+                      help="Select 'Yes' to write also the difference map "
+                           "divided by its local standard deviation "
+                           "(zscore_ map), after subtracting the local mean. "
+                           "The same contour level of z-score maps means "
+                           "the same significance in maps with different "
+                           "noise, so that levels are comparable across "
+                           "runs and datasets.")
+        form.addParam('zScoreWindow', FloatParam,
+                      expertLevel=LEVEL_ADVANCED,
+                      condition='zScore==True',
+                      label="Local noise window (A)",
+                      default=20.,
+                      help="Size of the region around each voxel used to "
+                           "estimate the local mean and standard deviation. "
+                           "It should be larger than the features of the "
+                           "difference map.")
+        form.addParam('zScoreFilter', EnumParam,
+                      expertLevel=LEVEL_ADVANCED,
+                      condition='zScore==True',
+                      choices=self.ZSCORE_FILTERS,
+                      display=EnumParam.DISPLAY_HLIST,
+                      label="Local noise window shape",
+                      default=0,
+                      help="'box' averages the voxels of a cube of the "
+                           "window size. 'gaussian' weights them with a "
+                           "gaussian whose width (2 standard deviations) is "
+                           "the window size.")
+        form.addParam('useNativeEngine', BooleanParam,
+                      expertLevel=LEVEL_ADVANCED,
+                      label="Compute without ChimeraX?",
+                      default=False,
+                      help="Select 'Yes' to compute the difference and the "
+                           "filtered maps without launching ChimeraX. Both "
+                           "maps are read as memory maps, the subtrahend is "
+                           "interpolated on the minuend grid if needed and "
+                           "scaled to minimize the RMS of the difference "
+                           "(as 'volume subtract ... minRms true'). Masking "
+                           "sets to 0 the minuend voxels where the "
+                           "subtrahend is above the contour level.\n"
+                           "Maps are processed in slabs so that maps larger "
+                           "than the memory can be handled.\n"
+                           "If the subtrahend is an atomic structure, its "
+                           "simulated map (as 'molmap') is computed directly "
+                           "on the minuend grid, symmetry copies are "
+                           "generated as 'sym' and the map fraction "
+                           "around the atomic structure is cut out as "
+                           "'volume zone'.\n"
+                           "No ChimeraX session is saved.")
+        form.addParam('headless', BooleanParam,
+                      expertLevel=LEVEL_ADVANCED,
+                      condition='useNativeEngine==False',
+                      label="Run ChimeraX without a window?",
+                      default=False,
+                      help="Select 'Yes' to run the ChimeraX script with "
+                           "--nogui --exit, so that no user interaction is "
+                           "needed and the protocol can run on queue nodes "
+                           "without a display. The maps and structures "
+                           "written by the script are registered as outputs "
+                           "when ChimeraX exits.")
+        form.addParam('memoryBudget', FloatParam,
+                      expertLevel=LEVEL_ADVANCED,
+                      condition='useNativeEngine==True',
+                      label="Memory budget (GB)",
+                      default=2.,
+                      help="Approximate peak memory used to process the "
+                           "maps without ChimeraX. Lower it to process very "
+                           "large maps on nodes with little memory.")
+        form.addParam('previewBinning', EnumParam,
+                      expertLevel=LEVEL_ADVANCED,
+                      condition='useNativeEngine==True',
+                      choices=['no', '2x', '4x'],
+                      display=EnumParam.DISPLAY_HLIST,
+                      label="Preview binning",
+                      default=0,
+                      help="Bin the input maps (mean of 2x2x2 or 4x4x4 "
+                           "voxels) and simulate the atomic structure on the "
+                           "binned grid to get a quick, low resolution "
+                           "difference map. Use it to choose the parameters "
+                           "and then run the protocol again without "
+                           "binning.")
+        form.addParam('autoCrop', BooleanParam,
+                      expertLevel=LEVEL_ADVANCED,
+                      condition='useNativeEngine==True and mapOrModel==1',
+                      label="Crop the map around the atomic structure?",
+                      default=False,
+                      help="Select 'Yes' to compute the simulated map, zone "
+                           "and difference only in the box of the atomic "
+                           "structure plus a padding. The padding is at "
+                           "least the extent of the simulated atoms (and "
+                           "the zone radius), so the difference is the "
+                           "same as without cropping.")
+        form.addParam('cropPadding', FloatParam,
+                      expertLevel=LEVEL_ADVANCED,
+                      condition=('useNativeEngine==True and mapOrModel==1 '
+                                 'and autoCrop==True'),
+                      label="Crop padding (A)",
+                      default=10.,
+                      help="Margin added around the atomic structure.")
+        form.addParam('pasteBack', BooleanParam,
+                      expertLevel=LEVEL_ADVANCED,
+                      condition=('useNativeEngine==True and mapOrModel==1 '
+                                 'and autoCrop==True'),
+                      label="Paste the difference in the full box?",
+                      default=True,
+                      help="Select 'Yes' to write the difference and filtered "
+                           "maps on the grid of the input map, 'No' to keep "
+                           "them on the cropped box.")
+        form.addParam('halfMaps', BooleanParam,
+                      expertLevel=LEVEL_ADVANCED,
+                      label="Subtract also from the half maps?",
+                      default=False,
+                      help="Select 'Yes' to subtract the same subtrahend "
+                           "from both half maps of the input volume, in "
+                           "parallel, and compute the Fourier shell "
+                           "correlation (FSC) of the two half difference "
+                           "maps. Difference density supported by both "
+                           "halves correlates up to high resolution. "
+                           "The half difference maps are not pasted back "
+                           "into the full box. With ChimeraX the half "
+                           "maps are subtracted in a single extra launch, "
+                           "or in the same launch as the full map if "
+                           "ChimeraX runs without interface.")
+        form.addParam('outputFormat', EnumParam,
+                      expertLevel=LEVEL_ADVANCED,
+                      condition='useNativeEngine==True',
+                      choices=[label for label, _, compressed
+                               in maps.OUTPUT_FORMATS if not compressed],
+                      display=EnumParam.DISPLAY_HLIST,
+                      label="Format of the output maps",
+                      default=0,
+                      help="'float16' writes the simulated, zone, "
+                           "difference, filtered and z-score maps in MRC "
+                           "mode 12, half the size of float32 maps. They "
+                           "are all registered as outputs, so they are not "
+                           "compressed.")
+        form.addParam('useMapCache', BooleanParam,
+                      expertLevel=LEVEL_ADVANCED,
+                      condition='useNativeEngine==True and mapOrModel==1',
+                      label="Reuse cached simulated maps?",
+                      default=True,
+                      help="Simulated maps and symmetry copies of atomic "
+                           "structures are kept in a cache shared by all "
+                           "projects (variable CHIMERA_MAP_CACHE, quota in "
+                           "GB given by CHIMERA_MAP_CACHE_SIZE). Runs with "
+                           "the same structure, selection, symmetry, "
+                           "resolution and grid reuse the cached map, and "
+                           "runs with the same structure, selection and "
+                           "symmetry reuse the symmetry copies.")
         form.addParam('extraCommands', StringParam,
                       default='',
                       condition='False',
@@ -273,7 +475,12 @@ class ChimeraSubtractionMaps(EMProtocol):
 
     def _insertAllSteps(self):
         self._insertFunctionStep('prerequisitesStep')
-        self._insertFunctionStep('runChimeraStep')
+        if self.isNative():
+            self._insertFunctionStep('nativeSubtractionStep')
+        else:
+            self._insertFunctionStep('runChimeraStep')
+        if self.zScore:
+            self._insertFunctionStep('zScoreStep')
         self._insertFunctionStep('createOutput')
 
 
@@ -294,12 +501,12 @@ class ChimeraSubtractionMaps(EMProtocol):
             print("Map to subtract generated from the atomic structure:\n %s\n"
                   % self.atomStructName)
 
-    def runChimeraStep(self):
-
+    def _getChimeraScript(self, minuendFileName):
+        """ Script that computes the difference map of minuendFileName
+        (model #8) and writes the maps and models used to compute it """
         # building script file including the coordinate axes and the input
         # volume with samplingRate and Origin information
-        f = open(self._getTmpPath(chimeraPythonFileName), "w")
-        f.write("from chimerax.core.commands import run\n")
+        script = Script()
 
         # building coordinate axes
         dim = self.vol.getDim()[0]
@@ -309,42 +516,37 @@ class ChimeraSubtractionMaps(EMProtocol):
                                          sampling=sampling)
         # origin coordinates
         modelId = 1 # axis
-        f.write("run(session, 'open %s')\n" % (bildFileName))
-        f.write("run(session, 'cofr 0,0,0')\n")  # set center of coordinates
+        script.add(Open(bildFileName))
+        script.add('cofr', (0, 0, 0))  # set center of coordinates
         # input volume
         modelMapM = modelId + 1 # 2, Minuend, result = minuend − subtrahend
-        f.write("run(session,'open %s')\n" % self.fnVolName)
+        script.add(Open(minuendFileName))
         # step = 1 -> no  binning
-        f.write("run(session,'volume #%d style surface voxelSize %f')\n"
-                % (modelMapM, sampling))
-        x, y, z = self.vol.getShiftsFromOrigin()
-        f.write("run(session,'volume #%d origin %0.2f,%0.2f,%0.2f')\n"
-                % (modelMapM, x, y, z))
+        script.add(commands.Volume(modelMapM, style='surface',
+                                   voxelSize=sampling))
+        script.add(commands.Volume(modelMapM,
+                                   origin=self.vol.getShiftsFromOrigin()))
         modelMapS =7
         modelAtomStruct = 3
         modelAtomStructChain = 4
         modelAtomStructChainSym = 5
         modelIdZone = 6
         modelMapDiff = 8
-        modelMapDiffFil = 9
 
         if self.mapOrModel == 0:  # subtrahend is a 3D Map
             # input map
             # with its origin coordinates
             # modelMapS = modelMapM + 1  # 3 Subtrahend
-            f.write("run(session,'open %s')\n" %
-                    (self.subVolName))
-            f.write("run(session, 'rename #3 id #%d')\n" % modelMapS)
-            f.write("run(session,'volume #%d style surface voxelSize %f step 1')\n"
-                    % (modelMapS, sampling))
-            x, y, z = self.subVol.getShiftsFromOrigin()
-            f.write("run(session,'volume #%d origin %0.2f,%0.2f,%0.2f')\n"
-                        % (modelMapS, x, y, z))
+            script.add(Open(self.subVolName))
+            script.add(Rename(3, modelMapS))
+            script.add(commands.Volume(modelMapS, style='surface',
+                                       voxelSize=sampling, step=1))
+            script.add(commands.Volume(
+                modelMapS, origin=self.subVol.getShiftsFromOrigin()))
             if self.subtractOrMask == 1 and self.level.get() is not None:
-                f.write("run(session,'volume #%d level %f')\n" %
-                        (modelMapS, self.level))
+                script.add(commands.Volume(modelMapS, level=self.level.get()))
         else:  # subtrahend is an atomic structure
-            f.write("run(session,'open %s')\n" % self.atomStructName)
+            script.add(Open(self.atomStructName))
             # input atomic structure
             if self.selectChain == True:
                 # model and chain selected
@@ -356,113 +558,102 @@ class ChimeraSubtractionMaps(EMProtocol):
                         modelId = int(modelAtomStruct +
                                                      int(self.selectedModel))
 
-                        f.write("run(session, 'rename #%d id #%d')\n" %
-                                (modelId, modelAtomStruct))
+                        script.add(Rename(modelId, modelAtomStruct))
                     self.selectedChain = \
                         chain.split(',')[1].split(':')[1].strip().split('"')[1]
                     print("Selected chain: %s from model: %s from structure: %s" \
                         % (self.selectedChain, self.selectedModel,
                             os.path.basename(self.atomStructName)))
-                    f.write("run(session,'sel #%d/%s')\n"
-                            % (modelAtomStruct, self.selectedChain))
+                    script.add('sel', '#%d/%s' % (modelAtomStruct,
+                                                  self.selectedChain))
                     tmpPath = os.path.abspath(self._getTmpPath('chain.cif'))
 
-                    f.write("run(session,"
-                            "'save %s format mmcif models #%d relModel #%d selectedOnly true')\n"
-                            % (tmpPath, modelAtomStruct, modelId))
-                    f.write("run(session,'open %s')\n" % tmpPath)
-                    f.write("run(session,'scipionwrite #%d prefix chain_%s_ ')\n"
-                            % (modelAtomStructChain, self.selectedChain))
+                    script.add(Save(tmpPath, models=modelAtomStruct,
+                                    format='mmcif', relModel=spec(modelId),
+                                    selectedOnly=True))
+                    script.add(Open(tmpPath))
+                    script.add(ScipionWrite(modelAtomStructChain,
+                                            'chain_%s_' % self.selectedChain))
                     if self.selectAreaMap == True:  # mask the minuend using the atomic structure
                         if self.applySymmetry == True and self.symmetryGroup.get() is not None:
                             sym = CHIMERA_SYM_NAME[self.symmetryGroup.get()]
                             modelId = modelAtomStructChain #4
-                            self.symMethod(f, modelId, sym, self.symmetryOrder)
+                            self.symMethod(script, modelId, sym,
+                                           self.symmetryOrder.get())
 
-                            f.write("run(session,'volume zone #%d nearAtoms #%d "
-                                    "range %d newMap true modelId #%d')\n"
-                                    % (modelMapM, modelAtomStructChainSym,
-                                       self.radius, modelIdZone))
+                            self._addZone(script, modelMapM,
+                                          modelAtomStructChainSym, modelIdZone)
                             if not self.removeResidues:
-                                f.write("run(session,'scipionwrite #%d prefix sym_  ')\n"
-                                        % modelAtomStructChainSym)
+                                script.add(ScipionWrite(
+                                    modelAtomStructChainSym, 'sym_'))
 
-                            f.write("run(session,'close #%d')\n" % (modelAtomStructChainSym))
+                            script.add(Close(modelAtomStructChainSym))
                         else:
-                            f.write("run(session,'volume zone #%d nearAtoms #%d "
-                                    "range %d newMap true modelId #%d')\n"
-                                    % (modelMapM, modelAtomStructChain,
-                                    self.radius, modelIdZone))
+                            self._addZone(script, modelMapM,
+                                          modelAtomStructChain, modelIdZone)
 
-                        f.write("run(session,'scipionwrite #%d prefix zone_  ')\n" % modelIdZone)
+                        script.add(ScipionWrite(modelIdZone, 'zone_'))
 
                     if self.removeResidues == True:
                         idxRemove = self.getIdxRemoveResidues()
                         if idxRemove is not None:
                             self.firstResidue = idxRemove[0]
                             self.lastResidue = idxRemove[1]
-                            f.write("run(session,'sel #%d/%s:%d-%d')\n"
-                                    % (modelAtomStructChain, self.selectedChain,
-                                       int(self.firstResidue), int(self.lastResidue)))
-                            f.write("run(session,'del sel')\n")
-                            f.write("run(session,'sel #%d/%s:%d-%d')\n" %
-                                    (modelAtomStructChain, self.selectedChain,
-                                     int(self.firstResidue) - 10,
-                                     int(self.lastResidue) + 10))
+                            script.add('sel', '#%d/%s:%d-%d'
+                                       % (modelAtomStructChain,
+                                          self.selectedChain,
+                                          int(self.firstResidue),
+                                          int(self.lastResidue)))
+                            script.add('del', 'sel')
+                            script.add('sel', '#%d/%s:%d-%d'
+                                       % (modelAtomStructChain,
+                                          self.selectedChain,
+                                          int(self.firstResidue) - 10,
+                                          int(self.lastResidue) + 10))
                     if self.applySymmetry == True:
                         if self.symmetryGroup.get() is not None:
                             sym = CHIMERA_SYM_NAME[self.symmetryGroup.get()]
                             modelId = modelAtomStructChain
-                            self.symMethod(f, modelId, sym, self.symmetryOrder, self.rangeDist)
-                            f.write("run(session,'scipionwrite #%d prefix sym_  ')\n"
-                                    % modelAtomStructChainSym)
-                            f.write("v=run(session,'molmap #%d %0.3f gridSpacing %f')\n"
-                                    % (modelAtomStructChainSym, self.resolution, sampling))
-                            f.write("run(session,'rename #%d id #7' % v.id[0])\n") ## #7 is modelMapS id
-                            if self.subtractOrMask == 1 and self.level.get() is not None:
-                                f.write("run(session,'volume #%d level %f')\n" %
-                                        (modelMapS, self.level))
+                            self.symMethod(script, modelId, sym,
+                                           self.symmetryOrder.get())
+                            script.add(ScipionWrite(modelAtomStructChainSym,
+                                                    'sym_'))
+                            self._addMolmap(script, modelAtomStructChainSym,
+                                            modelMapS, sampling)
                             if self.removeResidues == True:
                                 idxRemove = self.getIdxRemoveResidues()
                                 if idxRemove is not None:
-                                    f.write("run(session,'sel #%d:%d-%d')\n" %
-                                            (modelAtomStructChainSym,
-                                             int(self.firstResidue) - 10,
-                                             int(self.lastResidue) + 10))
+                                    script.add('sel', '#%d:%d-%d'
+                                               % (modelAtomStructChainSym,
+                                                  int(self.firstResidue) - 10,
+                                                  int(self.lastResidue) + 10))
 
                     else:
-                        f.write("v=run(session,'molmap #%d %0.3f gridSpacing %f')\n"
-                                % (modelAtomStructChain, self.resolution, sampling))
-                        f.write("run(session,'rename #%d id #7' % v.id[0])\n") ## #7 is modelMapS id
-                        if self.subtractOrMask == 1 and self.level.get() is not None:
-                            f.write("run(session,'volume #%d level %f')\n" %
-                                    (modelMapS, self.level))
+                        self._addMolmap(script, modelAtomStructChain,
+                                        modelMapS, sampling)
 
-                    f.write("run(session,'scipionwrite #%d prefix molmap_chain%s_')\n"
-                            % (modelMapS, self.selectedChain))
+                    script.add(ScipionWrite(
+                        modelMapS, 'molmap_chain%s_' % self.selectedChain))
 
             else:  # use whole atomic model
-                f.write("run(session,'scipionwrite #%d')\n" % modelAtomStruct)
+                script.add(ScipionWrite(modelAtomStruct))
                 if self.selectAreaMap == True:
                     if self.applySymmetry == True and self.symmetryGroup.get() is not None:
                         sym = CHIMERA_SYM_NAME[self.symmetryGroup.get()]
                         modelId = modelAtomStruct
-                        self.symMethod(f, modelId, sym, self.symmetryOrder, self.rangeDist)
-                        f.write("run(session, 'rename #4 id #%d')\n" % modelAtomStructChainSym)
-                        f.write("run(session,'volume zone #%d nearAtoms #%d "
-                                "range %d newMap true modelId #%d')\n"
-                                % (modelMapM, modelAtomStructChainSym,
-                                   self.radius, modelIdZone))
+                        self.symMethod(script, modelId, sym,
+                                       self.symmetryOrder.get())
+                        script.add(Rename(4, modelAtomStructChainSym))
+                        self._addZone(script, modelMapM,
+                                      modelAtomStructChainSym, modelIdZone)
 
-                        f.write("run(session,'close #%d')\n" % (modelAtomStructChainSym))
+                        script.add(Close(modelAtomStructChainSym))
 
                     else:
-                        f.write("run(session,'volume zone #%d nearAtoms #%d "
-                                "range %d newMap true modelId #%d')\n"
-                                % (modelMapM, modelAtomStruct,
-                                    self.radius, modelIdZone))
+                        self._addZone(script, modelMapM, modelAtomStruct,
+                                      modelIdZone)
 
-                    f.write("run(session,'scipionwrite #%d prefix zone_  ')\n" % modelIdZone)
+                    script.add(ScipionWrite(modelIdZone, 'zone_'))
 
                 if self.removeResidues == True:
                     idxRemove = self.getIdxRemoveResidues()
@@ -474,59 +665,50 @@ class ChimeraSubtractionMaps(EMProtocol):
                             modelId = int(modelAtomStruct +
                                           int(self.selectedModel))
 
-                            f.write("run(session, 'rename #%d id #%d')\n" %
-                                    (modelId, modelAtomStruct))
+                            script.add(Rename(modelId, modelAtomStruct))
                         self.selectedChain = \
                             chain.split(',')[1].split(':')[1].strip().split('"')[1]
                         print("Selected chain: %s from model: %s from structure: %s"\
                               % (self.selectedChain, self.selectedModel,
                                  os.path.basename(self.atomStructName)))
-                        f.write("run(session,'sel #%d/%s')\n"
-                                % (modelAtomStruct, self.selectedChain))
+                        script.add('sel', '#%d/%s' % (modelAtomStruct,
+                                                      self.selectedChain))
                         self.firstResidue = idxRemove[0]
                         self.lastResidue = idxRemove[1]
-                        f.write("run(session,'sel #%d/%s:%d-%d')\n"
-                                % (modelAtomStruct, self.selectedChain,
-                                   int(self.firstResidue), int(self.lastResidue)))
-                        f.write("run(session,'del sel')\n")
-                        f.write("run(session,'scipionwrite #%d prefix mutated_ ')\n"
-                                % modelAtomStruct)
-
-                        f.write("run(session,'sel #%d/%s:%d-%d')\n" %
-                                (modelAtomStruct, self.selectedChain,
-                                 int(self.firstResidue) - 10,
-                                 int(self.lastResidue) + 10))
+                        script.add('sel', '#%d/%s:%d-%d'
+                                   % (modelAtomStruct, self.selectedChain,
+                                      int(self.firstResidue),
+                                      int(self.lastResidue)))
+                        script.add('del', 'sel')
+                        script.add(ScipionWrite(modelAtomStruct, 'mutated_'))
+
+                        script.add('sel', '#%d/%s:%d-%d'
+                                   % (modelAtomStruct, self.selectedChain,
+                                      int(self.firstResidue) - 10,
+                                      int(self.lastResidue) + 10))
 
                 if self.applySymmetry == True:
                     if self.symmetryGroup.get() is not None:
                         sym = CHIMERA_SYM_NAME[self.symmetryGroup.get()]
                         modelId = modelAtomStruct
-                        self.symMethod(f, modelId, sym, self.symmetryOrder, self.rangeDist)
-                        f.write("run(session, 'rename #4 id #%d')\n" % modelAtomStructChainSym)
-                        f.write("run(session,'scipionwrite #%d prefix sym_ ')\n"
-                                % modelAtomStructChainSym)
+                        self.symMethod(script, modelId, sym,
+                                       self.symmetryOrder.get())
+                        script.add(Rename(4, modelAtomStructChainSym))
+                        script.add(ScipionWrite(modelAtomStructChainSym,
+                                                'sym_'))
                         idxRemove = self.getIdxRemoveResidues()
                         if (self.inputStructureChain.get() is not None and idxRemove is not None):
-                            f.write("run(session, 'sel #%d/%s:%d-%d')\n" %
-                                    (modelAtomStructChainSym,
-                                     self.selectedChain,
-                                     int(self.firstResidue) - 10,
-                                     int(self.lastResidue) + 10))
-                        f.write("v=run(session,'molmap #%d %0.3f gridSpacing %f')\n"
-                                % (modelAtomStructChainSym, self.resolution, sampling))
-                        f.write("run(session,'rename #%d id #7' % v.id[0])\n") ## #7 is modelMapS id
-                        # modelMapS = modelAtomStructChainSym + 1
-                        if self.subtractOrMask == 1 and self.level.get() is not None:
-                            f.write("run(session,'volume #%d level %f')\n" %
-                                    (modelMapS, self.level))
+                            script.add('sel', '#%d/%s:%d-%d'
+                                       % (modelAtomStructChainSym,
+                                          self.selectedChain,
+                                          int(self.firstResidue) - 10,
+                                          int(self.lastResidue) + 10))
+                        self._addMolmap(script, modelAtomStructChainSym,
+                                        modelMapS, sampling)
                 else:  # no symmetry
-                    f.write("v=run(session,'molmap #%d %0.3f gridSpacing %f')\n"
-                            % (modelAtomStruct, self.resolution, sampling))
-                    f.write("run(session,'rename #%d id #7' % v.id[0])\n") ## #7 is modelMapS id
-                    if self.subtractOrMask == 1 and self.level.get() is not None:
-                        f.write("run(session,'volume #%d level %f')\n" %
-                                (modelMapS, self.level))
-                f.write("run(session,'scipionwrite #%d prefix molmap_  ')\n" % modelMapS)
+                    self._addMolmap(script, modelAtomStruct, modelMapS,
+                                    sampling)
+                script.add(ScipionWrite(modelMapS, 'molmap_'))
 
         # Generation of the differential map
         if self.selectAreaMap == True:
@@ -534,97 +716,524 @@ class ChimeraSubtractionMaps(EMProtocol):
         else:
             modelId = modelMapM
         if self.subtractOrMask == 0:
-            f.write("run(session, 'volume subtract #%d #%d modelId #%d "
-                    "minRms true onGrid #%d')\n" %
-                    (modelId, modelMapS, modelMapDiff, modelId))
+            script.add('volume subtract', spec(modelId), spec(modelMapS),
+                       modelId=spec(modelMapDiff), minRms=True,
+                       onGrid=spec(modelId))
         else:
-            f.write("run(session, 'volume mask #%d surfaces #%d invertMask "
-                    "true modelId #%d')\n" %
-                    (modelId, modelMapS, modelMapDiff))
-        f.write("run(session,'scipionwrite #%d prefix difference_')\n" % modelMapDiff)
+            script.add('volume mask', spec(modelId),
+                       surfaces=spec(modelMapS), invertMask=True,
+                       modelId=spec(modelMapDiff))
+        return script
+
+    def _getHalfMapScripts(self, cwd):
+        """ Scripts that subtract the subtrahend from each half map, only
+        the half difference maps are written """
+        modelMapDiff = 8
+        scripts = []
+        for half, fileName in enumerate(self.vol.getHalfMaps().split(','),
+                                        1):
+            script = self._getChimeraScript(ImageHandler.removeFileType(
+                os.path.abspath(fileName)))
+            script.commands = [c for c in script.commands
+                               if not isinstance(c, ScipionWrite)]
+            script.add(ScipionWrite(modelMapDiff,
+                                    'half%d_difference_' % half))
+            script.cwd, script.env = cwd, getEnvDictionary(self)
+            scripts.append(script)
+        return scripts
+
+    def runChimeraStep(self):
+        modelMapDiff = 8
+        modelMapDiffFil = 9
+        script = self._getChimeraScript(self.fnVolName)
+        script.add(ScipionWrite(modelMapDiff, 'difference_'))
 
         # Generation of the filtered map
         if self.filterToApplyToDiffMap.get() == 0:
-            f.write("run(session,'volume gaussian #%d sd %0.3f modelId %#d')\n"
-                    % (modelMapDiff, self.widthFilter.get(), modelMapDiffFil))
+            script.add('volume gaussian', spec(modelMapDiff),
+                       sd=self.widthFilter.get(),
+                       modelId=spec(modelMapDiffFil))
         else:
-            f.write("run(session,'volume laplacian #%d')\n" % modelMapDiff)
+            script.add('volume laplacian', spec(modelMapDiff),
+                       modelId=spec(modelMapDiffFil))
 
-        f.write("run(session,'scipionwrite #%d prefix filtered_')\n" % modelMapDiffFil)
+        script.add(ScipionWrite(modelMapDiffFil, 'filtered_'))
         if self.inputPdbFiles is not None:  # Other atomic models different
                                             # from the subtrahend
             for atomStruct in self.inputPdbFiles:
-                f.write("run(session,'open %s')\n" %
-                        os.path.abspath(atomStruct.get().getFileName()))
+                script.add(Open(os.path.abspath(
+                    atomStruct.get().getFileName())))
         # Finally save session
-        f.write("run(session,'scipionss')\n")
+        script.add('scipionss')
 
         # run the script:
-        if len(self.extraCommands.get()) > 2:
-            f.write(self.extraCommands.get())
-            args = " --nogui --script " + \
-                   os.path.abspath(self._getTmpPath(chimeraPythonFileName))
+        _chimeraScriptFileName = os.path.abspath(
+            self._getTmpPath(chimeraPythonFileName))
+        with open(_chimeraScriptFileName, "w") as f:
+            f.write(script.python())
+            if len(self.extraCommands.get()) > 2:
+                f.write(self.extraCommands.get())
+        if self.headless:
+            args = " --nogui --exit --script " + _chimeraScriptFileName
+        elif len(self.extraCommands.get()) > 2:
+            args = " --nogui --script " + _chimeraScriptFileName
         else:
-            args = " --script " + \
-                   os.path.abspath(self._getTmpPath(chimeraPythonFileName))
-        f.close()
+            args = " --script " + _chimeraScriptFileName
 
-        self._log.info('Launching: ' + Plugin.getProgram() + ' ' + args)
-
-        # run in the background
         cwd = os.path.abspath(self._getExtraPath())
-        Plugin.runChimeraProgram(Plugin.getProgram(), args, cwd=cwd, extraEnv=getEnvDictionary(self))
+        halfScripts = self._getHalfMapScripts(cwd) if self.halfMaps else []
+        mergedFileName = os.path.abspath(self._getTmpPath('merged_jobs.py'))
+        if halfScripts and self.headless and \
+                len(self.extraCommands.get()) <= 2:
+            # the full and half map jobs in a single ChimeraX
+            script.cwd, script.env = cwd, getEnvDictionary(self)
+            self._log.info('Launching: %s with %d merged jobs'
+                           % (Plugin.getProgram(), 1 + len(halfScripts)))
+            Plugin.runChimeraScripts([script] + halfScripts, mergedFileName,
+                                     protocol=self, step='runChimeraStep')
+        else:
+            self._log.info('Launching: ' + Plugin.getProgram() + ' ' + args)
+            # run in the background
+            Plugin.runChimeraProgram(Plugin.getProgram(), args, cwd=cwd,
+                                     extraEnv=getEnvDictionary(self),
+                                     protocol=self, step='runChimeraStep')
+            if halfScripts:
+                Plugin.runChimeraScripts(halfScripts, mergedFileName,
+                                         protocol=self, step='runChimeraStep')
+        if self.headless and not glob(self._getExtraPath('filtered_*.mrc')):
+            raise Exception("ChimeraX exited without writing the filtered "
+                            "map, check the log for script errors.")
+        if halfScripts:
+            self._writeHalfMapsFsc()
+
+    def _addZone(self, script, modelMap, modelAtoms, modelIdZone):
+        """ Zone of the minuend around the atoms of the subtrahend """
+        script.add('volume zone', spec(modelMap), nearAtoms=spec(modelAtoms),
+                   range=int(self.radius.get()), newMap=True,
+                   modelId=spec(modelIdZone))
+
+    def _addMolmap(self, script, modelAtoms, modelMapS, sampling):
+        """ Map simulated from the atoms, renamed to modelMapS """
+        script.add(NewModel(Molmap(modelAtoms, self.resolution.get(),
+                                   gridSpacing=sampling), modelMapS))
+        if self.subtractOrMask == 1 and self.level.get() is not None:
+            script.add(commands.Volume(modelMapS, level=self.level.get()))
+
+    def nativeSubtractionStep(self):
+        # same model ids (and therefore file names) as runChimeraStep
+        modelAtomStructChainSym = 5
+        modelIdZone = 6
+        modelMapS = 7
+        modelMapDiff = 8
+        modelMapDiffFil = 9
+        sampling = self.vol.getSamplingRate()
+        memory = self.memoryBudget.get() * 1024 ** 3
+        mrcMode = maps.outputMode(self.outputFormat.get())
+        minuendFileName = ImageHandler.removeFileType(self.fnVolName)
+        minuendOrigin = self.vol.getShiftsFromOrigin()
+        binning = self.getPreviewBinning()
+        if binning > 1:
+            minuendFileName, minuendOrigin = self._binNativeMap(
+                'minuend', minuendFileName, sampling, minuendOrigin)
+            sampling *= binning
+        gridFileName, gridOrigin = minuendFileName, minuendOrigin
+        if self.mapOrModel == 0:
+            subFileName = ImageHandler.removeFileType(self.subVolName)
+            subOrigin = self.subVol.getShiftsFromOrigin()
+            if binning > 1:
+                subFileName, subOrigin = self._binNativeMap(
+                    'subtrahend', subFileName, self.subVol.getSamplingRate(),
+                    subOrigin)
+        else:
+            self._parseNativeChain()
+            if self.autoCrop:
+                minuendFileName, minuendOrigin = self._cropNativeMinuend(
+                    minuendFileName, minuendOrigin, sampling, memory)
+            prefix = 'molmap_'
+            if self.selectChain:
+                prefix = 'molmap_chain%s_' % self.selectedChain
+            subFileName = self._getNativeMapFileName(prefix, modelMapS)
+            with maps.openMap(minuendFileName, sampling,
+                              minuendOrigin) as minuend:
+                cache = key = None
+                if self.useMapCache:
+                    cache = Plugin.getMapCache()
+                    key = self._getMolmapCacheKey(minuend)
+                if cache is not None and cache.fetch(key, subFileName):
+                    self._log.info("Simulated map read from cache %s"
+                                   % cache.directory)
+                else:
+                    molmap.molmap(self._getNativeSubtrahendAtoms(),
+                                  self.resolution.get(), subFileName,
+                                  minuend, mrcMode=mrcMode, memory=memory)
+                    if cache is not None:
+                        cache.put(key, subFileName)
+            self._addToManifest(subFileName)
+            if self.applySymmetry:
+                copiesFileName = self._getNativeMapFileName(
+                    'sym_', modelAtomStructChainSym,
+                    chimeraPdbTemplateFileName)
+                self._writeNativeCopies(copiesFileName)
+                self._addToManifest(copiesFileName)
+            subOrigin = minuendOrigin
+            if self.selectAreaMap:
+                # zone around the atoms before removing residues, the
+                # difference is computed on the zone
+                zoneFileName = self._getNativeMapFileName('zone_',
+                                                          modelIdZone)
+                zoneAtoms = self._getNativeSubtrahendAtoms(
+                    removeResidues=False)
+                maps.zoneMap(minuendFileName, zoneFileName,
+                             atoms.coordinates(zoneAtoms), self.radius.get(),
+                             sampling, minuendOrigin, memory=memory,
+                             mrcMode=mrcMode)
+                self._addToManifest(zoneFileName)
+                minuendFileName = zoneFileName
+
+        diffFileName = self._getNativeMapFileName('difference_', modelMapDiff)
+        pasteBack = self.mapOrModel == 1 and self.autoCrop and self.pasteBack
+        if pasteBack:
+            fullDiffFileName = diffFileName
+            diffFileName = os.path.abspath(self._getTmpPath('difference.mrc'))
+        if self.subtractOrMask == 0:
+            scale = maps.subtractMaps(
+                minuendFileName, subFileName, diffFileName, minRms=True,
+                minuendVoxelSize=sampling, minuendOrigin=minuendOrigin,
+                subtrahendVoxelSize=sampling, subtrahendOrigin=subOrigin,
+                memory=memory, mrcMode=mrcMode)
+            self._log.info("Subtrahend scaled by %f (minimum RMS)" % scale)
+        else:
+            maps.maskMap(minuendFileName, subFileName, diffFileName,
+                         self.level.get(), minuendVoxelSize=sampling,
+                         minuendOrigin=minuendOrigin, maskVoxelSize=sampling,
+                         maskOrigin=subOrigin, memory=memory,
+                         mrcMode=mrcMode)
+        if pasteBack:
+            # outside the crop the subtrahend is 0: the difference is the
+            # minuend, or 0 outside the zone
+            maps.pasteMap(diffFileName, gridFileName, fullDiffFileName,
+                          background=not self.selectAreaMap,
+                          gridVoxelSize=sampling, gridOrigin=gridOrigin,
+                          memory=memory, mrcMode=mrcMode)
+            diffFileName = fullDiffFileName
+
+        filFileName = self._getNativeMapFileName('filtered_', modelMapDiffFil)
+        if self.filterToApplyToDiffMap.get() == 0:
+            maps.filterMap(diffFileName, filFileName, 'gaussian',
+                           self.widthFilter.get(), memory=memory,
+                           mrcMode=mrcMode)
+        else:
+            maps.filterMap(diffFileName, filFileName, 'laplacian',
+                           memory=memory, mrcMode=mrcMode)
+        self._addToManifest(diffFileName, filFileName)
+
+        if self.halfMaps:
+            self._subtractHalfMaps(subFileName, subOrigin, memory, mrcMode)
+
+    def _subtractHalfMaps(self, subFileName, subOrigin, memory, mrcMode):
+        """ Subtract the subtrahend of the full map from both half maps in
+        parallel and write the FSC of the half differences """
+        modelMapDiff = 8
+        cropXyz = zoneXyz = cropPadding = None
+        if self.mapOrModel == 1:
+            xyz = atoms.coordinates(
+                self._getNativeSubtrahendAtoms(removeResidues=False))
+            if self.autoCrop:
+                cropXyz = xyz
+                cropPadding = self._getCropPadding(
+                    self.vol.getSamplingRate() * self.getPreviewBinning())
+            if self.selectAreaMap:
+                zoneXyz = xyz
+        halves = self.vol.getHalfMaps().split(',')
+        tasks = []
+        for half, fileName in enumerate(halves, 1):
+            tasks.append({
+                'minuend': ImageHandler.removeFileType(
+                    os.path.abspath(fileName)),
+                'sampling': self.vol.getSamplingRate(),
+                'origin': self.vol.getShiftsFromOrigin(),
+                'binning': self.getPreviewBinning(),
+                'cropXyz': cropXyz,
+                'cropPadding': cropPadding,
+                'zoneXyz': zoneXyz,
+                'radius': self.radius.get(),
+                'subtrahend': subFileName,
+                'subtrahendOrigin': subOrigin,
+                'subtractOrMask': self.subtractOrMask.get(),
+                'level': self.level.get(),
+                'difference': self._getNativeMapFileName(
+                    'half%d_difference_' % half, modelMapDiff),
+                'tmpPrefix': os.path.abspath(self._getTmpPath('half%d'
+                                                              % half)),
+                'memory': memory / len(halves),
+                'mrcMode': mrcMode})
+        with ProcessPoolExecutor(max_workers=len(tasks)) as executor:
+            for task, scale in zip(tasks, executor.map(subtractHalfMap,
+                                                       tasks)):
+                if scale is not None:
+                    self._log.info("%s: subtrahend scaled by %f"
+                                   % (os.path.basename(task['minuend']),
+                                      scale))
+        self._addToManifest(*[task['difference'] for task in tasks])
+        self._writeHalfMapsFsc()
+
+    def _writeHalfMapsFsc(self):
+        """ FSC of the half difference maps """
+        modelMapDiff = 8
+        frequencies, fsc = maps.mapFsc(
+            self._getNativeMapFileName('half1_difference_', modelMapDiff),
+            self._getNativeMapFileName('half2_difference_', modelMapDiff))
+        maps.writeFsc(self._getFscFileName(), frequencies, fsc)
+        resolution = maps.fscResolution(frequencies, fsc)
+        if resolution is not None:
+            self._log.info("Half difference maps FSC 0.143 at %0.2f A"
+                           % resolution)
+
+    def zScoreStep(self):
+        memory = self.memoryBudget.get() * 1024 ** 3
+        filterType = self.ZSCORE_FILTERS[self.zScoreFilter.get()].lower()
+        # ChimeraX writes float32 maps
+        outputFormat = self.outputFormat.get() if self.isNative() else 0
+        prefix = 'difference_'
+        for diffFileName in sorted(glob(self._getExtraPath(prefix + '*'))):
+            if diffFileName.endswith(maps.STATS_SUFFIX):
+                continue
+            zFileName = os.path.join(
+                os.path.dirname(diffFileName),
+                'zscore_' + os.path.basename(diffFileName)[len(prefix):])
+            maps.localZscoreMap(diffFileName, zFileName,
+                                self.zScoreWindow.get(), filterType,
+                                memory=memory,
+                                mrcMode=maps.outputMode(outputFormat))
+            self._addToManifest(zFileName)
+            self._log.info("Local z-score map written to %s" % zFileName)
 
     def createOutput(self):
-        # Check vol and pdb files
+        """ Register the maps and atomic structures of the manifest, saved
+        by scipionwrite or by the native engine (see chimera.manifest) """
         directory = self._getExtraPath()
-        for filename in sorted(os.listdir(directory)):
-            if filename.endswith(".mrc"):
-                volFileName = os.path.join(directory, filename)
-                vol = Volume()
-                vol.setFileName(volFileName)
-
-                # fix mrc header
-                ccp4header = Ccp4Header(volFileName, readHeader=True)
-                sampling = ccp4header.computeSampling()
+        for entry in manifest.outputEntries(directory):
+            fileName = os.path.join(directory, entry['path'])
+            if entry['type'] == manifest.MAP:
+                maps.mapStats(fileName)  # sidecar used by viewers
+                output = Volume()
+                output.setFileName(fileName)
                 origin = Transform()
-                shifts = ccp4header.getOrigin()
-                origin.setShiftsTuple(shifts)
-                vol.setOrigin(origin)
-                vol.setSamplingRate(sampling)
-                keyword = filename.split(".mrc")[0]
-                kwargs = {keyword: vol}
-                self._defineOutputs(**kwargs)
-
-            elif filename.endswith(".pdb") or filename.endswith(".cif"):
-                path = os.path.join(directory, filename)
-                pdb = AtomStruct()
-                pdb.setFileName(path)
-                keyword = filename.split(".pdb")[0].replace(".","_")
-                kwargs = {keyword: pdb}
-                self._defineOutputs(**kwargs)
-
-    def symMethod(self, f, modelId, sym, order=None, range=None):
-        if sym == "Cn" and order != 1:
-            f.write("run(session,'sym #%d C%d copies t')\n"
-                    % (modelId, order))
-        elif sym == "Dn" and order != 1:
-            f.write("run(session,'sym #%d d%d copies t')\n"
-                    % (modelId, order))
-        elif sym == "T222" or sym == "TZ3":
-            f.write("v=run(session,'sym #%d t,%s copies t')\n"
-                    % (modelId, sym[1:]))
-        elif sym == "O":
-            f.write("run(session,'sym #%d O copies t')\n"
-                    % modelId)
-        elif sym == "I222" or sym == "I222r" or sym == "In25" or \
-                sym == "In25r" or sym == "I2n3" or sym == "I2n3r" or \
-                sym == "I2n5" or sym == "I2n5r":
-            f.write("run(session,'sym #%d i,%s copies t')\n"
-                    % (modelId, sym[1:]))
-
-        f.write("run(session,'delete #%d & #%d #>%d')\n"
-                    % (int(modelId) + 1, modelId, self.rangeDist))
+                origin.setShiftsTuple(entry['origin'])
+                output.setOrigin(origin)
+                output.setSamplingRate(entry['sampling'])
+                keyword = manifest.outputName(entry)
+            else:
+                output = AtomStruct()
+                output.setFileName(fileName)
+                # names of the outputs of previous versions (..._cif)
+                keyword = os.path.basename(entry['path']).split(
+                    ".pdb")[0].replace(".", "_")
+            self._defineOutputs(**{keyword: output})
+
+        if os.path.exists(self._getFscFileName()):
+            frequencies, values = maps.readFsc(self._getFscFileName())
+            fsc = FSC(objLabel='half difference maps')
+            fsc.setData(frequencies.tolist(), values.tolist())
+            fscSet = self._createSetOfFSCs()
+            fscSet.append(fsc)
+            self._defineOutputs(outputFSC=fscSet)
+            self._defineSourceRelation(self.inputVolume, fscSet)
+
+    def symMethod(self, script, modelId, sym, order=None):
+        """ Symmetry copies of model modelId (model modelId + 1) within
+        rangeDist """
+        group = symGroup(sym, order or 1)
+        if group is not None:
+            script.add(Sym(modelId, group, copies=True))
+        script.add('delete', '#%d & #%d #>%d'
+                   % (int(modelId) + 1, modelId, self.rangeDist))
+
+    def isNative(self):
+        """ True if the maps are computed without ChimeraX """
+        return self.useNativeEngine.get()
+
+    def getPreviewBinning(self):
+        """ Binning factor of the native preview, 1 for full sampling """
+        return self.PREVIEW_BINNING[self.previewBinning.get()] \
+            if self.isNative() else 1
+
+    def _binNativeMap(self, name, fileName, sampling, origin):
+        """ Bin a map for the preview. Return the file name and origin of
+        the binned map. """
+        binnedFileName = os.path.abspath(self._getTmpPath('%s_bin.mrc' % name))
+        _, binnedOrigin = maps.binMap(fileName, binnedFileName,
+                                      self.getPreviewBinning(), sampling,
+                                      origin,
+                                      memory=self.memoryBudget.get() *
+                                      1024 ** 3)
+        return binnedFileName, tuple(binnedOrigin)
+
+    def _cropNativeMinuend(self, fileName, origin, sampling, memory,
+                           resolution=None, radius=None):
+        """ Crop the minuend around the subtrahend atoms. Return the file
+        name and origin of the crop.
+
+        :param resolution, radius: largest molmap resolution and zone
+                                   radius, those of the form if None
+        """
+        padding = self._getCropPadding(sampling, resolution, radius)
+        xyz = atoms.coordinates(
+            self._getNativeSubtrahendAtoms(removeResidues=False))
+        cropFileName = os.path.abspath(self._getTmpPath('crop.mrc'))
+        with maps.openMap(fileName, sampling, origin) as mapFile:
+            low, high = maps.cropBox(mapFile, xyz, padding)
+            self._log.info("Map cropped to %s voxels (%0.1f%% of the box)"
+                           % (tuple(high - low), 100. *
+                              np.prod(high - low) / np.prod(mapFile.shape)))
+        cropOrigin = maps.cropMap(fileName, cropFileName, low, high,
+                                  sampling, origin, memory=memory)
+        return cropFileName, tuple(cropOrigin)
+
+    def _getCropPadding(self, sampling, resolution=None, radius=None):
+        """ Crop padding (A) that keeps the whole simulated map and zone """
+        resolution = resolution or self.resolution.get()
+        radius = radius or self.radius.get()
+        padding = max(self.cropPadding.get(),
+                      molmap.CUTOFF_RANGE * molmap.SIGMA_FACTOR * resolution +
+                      sampling)
+        if self.selectAreaMap:
+            padding = max(padding, radius + sampling)
+        return padding
+
+    def _getFscFileName(self):
+        return os.path.abspath(self._getExtraPath('halves_fsc.csv'))
+
+    def _parseNativeChain(self):
+        """ Set selectedModel and selectedChain from the chain wizard,
+        None if no chain is involved """
+        chainJson = None
+        if self.selectChain and self.selectStructureChain.get() is not None:
+            chainJson = self.selectStructureChain.get()
+        elif self.removeResidues and self.inputStructureChain.get() is not None:
+            chainJson = self.inputStructureChain.get()
+        self.selectedModel = self.selectedChain = None
+        if chainJson is not None:
+            self.selectedModel = chainJson.split(',')[0].split(':')[1].strip()
+            self.selectedChain = \
+                chainJson.split(',')[1].split(':')[1].strip().split('"')[1]
+
+    def _getSubtrahendCacheFields(self, removeResidues=True):
+        """ Cache key fields that identify the atoms of the subtrahend, as
+        given by _getNativeSubtrahendAtoms """
+        applySymmetry = bool(self.applySymmetry)
+        if getattr(self, '_structureHash', None) is None:
+            self._structureHash = mapcache.fileHash(self.atomStructName)
+        return dict(
+            structure=self._structureHash,
+            reader=atoms.VERSION,
+            model=self.selectedModel if self.selectChain else None,
+            chain=self.selectedChain if self.selectChain else None,
+            removedResidues=([self.selectedChain] +
+                             (self.getIdxRemoveResidues() or [])
+                             if self.removeResidues and removeResidues
+                             else None),
+            symmetry=(CHIMERA_SYM_NAME[self.symmetryGroup.get()]
+                      if applySymmetry else None),
+            symmetryVersion=symmetry.VERSION if applySymmetry else None,
+            symmetryOrder=self.symmetryOrder.get() if applySymmetry else None,
+            symmetryCenter=(0., 0., 0.) if applySymmetry else None,
+            rangeDist=self.rangeDist.get() if applySymmetry else None,
+            rangeFilter='copies' if applySymmetry else None)
+
+    def _getMolmapCacheKey(self, gridMap, resolution=None):
+        """ Cache key of the simulated map of the subtrahend on the grid
+        of gridMap """
+        if resolution is None:
+            resolution = self.resolution.get()
+        return mapcache.cacheKey(
+            molmap=molmap.VERSION,
+            sigmaFactor=molmap.SIGMA_FACTOR,
+            cutoffRange=molmap.CUTOFF_RANGE,
+            resolution=resolution,
+            voxelSize=gridMap.voxelSize,
+            origin=gridMap.origin,
+            shape=gridMap.shape,
+            outputFormat=self.outputFormat.get(),
+            **self._getSubtrahendCacheFields())
+
+    def _getNativeAtoms(self, removeResidues=True):
+        """ Atoms of the subtrahend after chain selection and removal of
+        residues, as done by runChimeraStep """
+        if getattr(self, '_nativeAtoms', None) is None:
+            self._nativeAtoms = atoms.readAtoms(self.atomStructName)
+        allAtoms = self._nativeAtoms
+        if self.selectedChain is None:
+            return allAtoms
+        if self.selectChain:
+            allAtoms = atoms.selectAtoms(allAtoms, int(self.selectedModel),
+                                         self.selectedChain)
+        if self.removeResidues and removeResidues:
+            idxRemove = self.getIdxRemoveResidues()
+            if idxRemove is not None:
+                allAtoms = atoms.removeResidues(allAtoms, self.selectedChain,
+                                                idxRemove[0], idxRemove[1])
+        return allAtoms
+
+    def _getNativeSubtrahendAtoms(self, removeResidues=True):
+        """ _getNativeAtoms with the symmetry copies if symmetry is
+        applied. The copies are read from the map cache if they were
+        computed before """
+        if not self.applySymmetry:
+            return self._getNativeAtoms(removeResidues)
+        if not hasattr(self, '_nativeCopies'):
+            self._nativeCopies = {}
+        if removeResidues not in self._nativeCopies:
+            cache = Plugin.getMapCache() if self.useMapCache else None
+            key = (mapcache.cacheKey(
+                **self._getSubtrahendCacheFields(removeResidues))
+                if cache is not None else None)
+            fileName = os.path.abspath(self._getTmpPath('symmetry.npy'))
+            if cache is not None and cache.fetch(key, fileName, '.npy'):
+                self._log.info("Symmetrized structure read from cache %s"
+                               % cache.directory)
+                copies = np.load(fileName)
+            else:
+                copies = symmetry.symmetrize(
+                    self._getNativeAtoms(removeResidues),
+                    CHIMERA_SYM_NAME[self.symmetryGroup.get()],
+                    self.symmetryOrder.get(), rangeDist=self.rangeDist.get())
+                if cache is not None:
+                    np.save(fileName, copies)
+                    cache.put(key, fileName, '.npy')
+            self._nativeCopies[removeResidues] = copies
+        return self._nativeCopies[removeResidues]
+
+    def _writeNativeCopies(self, fileName):
+        """ Write the symmetry copies as mmCIF, copied from the map cache
+        if they were written before """
+        cache = Plugin.getMapCache() if self.useMapCache else None
+        key = (mapcache.cacheKey(**self._getSubtrahendCacheFields())
+               if cache is not None else None)
+        if cache is not None and cache.fetch(key, fileName, '.cif'):
+            self._log.info("Symmetrized structure read from cache %s"
+                           % cache.directory)
+            return
+        atoms.writeCif(self._getNativeSubtrahendAtoms(), fileName)
+        if cache is not None:
+            cache.put(key, fileName, '.cif')
+
+    def _getNativeMapFileName(self, prefix, modelId,
+                              template=chimeraMapTemplateFileName):
+        """ Same file name that scipionwrite gives to model #modelId. The
+        maps are registered as outputs, so they are never compressed """
+        fileName = template % self.getObjId()
+        return os.path.abspath(self._getExtraPath(
+            prefix + fileName.replace("__", "__%d_" % modelId)))
+
+    def _addToManifest(self, *fileNames):
+        """ Add the maps and structures written by the native engine to
+        the manifest, as scipionwrite does for the models saved by
+        ChimeraX. Their checksum is not computed. """
+        directory = self._getExtraPath()
+        for fileName in fileNames:
+            manifest.writeEntry(directory, manifest.fileEntry(
+                fileName, directory, checksum=False))
 
     def getIdxRemoveResidues(self):
         resJson = getattr(self, 'residuesToRemove').get()
@@ -636,14 +1245,20 @@ class ChimeraSubtractionMaps(EMProtocol):
     def _summary(self):
         summary = []
         if self.getOutputsSize() > 0:
-            directory = self._getExtraPath()
+            entries = manifest.outputEntries(self._getExtraPath())
             summary.append("Produced files:")
-            for filename in sorted(os.listdir(directory)):
-                if filename.endswith(".pdb"):
-                    summary.append(filename)
-            for filename in sorted(os.listdir(directory)):
-                if filename.endswith(".mrc"):
-                    summary.append(filename)
+            for outputType in (manifest.ATOM_STRUCT, manifest.MAP):
+                summary.extend(entry['path'] for entry in entries
+                               if entry['type'] == outputType)
+            if self.getPreviewBinning() > 1:
+                summary.append("Preview computed on maps binned %dx"
+                               % self.getPreviewBinning())
+            if os.path.exists(self._getFscFileName()):
+                resolution = maps.fscResolution(
+                    *maps.readFsc(self._getFscFileName()))
+                summary.append("FSC of the half difference maps: %s"
+                               % ("0.143 at %0.2f A" % resolution
+                                  if resolution else "above 0.143"))
             summary.append("we have some result")
         else:
             summary.append(Message.TEXT_NO_OUTPUT_FILES)
@@ -662,5 +1277,10 @@ class ChimeraSubtractionMaps(EMProtocol):
             errors.append("Error: You should provide an additional "
                           "map or an atomic structure.\n")
 
+        if (self.halfMaps and
+                self.inputVolume.get() is not None and
+                not self.inputVolume.get().hasHalfMaps()):
+            errors.append("Error: The input map has no half maps.\n")
+
         return errors
 
@@ -0,0 +1,269 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from pwem.emlib.image import ImageHandler
+from pwem.objects import Volume
+from pwem.protocols import EMProtocol
+from pyworkflow import VERSION_3_0
+from pyworkflow.protocol.constants import LEVEL_ADVANCED
+from pyworkflow.protocol.params import (PointerParam, EnumParam, FloatParam)
+
+from chimera import maps, molmap
+from .protocol_subtraction_maps import ChimeraSubtractionMaps
+
+
+def subtractVolume(task):
+    """ Subtraction (or masking) and filtering of one volume, run in a
+    worker process. Return the minRms scale (None when masking). """
+    scale = None
+    if task['subtractOrMask'] == 0:
+        scale = maps.subtractMaps(
+            task['minuend'], task['subtrahend'], task['difference'],
+            minRms=True, minuendVoxelSize=task['sampling'],
+            minuendOrigin=task['origin'],
+            subtrahendVoxelSize=task['subtrahendSampling'],
+            subtrahendOrigin=task['subtrahendOrigin'],
+            mrcMode=task['mrcMode'])
+    else:
+        maps.maskMap(task['minuend'], task['subtrahend'], task['difference'],
+                     task['level'], minuendVoxelSize=task['sampling'],
+                     minuendOrigin=task['origin'],
+                     maskVoxelSize=task['subtrahendSampling'],
+                     maskOrigin=task['subtrahendOrigin'],
+                     mrcMode=task['mrcMode'])
+    # one FFT thread per worker process
+    if task['filter'] == 0:
+        maps.filterMap(task['difference'], task['filtered'], 'gaussian',
+                       task['width'], workers=1, mrcMode=task['mrcMode'])
+    else:
+        maps.filterMap(task['difference'], task['filtered'], 'laplacian',
+                       workers=1, mrcMode=task['mrcMode'])
+    return scale
+
+
+class ChimeraSubtractionMapsBatch(EMProtocol):
+    """Protocol to subtract the same map, or the map derived from an
+        atomic structure, from every volume of a set (for instance the
+        classes of a 3D classification).
+        The subtrahend is computed once and the volumes are processed in
+        parallel without launching ChimeraX."""
+    _label = 'batch map subtraction'
+    _program = ""
+    _version = VERSION_3_0
+
+    @classmethod
+    def getClassPackageName(cls):
+        return "chimerax"
+
+    # --------------------------- DEFINE param functions --------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputVolumes', PointerParam,
+                      pointerClass="SetOfVolumes",
+                      label='Input 3D Maps',
+                      important=True,
+                      help="Difference 3D map = minuend − subtrahend.\n"
+                           "Each volume of this set is a minuend.")
+        form.addParam('subtractOrMask', EnumParam,
+                      choices=ChimeraSubtractionMaps.PROTOCOL_OPTIONS,
+                      display=EnumParam.DISPLAY_HLIST,
+                      default=0,
+                      label='Select the operation to perform',
+                      help='You can select "Subtract" to get the result '
+                           'minuend − subtrahend, or "Mask" to set to 0 '
+                           'the minuend voxels where the subtrahend is '
+                           'greater than the level.')
+        form.addParam('level', FloatParam,
+                      condition='subtractOrMask==1',
+                      default=0.001,
+                      label='Contour level (subtrahend)',
+                      help='Voxels of the minuend where the subtrahend is '
+                           'above this level are masked.')
+        form.addParam('mapOrModel', EnumParam,
+                      choices=ChimeraSubtractionMaps.MAP_OPTIONS,
+                      display=EnumParam.DISPLAY_HLIST,
+                      default=0, label='Subtraction/Mask of',
+                      help="Subtrahend 3D map may be provided by the user "
+                           "(choose '3D map') or created from an atomic "
+                           "coordinates file (choose 'atomic structure').")
+        form.addParam('inputVolume2', PointerParam, pointerClass="Volume",
+                      condition='mapOrModel==0',
+                      important=True, allowsNull=True,
+                      label='Map to subtract (subtrahend)',
+                      help="Map that has to be subtracted from every "
+                           "minuend.")
+        form.addParam('resolution', FloatParam,
+                      condition='mapOrModel==1',
+                      label='Map resolution (A):',
+                      help="The atomic structure file will be used to "
+                           "create a 3D map on the grid of the first input "
+                           "volume. Each atom is described as a 3D Gaussian "
+                           "of width proportional to the resolution and "
+                           "amplitude proportional to the atomic number.")
+        form.addParam('pdbFileToBeRefined', PointerParam,
+                      pointerClass="AtomStruct", allowsNull=True,
+                      condition='mapOrModel==1',
+                      important=True,
+                      label='Atomic structure',
+                      help="Atomic structure to derive a 3D map that will "
+                           "be subtracted from every minuend.")
+        form.addParam("filterToApplyToDiffMap", EnumParam,
+                      expertLevel=LEVEL_ADVANCED,
+                      choices=['Gaussian', 'Laplacian'],
+                      display=EnumParam.DISPLAY_HLIST,
+                      label="Filter to apply to the differential maps",
+                      default=0,
+                      help="Choose the filter to clean the background noise "
+                           "of the differential maps.")
+        form.addParam("widthFilter", FloatParam,
+                      condition='filterToApplyToDiffMap==0',
+                      expertLevel=LEVEL_ADVANCED,
+                      label="Gaussian filter width",
+                      default=1.5,
+                      help="Set the width (A) of the Gaussian filter.")
+        form.addParam('outputFormat', EnumParam,
+                      expertLevel=LEVEL_ADVANCED,
+                      choices=[label for label, _, _ in maps.OUTPUT_FORMATS],
+                      display=EnumParam.DISPLAY_HLIST,
+                      label="Format of the output maps",
+                      default=0,
+                      help="'float16' writes the simulated, difference and "
+                           "filtered maps in MRC mode 12, half the size of "
+                           "float32 maps. 'float16 compressed' also "
+                           "compresses with gzip (.mrc.gz) the map simulated "
+                           "from the atomic structure, which is kept in the "
+                           "extra folder but not registered. The difference "
+                           "maps are always plain MRC files.")
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- INSERT steps functions --------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('subtrahendStep')
+        self._insertFunctionStep('subtractStep')
+        self._insertFunctionStep('createOutputStep')
+
+    # --------------------------- STEPS functions ---------------------------
+    def subtrahendStep(self):
+        if self.mapOrModel == 0:
+            return
+        # simulated map on the grid of the first volume, other grids are
+        # interpolated by the subtraction
+        vol = self.inputVolumes.get().getFirstItem()
+        with maps.openMap(ImageHandler.removeFileType(vol.getFileName()),
+                          vol.getSamplingRate(),
+                          vol.getShiftsFromOrigin()) as gridMap:
+            molmap.molmap(self.pdbFileToBeRefined.get().getFileName(),
+                          self.resolution.get(), self._getSubtrahendFileName(),
+                          gridMap, threads=self.numberOfThreads.get(),
+                          mrcMode=maps.outputMode(self.outputFormat.get()))
+
+    def subtractStep(self):
+        if self.mapOrModel == 0:
+            subVol = self.inputVolume2.get()
+        else:  # molmap is on the grid of the first volume
+            subVol = self.inputVolumes.get().getFirstItem()
+        subtrahendSampling = subVol.getSamplingRate()
+        subtrahendOrigin = subVol.getShiftsFromOrigin()
+        tasks = []
+        for vol in self.inputVolumes.get():
+            objId = vol.getObjId()
+            tasks.append({
+                'minuend': ImageHandler.removeFileType(vol.getFileName()),
+                'sampling': vol.getSamplingRate(),
+                'origin': vol.getShiftsFromOrigin(),
+                'subtrahend': self._getSubtrahendFileName(),
+                'subtrahendSampling': subtrahendSampling,
+                'subtrahendOrigin': subtrahendOrigin,
+                'subtractOrMask': self.subtractOrMask.get(),
+                'level': self.level.get(),
+                'difference': self._getOutputFileName('difference', objId),
+                'filtered': self._getOutputFileName('filtered', objId),
+                'filter': self.filterToApplyToDiffMap.get(),
+                'width': self.widthFilter.get(),
+                'mrcMode': maps.outputMode(self.outputFormat.get())})
+        workers = max(1, min(self.numberOfThreads.get(), len(tasks)))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for task, scale in zip(tasks, executor.map(subtractVolume,
+                                                       tasks)):
+                if scale is not None:
+                    self._log.info("%s: subtrahend scaled by %f"
+                                   % (os.path.basename(task['minuend']),
+                                      scale))
+
+    def createOutputStep(self):
+        inputVolumes = self.inputVolumes.get()
+        outputs = {}
+        for prefix, suffix in [('difference', 'Differences'),
+                               ('filtered', 'Filtered')]:
+            volumes = self._createSetOfVolumes(suffix)
+            volumes.copyInfo(inputVolumes)
+            for vol in inputVolumes:
+                outVol = Volume()
+                outVol.copyInfo(vol)
+                outVol.setObjId(vol.getObjId())
+                outVol.setFileName(self._getOutputFileName(prefix,
+                                                           vol.getObjId()))
+                outVol.setOrigin(vol.getOrigin(force=True))
+                volumes.append(outVol)
+            outputs['output%s' % suffix] = volumes
+        self._defineOutputs(**outputs)
+        for volumes in outputs.values():
+            self._defineSourceRelation(self.inputVolumes, volumes)
+
+    # --------------------------- UTILS functions ---------------------------
+    def _getSubtrahendFileName(self):
+        if self.mapOrModel == 0:
+            return ImageHandler.removeFileType(
+                os.path.abspath(self.inputVolume2.get().getFileName()))
+        return maps.outputFileName(
+            os.path.abspath(self._getExtraPath('molmap.mrc')),
+            self.outputFormat.get(), output=False)
+
+    def _getOutputFileName(self, prefix, objId):
+        return os.path.abspath(self._getExtraPath('%s_%03d.mrc'
+                                                  % (prefix, objId)))
+
+    # --------------------------- INFO functions ----------------------------
+    def _summary(self):
+        summary = []
+        if self.hasAttribute('outputDifferences'):
+            summary.append("%d difference maps and their filtered versions"
+                           % self.outputDifferences.getSize())
+            for fileName in maps.compressedMaps(self._getExtraPath()):
+                summary.append("%s (not registered)" % fileName)
+        return summary
+
+    def _validate(self):
+        errors = []
+        if self.mapOrModel == 0 and self.inputVolume2.get() is None:
+            errors.append("Error: You should provide a map to subtract.\n")
+        if self.mapOrModel == 1 and self.pdbFileToBeRefined.get() is None:
+            errors.append("Error: You should provide an atomic "
+                          "structure.\n")
+        return errors
@@ -0,0 +1,228 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from pwem.emlib.image import ImageHandler
+from pwem.objects import Volume
+from pwem.protocols import EMProtocol
+from pyworkflow import VERSION_3_0
+from pyworkflow.protocol.constants import LEVEL_ADVANCED
+from pyworkflow.protocol.params import (PointerParam, EnumParam, FloatParam,
+                                        BooleanParam)
+
+from chimera import maps, molmap, atoms
+from .protocol_subtraction_maps import ChimeraSubtractionMaps
+from .protocol_subtraction_maps_batch import subtractVolume
+
+
+class ChimeraSubtractionMapsChains(EMProtocol):
+    """Protocol to subtract, chain by chain, the maps derived from an
+        atomic structure from a map.
+        The simulated maps of all the chains are computed in a single
+        pass over the atoms and the difference maps are computed in
+        parallel without launching ChimeraX. With 'leave one chain out'
+        everything but each chain is subtracted, so that the difference
+        map keeps the density of that chain."""
+    _label = 'map subtraction per chain'
+    _program = ""
+    _version = VERSION_3_0
+
+    @classmethod
+    def getClassPackageName(cls):
+        return "chimerax"
+
+    # --------------------------- DEFINE param functions --------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputVolume', PointerParam, pointerClass="Volume",
+                      label='Input 3D Map',
+                      important=True,
+                      help="Difference 3D map = minuend − subtrahend.\n"
+                           "This map is the minuend.")
+        form.addParam('pdbFileToBeRefined', PointerParam,
+                      pointerClass="AtomStruct",
+                      important=True,
+                      label='Atomic structure',
+                      help="A map is simulated for each chain of this "
+                           "atomic structure.")
+        form.addParam('resolution', FloatParam,
+                      label='Map resolution (A):',
+                      help="Each atom is described as a 3D Gaussian of width "
+                           "proportional to the resolution and amplitude "
+                           "proportional to the atomic number.")
+        form.addParam('leaveOneOut', BooleanParam, default=False,
+                      label='Leave one chain out',
+                      help="If 'No', the map of each chain is subtracted. "
+                           "If 'Yes', the map of all the other chains is "
+                           "subtracted.")
+        form.addParam('subtractOrMask', EnumParam,
+                      choices=ChimeraSubtractionMaps.PROTOCOL_OPTIONS,
+                      display=EnumParam.DISPLAY_HLIST,
+                      default=0,
+                      label='Select the operation to perform',
+                      help='You can select "Subtract" to get the result '
+                           'minuend − subtrahend, or "Mask" to set to 0 '
+                           'the minuend voxels where the subtrahend is '
+                           'greater than the level.')
+        form.addParam('level', FloatParam,
+                      condition='subtractOrMask==1',
+                      default=0.001,
+                      label='Contour level (subtrahend)',
+                      help='Voxels of the minuend where the subtrahend is '
+                           'above this level are masked.')
+        form.addParam("filterToApplyToDiffMap", EnumParam,
+                      expertLevel=LEVEL_ADVANCED,
+                      choices=['Gaussian', 'Laplacian'],
+                      display=EnumParam.DISPLAY_HLIST,
+                      label="Filter to apply to the differential maps",
+                      default=0,
+                      help="Choose the filter to clean the background noise "
+                           "of the differential maps.")
+        form.addParam("widthFilter", FloatParam,
+                      condition='filterToApplyToDiffMap==0',
+                      expertLevel=LEVEL_ADVANCED,
+                      label="Gaussian filter width",
+                      default=1.5,
+                      help="Set the width (A) of the Gaussian filter.")
+        form.addParam('outputFormat', EnumParam,
+                      expertLevel=LEVEL_ADVANCED,
+                      choices=[label for label, _, _ in maps.OUTPUT_FORMATS],
+                      display=EnumParam.DISPLAY_HLIST,
+                      label="Format of the output maps",
+                      default=0,
+                      help="'float16' writes the simulated, difference and "
+                           "filtered maps of the chains in MRC mode 12, half "
+                           "the size of float32 maps. 'float16 compressed' "
+                           "also compresses with gzip (.mrc.gz) the "
+                           "simulated map of each chain, which is kept in "
+                           "the extra folder but not registered. The "
+                           "difference maps are always plain MRC files.")
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- INSERT steps functions --------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('molmapStep')
+        self._insertFunctionStep('subtractStep')
+        self._insertFunctionStep('createOutputStep')
+
+    # --------------------------- STEPS functions ---------------------------
+    def molmapStep(self):
+        vol = self.inputVolume.get()
+        structure = atoms.readAtoms(self.pdbFileToBeRefined.get().getFileName())
+        chains, groups = atoms.chainGroups(structure)
+        self._log.info("Simulating the maps of chains %s" % ', '.join(chains))
+        with maps.openMap(ImageHandler.removeFileType(vol.getFileName()),
+                          vol.getSamplingRate(),
+                          vol.getShiftsFromOrigin()) as gridMap:
+            molmap.molmapGroups(structure, groups, self.resolution.get(),
+                                [self._getOutputFileName('molmap', chain)
+                                 for chain in chains],
+                                gridMap, complement=self.leaveOneOut.get(),
+                                threads=self.numberOfThreads.get(),
+                                mrcMode=maps.outputMode(
+                                    self.outputFormat.get()))
+
+    def subtractStep(self):
+        vol = self.inputVolume.get()
+        tasks = []
+        for chain in self._getChains():
+            tasks.append({
+                'minuend': ImageHandler.removeFileType(vol.getFileName()),
+                'sampling': vol.getSamplingRate(),
+                'origin': vol.getShiftsFromOrigin(),
+                'subtrahend': self._getOutputFileName('molmap', chain),
+                'subtrahendSampling': vol.getSamplingRate(),
+                'subtrahendOrigin': vol.getShiftsFromOrigin(),
+                'subtractOrMask': self.subtractOrMask.get(),
+                'level': self.level.get(),
+                'difference': self._getOutputFileName('difference', chain),
+                'filtered': self._getOutputFileName('filtered', chain),
+                'filter': self.filterToApplyToDiffMap.get(),
+                'width': self.widthFilter.get(),
+                'mrcMode': maps.outputMode(self.outputFormat.get())})
+        workers = max(1, min(self.numberOfThreads.get(), len(tasks)))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for chain, scale in zip(self._getChains(),
+                                    executor.map(subtractVolume, tasks)):
+                if scale is not None:
+                    self._log.info("chain %s: subtrahend scaled by %f"
+                                   % (chain, scale))
+
+    def createOutputStep(self):
+        inputVol = self.inputVolume.get()
+        outputs = {}
+        for prefix, suffix in [('difference', 'Differences'),
+                               ('filtered', 'Filtered')]:
+            volumes = self._createSetOfVolumes(suffix)
+            volumes.setSamplingRate(inputVol.getSamplingRate())
+            for chain in self._getChains():
+                vol = Volume()
+                vol.setFileName(self._getOutputFileName(prefix, chain))
+                vol.setSamplingRate(inputVol.getSamplingRate())
+                vol.setOrigin(inputVol.getOrigin(force=True))
+                vol.setObjComment('chain %s' % chain)
+                volumes.append(vol)
+            outputs['output%s' % suffix] = volumes
+        self._defineOutputs(**outputs)
+        for volumes in outputs.values():
+            self._defineSourceRelation(self.inputVolume, volumes)
+            self._defineSourceRelation(self.pdbFileToBeRefined, volumes)
+
+    # --------------------------- UTILS functions ---------------------------
+    def _getChains(self):
+        if not hasattr(self, '_chains'):
+            structure = atoms.readAtoms(
+                self.pdbFileToBeRefined.get().getFileName())
+            self._chains = list(atoms.chainGroups(structure)[0])
+        return self._chains
+
+    def _getOutputFileName(self, prefix, chain):
+        return maps.outputFileName(
+            os.path.abspath(self._getExtraPath('%s_chain%s.mrc'
+                                               % (prefix, chain))),
+            self.outputFormat.get(), output=prefix != 'molmap')
+
+    # --------------------------- INFO functions ----------------------------
+    def _summary(self):
+        summary = []
+        if self.hasAttribute('outputDifferences'):
+            summary.append("%d difference maps (%s) and their filtered "
+                           "versions"
+                           % (self.outputDifferences.getSize(),
+                              'leave one chain out' if self.leaveOneOut
+                              else 'one chain subtracted'))
+            for fileName in maps.compressedMaps(self._getExtraPath()):
+                summary.append("%s (not registered)" % fileName)
+        return summary
+
+    def _validate(self):
+        errors = []
+        if self.resolution.get() is None:
+            errors.append("Error: You should provide the resolution of the "
+                          "simulated maps.\n")
+        return errors
@@ -0,0 +1,180 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+
+import numpy as np
+
+from pwem.emlib.image import ImageHandler
+from pwem.objects import EMFile
+from pwem.protocols import EMProtocol
+from pyworkflow import VERSION_3_0
+from pyworkflow.protocol.constants import LEVEL_ADVANCED
+from pyworkflow.protocol.params import (PointerParam, FloatParam, IntParam,
+                                        StringParam)
+
+from chimera import maps, molmap, atoms, scan
+
+
+class ChimeraSubtractionMapsScan(EMProtocol):
+    """Protocol to scan a chain of an atomic structure with a window of
+        residues. For each window the map of the structure without the
+        window residues is subtracted from the input map and the density
+        left around the window is measured, which gives a per residue
+        profile of the map support of the model.
+        The simulated map of the whole structure is computed once and
+        only the contribution of the window atoms is removed for each
+        window, without launching ChimeraX."""
+    _label = 'residue window scan'
+    _program = ""
+    _version = VERSION_3_0
+
+    @classmethod
+    def getClassPackageName(cls):
+        return "chimerax"
+
+    # --------------------------- DEFINE param functions --------------------
+    def _defineParams(self, form):
+        form.addSection(label='Input')
+        form.addParam('inputVolume', PointerParam, pointerClass="Volume",
+                      label='Input 3D Map',
+                      important=True,
+                      help="Map (minuend) where the residues are checked.")
+        form.addParam('pdbFileToBeRefined', PointerParam,
+                      pointerClass="AtomStruct",
+                      important=True,
+                      label='Atomic structure',
+                      help="Atomic structure fitted in the input map.")
+        form.addParam('inputStructureChain', StringParam,
+                      label="Chain ", important=True,
+                      help="Select the chain of the atomic structure to "
+                           "scan.")
+        form.addParam('resolution', FloatParam,
+                      label='Map resolution (A):',
+                      help="Resolution of the map simulated from the "
+                           "atomic structure.")
+        form.addParam('windowSize', IntParam, default=5,
+                      label='Window size (residues)',
+                      help="Number of consecutive residues removed from the "
+                           "atomic structure in each window.")
+        form.addParam('windowStep', IntParam, default=1,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Window step (residues)',
+                      help="Number of residues between the first residues "
+                           "of consecutive windows.")
+        form.addParam('radius', FloatParam, default=2.,
+                      expertLevel=LEVEL_ADVANCED,
+                      label='Atom radius (A)',
+                      help="The statistics of each window are computed on "
+                           "the voxels within this distance of the window "
+                           "atoms.")
+
+    # --------------------------- INSERT steps functions --------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('molmapStep')
+        self._insertFunctionStep('scanStep')
+        self._insertFunctionStep('createOutputStep')
+
+    # --------------------------- STEPS functions ---------------------------
+    def molmapStep(self):
+        with self._openInputMap() as minuend:
+            molmap.molmap(self._getAtoms(), self.resolution.get(),
+                          self._getMolmapFileName(), minuend)
+
+    def scanStep(self):
+        chain = self._parseChain()[1]
+        with self._openInputMap() as minuend, \
+                maps.openMap(self._getMolmapFileName()) as full:
+            records = scan.windowScan(minuend, full, self._getAtoms(), chain,
+                                      self.windowSize.get(),
+                                      self.resolution.get(),
+                                      self.radius.get(),
+                                      self.windowStep.get())
+        scan.writeScan(self._getScanFileName(), records)
+        scan.writeProfile(self._getProfileFileName(), records)
+        self._log.info("%d windows of chain %s scanned"
+                       % (len(records), chain))
+
+    def createOutputStep(self):
+        self._defineOutputs(windowScan=EMFile(self._getScanFileName()),
+                            residueProfile=EMFile(self._getProfileFileName()))
+        self._defineSourceRelation(self.inputVolume, self.residueProfile)
+        self._defineSourceRelation(self.pdbFileToBeRefined,
+                                   self.residueProfile)
+
+    # --------------------------- UTILS functions ---------------------------
+    def _parseChain(self):
+        """ (model index, chain id) from the chain wizard """
+        chainJson = self.inputStructureChain.get()
+        model = chainJson.split(',')[0].split(':')[1].strip()
+        chain = chainJson.split(',')[1].split(':')[1].strip().split('"')[1]
+        return model, chain
+
+    def _getAtoms(self):
+        """ Atoms of the model of the selected chain """
+        if not hasattr(self, '_atoms'):
+            structure = atoms.readAtoms(
+                self.pdbFileToBeRefined.get().getFileName())
+            self._atoms = atoms.selectAtoms(structure, self._parseChain()[0])
+        return self._atoms
+
+    def _openInputMap(self):
+        vol = self.inputVolume.get()
+        return maps.openMap(ImageHandler.removeFileType(vol.getFileName()),
+                            vol.getSamplingRate(), vol.getShiftsFromOrigin())
+
+    def _getMolmapFileName(self):
+        return os.path.abspath(self._getExtraPath('molmap.mrc'))
+
+    def _getScanFileName(self):
+        return os.path.abspath(self._getExtraPath('window_scan.csv'))
+
+    def _getProfileFileName(self):
+        return os.path.abspath(self._getExtraPath('residue_profile.csv'))
+
+    # --------------------------- INFO functions ----------------------------
+    def _summary(self):
+        summary = []
+        if self.hasAttribute('residueProfile'):
+            profile = np.atleast_2d(np.loadtxt(self._getProfileFileName(),
+                                               delimiter=',', skiprows=1))
+            profile = profile[np.isfinite(profile[:, 1])]
+            summary.append("Per residue profile: %s"
+                           % self._getProfileFileName())
+            summary.append("Residues with the lowest density left by their "
+                           "removal:")
+            for residue, value in profile[np.argsort(profile[:, 1])][:5]:
+                summary.append("  %d: %g" % (residue, value))
+        return summary
+
+    def _validate(self):
+        errors = []
+        if not self.inputStructureChain.get():
+            errors.append("Error: You should select a chain.\n")
+        if self.windowSize.get() < 1 or self.windowStep.get() < 1:
+            errors.append("Error: The window size and step should be "
+                          "positive.\n")
+        return errors
@@ -0,0 +1,318 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from pwem.emlib.image import ImageHandler
+from pwem.objects import Volume, Transform
+from pyworkflow.protocol.params import StringParam
+
+from chimera import Plugin, maps, molmap, atoms
+from .protocol_subtraction_maps import ChimeraSubtractionMaps
+
+
+def differenceTask(task):
+    """ Subtraction or masking of one combination, run in a worker
+    process """
+    if task['mask']:
+        maps.maskMap(task['minuend'], task['subtrahend'], task['difference'],
+                     task['level'], minuendVoxelSize=task['sampling'],
+                     minuendOrigin=task['origin'],
+                     maskVoxelSize=task['sampling'],
+                     maskOrigin=task['subtrahendOrigin'],
+                     memory=task['memory'], mrcMode=task['mrcMode'])
+    else:
+        maps.subtractMaps(task['minuend'], task['subtrahend'],
+                          task['difference'], minRms=True,
+                          minuendVoxelSize=task['sampling'],
+                          minuendOrigin=task['origin'],
+                          subtrahendVoxelSize=task['sampling'],
+                          subtrahendOrigin=task['subtrahendOrigin'],
+                          memory=task['memory'], mrcMode=task['mrcMode'])
+
+
+def filterTask(task):
+    """ Filtering of one difference map, run in a worker process """
+    if task['width'] is None:
+        maps.filterMap(task['difference'], task['filtered'], 'laplacian',
+                       memory=task['memory'], workers=1,
+                       mrcMode=task['mrcMode'])
+    else:
+        maps.filterMap(task['difference'], task['filtered'], 'gaussian',
+                       task['width'], memory=task['memory'], workers=1,
+                       mrcMode=task['mrcMode'])
+
+
+class ChimeraSubtractionMapsSweep(ChimeraSubtractionMaps):
+    """Protocol to explore the parameters of the map subtraction.
+        The subtraction is computed without ChimeraX for every
+        combination of the given resolutions, atom radii, contour
+        levels and filter widths. Inputs are loaded once, each simulated
+        map is computed once per resolution and each zone once per
+        radius. All the filtered difference maps are registered in a
+        single set labeled with their parameters."""
+    _label = 'map subtraction sweep'
+
+    def _defineParams(self, form):
+        ChimeraSubtractionMaps._defineParams(self, form)
+        # always native, the native options stay visible
+        useNativeEngine = form.getParam('useNativeEngine')
+        useNativeEngine.default.set(True)
+        useNativeEngine.condition.set('False')
+        # the maps of the sweep stay on the cropped box
+        form.getParam('pasteBack').condition.set('False')
+        # not available in the sweep
+        form.getParam('zScore').condition.set('False')
+        form.getParam('halfMaps').condition.set('False')
+        # only the filtered maps are registered, the others can be compressed
+        outputFormat = form.getParam('outputFormat')
+        outputFormat.choices = [label for label, _, _ in maps.OUTPUT_FORMATS]
+        outputFormat.help.set("'float16' writes the sweep maps in MRC mode "
+                              "12, half the size of float32 maps. 'float16 "
+                              "compressed' also compresses with gzip "
+                              "(.mrc.gz) the simulated, zone and difference "
+                              "maps, which are kept in the extra folder but "
+                              "not registered. The filtered maps are always "
+                              "plain MRC files.")
+        form.addSection(label='Sweep')
+        form.addParam('resolutionValues', StringParam, default='',
+                      condition='mapOrModel==1',
+                      label='Resolutions (A)',
+                      help="Space separated list of resolutions of the "
+                           "simulated map, e.g. '3 4 5'. Empty to use the "
+                           "resolution of the Input tab.")
+        form.addParam('radiusValues', StringParam, default='',
+                      condition='mapOrModel==1 and selectAreaMap==True',
+                      label='Atom radii (A)',
+                      help="Space separated list of radii of the map "
+                           "fraction around the atomic structure. Empty to "
+                           "use the radius of the Input tab.")
+        form.addParam('levelValues', StringParam, default='',
+                      condition='subtractOrMask==1',
+                      label='Contour levels',
+                      help="Space separated list of contour levels of the "
+                           "subtrahend used to mask. Empty to use the level "
+                           "of the Input tab.")
+        form.addParam('widthValues', StringParam, default='',
+                      condition='filterToApplyToDiffMap==0',
+                      label='Gaussian filter widths',
+                      help="Space separated list of widths of the Gaussian "
+                           "filter. Empty to use the width of the Input "
+                           "tab.")
+        form.addParallelSection(threads=4, mpi=0)
+
+    # --------------------------- INSERT steps functions --------------------
+    def _insertAllSteps(self):
+        self._insertFunctionStep('prerequisitesStep')
+        self._insertFunctionStep('sweepStep')
+        self._insertFunctionStep('createSweepOutputStep')
+
+    # --------------------------- STEPS functions ---------------------------
+    def sweepStep(self):
+        sampling = self.vol.getSamplingRate()
+        workers = max(1, self.numberOfThreads.get())
+        memory = self.memoryBudget.get() * 1024 ** 3
+        mrcMode = maps.outputMode(self.outputFormat.get())
+        minuendFileName = ImageHandler.removeFileType(self.fnVolName)
+        minuendOrigin = self.vol.getShiftsFromOrigin()
+        binning = self.getPreviewBinning()
+        if binning > 1:
+            minuendFileName, minuendOrigin = self._binNativeMap(
+                'minuend', minuendFileName, sampling, minuendOrigin)
+            sampling *= binning
+        subtrahends = {}  # resolution -> file name
+        minuends = {None: minuendFileName}  # radius -> file name
+        subOrigin = minuendOrigin
+        if self.mapOrModel == 0:
+            subFileName = ImageHandler.removeFileType(self.subVolName)
+            subOrigin = self.subVol.getShiftsFromOrigin()
+            if binning > 1:
+                subFileName, subOrigin = self._binNativeMap(
+                    'subtrahend', subFileName, self.subVol.getSamplingRate(),
+                    subOrigin)
+            subtrahends[None] = subFileName
+        else:
+            # one simulated map per resolution and one zone per radius,
+            # shared by every combination of the other parameters
+            self._parseNativeChain()
+            if self.autoCrop:
+                minuendFileName, minuendOrigin = self._cropNativeMinuend(
+                    minuendFileName, minuendOrigin, sampling, memory,
+                    max(self._getResolutions()), max(self._getRadii()))
+                subOrigin = minuendOrigin
+                minuends = {None: minuendFileName}
+            cache = Plugin.getMapCache() if self.useMapCache else None
+            with maps.openMap(minuendFileName, sampling,
+                              minuendOrigin) as minuend:
+                for resolution in self._getResolutions():
+                    fileName = self._getSweepFileName(
+                        'molmap', [('resolution', resolution)])
+                    key = self._getMolmapCacheKey(minuend, resolution)
+                    if cache is None or not cache.fetch(key, fileName):
+                        molmap.molmap(self._getNativeSubtrahendAtoms(),
+                                      resolution, fileName, minuend,
+                                      threads=workers, mrcMode=mrcMode,
+                                      memory=memory)
+                        if cache is not None:
+                            cache.put(key, fileName)
+                    subtrahends[resolution] = fileName
+            if self.selectAreaMap:
+                xyz = atoms.coordinates(
+                    self._getNativeSubtrahendAtoms(removeResidues=False))
+                minuends = {}
+                for radius in self._getRadii():
+                    fileName = self._getSweepFileName('zone',
+                                                      [('radius', radius)])
+                    maps.zoneMap(minuendFileName, fileName, xyz, radius,
+                                 sampling, minuendOrigin, memory=memory,
+                                 mrcMode=mrcMode)
+                    minuends[radius] = fileName
+
+        differences = {}
+        filtered = []
+        for labels in self._getSweepCombinations():
+            resolution, radius, level, width = [v for _, v in labels]
+            diffFileName = self._getSweepFileName('difference', labels[:3])
+            if diffFileName not in differences:
+                differences[diffFileName] = {
+                    'mask': self.subtractOrMask == 1, 'level': level,
+                    'minuend': minuends[radius],
+                    'subtrahend': subtrahends[resolution],
+                    'difference': diffFileName, 'sampling': sampling,
+                    'origin': minuendOrigin, 'subtrahendOrigin': subOrigin,
+                    'memory': memory / workers, 'mrcMode': mrcMode}
+            filtered.append({'difference': diffFileName, 'width': width,
+                             'filtered': self._getSweepFileName('filtered',
+                                                                labels),
+                             'memory': memory / workers,
+                             'mrcMode': mrcMode})
+        self._log.info("Computing %d difference maps and %d filtered maps"
+                       % (len(differences), len(filtered)))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(differenceTask, differences.values()))
+            list(executor.map(filterTask, filtered))
+
+    def createSweepOutputStep(self):
+        inputVol = self.inputVolume.get()
+        sampling = inputVol.getSamplingRate() * self.getPreviewBinning()
+        # binned or cropped maps are not on the grid of the input volume
+        sameGrid = self.getPreviewBinning() == 1 and \
+            not (self.mapOrModel == 1 and self.autoCrop)
+        volumes = self._createSetOfVolumes()
+        volumes.setSamplingRate(sampling)
+        for labels in self._getSweepCombinations():
+            vol = Volume()
+            vol.setFileName(self._getSweepFileName('filtered', labels))
+            vol.setSamplingRate(sampling)
+            if sameGrid:
+                vol.setOrigin(inputVol.getOrigin(force=True))
+            else:
+                with maps.openMap(vol.getFileName()) as mapFile:
+                    origin = Transform()
+                    origin.setShiftsTuple(tuple(mapFile.origin))
+                vol.setOrigin(origin)
+            vol.setObjComment(self._getSweepLabel(labels))
+            volumes.append(vol)
+        self._defineOutputs(outputVolumes=volumes)
+        self._defineSourceRelation(self.inputVolume, volumes)
+
+    # --------------------------- UTILS functions ---------------------------
+    def isNative(self):
+        return True
+
+    @staticmethod
+    def _parseValues(text, default):
+        """ Floats of a space or comma separated list, [default] if empty """
+        values = [float(v) for v in (text or '').replace(',', ' ').split()]
+        return values or [default]
+
+    def _getResolutions(self):
+        return self._parseValues(self.resolutionValues.get(),
+                                 self.resolution.get())
+
+    def _getRadii(self):
+        return self._parseValues(self.radiusValues.get(),
+                                 self.radius.get())
+
+    def _getLevels(self):
+        return self._parseValues(self.levelValues.get(),
+                                 self.level.get())
+
+    def _getWidths(self):
+        return self._parseValues(self.widthValues.get(),
+                                 self.widthFilter.get())
+
+    def _getSweepCombinations(self):
+        """ [(name, value)] of resolution, radius, level and width for every
+        filtered map. Values that are not used are None. """
+        model = self.mapOrModel == 1
+        resolutions = self._getResolutions() if model else [None]
+        radii = self._getRadii() if model and self.selectAreaMap else [None]
+        levels = self._getLevels() if self.subtractOrMask == 1 else [None]
+        widths = (self._getWidths() if self.filterToApplyToDiffMap.get() == 0
+                  else [None])
+        return [list(zip(('resolution', 'radius', 'level', 'width'), values))
+                for values in itertools.product(resolutions, radii, levels,
+                                                widths)]
+
+    @staticmethod
+    def _getSweepLabel(labels):
+        return ' '.join('%s=%g' % (name, value) for name, value in labels
+                        if value is not None)
+
+    def _getSweepFileName(self, prefix, labels):
+        """ Extra file name with the parameter values, e.g.
+        difference_resolution4_level0.01.mrc """
+        suffix = ''.join('_%s%g' % (name, value) for name, value in labels
+                         if value is not None)
+        return maps.outputFileName(
+            os.path.abspath(self._getExtraPath(prefix + suffix + '.mrc')),
+            self.outputFormat.get(), output=prefix == 'filtered')
+
+    # --------------------------- INFO functions ----------------------------
+    def _summary(self):
+        summary = []
+        if self.hasAttribute('outputVolumes'):
+            summary.append("%d filtered difference maps:"
+                           % self.outputVolumes.getSize())
+            for vol in self.outputVolumes:
+                summary.append(vol.getObjComment())
+            for fileName in maps.compressedMaps(self._getExtraPath()):
+                summary.append("%s (not registered)" % fileName)
+        return summary
+
+    def _validate(self):
+        errors = ChimeraSubtractionMaps._validate(self)
+        for name in ('resolutionValues', 'radiusValues', 'levelValues',
+                     'widthValues'):
+            try:
+                self._parseValues(getattr(self, name).get(), None)
+            except ValueError:
+                errors.append("Error: %s should be a list of numbers.\n"
+                              % self.getDefinitionParam(name).label.get())
+        return errors
@@ -0,0 +1,169 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Residue window scan of difference maps for local validation.
+
+A window of residues slides along a chain. For each window the map of the
+structure without the window is F - W, where F is the simulated map of
+the whole structure and W the map of the window atoms, which is only
+computed in the bounding box of the window. The minRms scale of the
+subtraction is also updated incrementally:
+
+    f = (sum(m F) - sum(m W)) / (sum(F F) - 2 sum(F W) + sum(W W))
+
+where every term with W only involves the box, so each window costs a
+small molmap and the difference map is evaluated where it changes.
+Statistics are taken on the voxels within a radius of the window atoms.
+"""
+
+import numpy as np
+
+from . import maps, molmap
+from .atoms import coordinates, atomicNumbers
+
+WINDOW_DTYPE = np.dtype([('first', np.int32), ('last', np.int32),
+                         ('scale', np.float64), ('voxels', np.int64),
+                         ('mapMean', np.float64), ('diffMean', np.float64),
+                         ('diffStd', np.float64), ('diffMax', np.float64)])
+
+
+def _fullSums(minuend, full, slabSize=maps.SLAB_SIZE):
+    mf = ff = 0.
+    for z0, z1 in maps.iterSlabs(minuend.shape[0], slabSize):
+        m = minuend.data[z0:z1].astype(np.float64)
+        f = full.data[z0:z1].astype(np.float64)
+        mf += np.vdot(m, f)
+        ff += np.vdot(f, f)
+    return mf, ff
+
+
+def _box(xyz, voxelSize, origin, margin, shape):
+    """ (low, high) (z, y, x) grid indices of the box around xyz """
+    ijk = (xyz - origin) / voxelSize
+    low = np.floor(ijk.min(axis=0)).astype(int) - margin
+    high = np.ceil(ijk.max(axis=0)).astype(int) + margin + 1
+    low = np.clip(low[::-1], 0, shape)
+    high = np.clip(high[::-1], 0, shape)
+    return low, high
+
+
+def windowStats(minuend, full, xyz, weights, resolution, radius, sums):
+    """ (scale, voxels, mapMean, diffMean, diffStd, diffMax) of the
+    difference minuend - f (full - window) within radius of the window
+    atoms xyz.
+
+    :param minuend, full: maps.MapFile on the same grid
+    :param sums: (sum(m F), sum(F F)) over the whole grid
+    """
+    from scipy.spatial import cKDTree
+
+    voxelSize, origin = minuend.voxelSize, minuend.origin
+    sigma = molmap.SIGMA_FACTOR * resolution
+    margin = np.ceil(np.maximum(molmap.CUTOFF_RANGE * sigma, radius) /
+                     voxelSize).astype(int) + 1
+    low, high = _box(xyz, voxelSize, origin, margin, minuend.shape)
+    if np.any(high <= low):
+        return np.nan, 0, np.nan, np.nan, np.nan, np.nan
+    region = tuple(slice(l, h) for l, h in zip(low, high))
+    boxOrigin = origin + low[::-1] * voxelSize
+    w = molmap.molmapOnGrid(xyz, weights, resolution, tuple(high - low),
+                            voxelSize, boxOrigin, threads=1)
+    w = w.astype(np.float64)
+    m = minuend.data[region].astype(np.float64)
+    f = full.data[region].astype(np.float64)
+    mf, ff = sums
+    denominator = ff - 2 * np.vdot(f, w) + np.vdot(w, w)
+    scale = (mf - np.vdot(m, w)) / denominator if denominator > 0 else 0.
+    diff = m - scale * (f - w)
+    k, j, i = np.indices(diff.shape)
+    points = boxOrigin + np.stack((i, j, k), axis=-1).reshape(-1, 3) * \
+        voxelSize
+    distances, _ = cKDTree(xyz).query(points, distance_upper_bound=radius)
+    zone = np.isfinite(distances)
+    if not zone.any():
+        return scale, 0, np.nan, np.nan, np.nan, np.nan
+    values = diff.ravel()[zone]
+    return (scale, int(zone.sum()), float(m.ravel()[zone].mean()),
+            float(values.mean()), float(values.std()), float(values.max()))
+
+
+def windowScan(minuend, full, atoms, chain, windowSize, resolution,
+               radius=2., step=1):
+    """ Statistics of the difference maps of the structure without each
+    window of windowSize consecutive residues of a chain.
+
+    :param minuend: maps.MapFile of the experimental map
+    :param full: maps.MapFile of the simulated map of atoms on the same grid
+    :param atoms: structured array as in chimera.atoms
+    :return: array of WINDOW_DTYPE, one row per window
+    """
+    sums = _fullSums(minuend, full)
+    chainAtoms = atoms[atoms['chain'] == chain]
+    residues = np.unique(chainAtoms['resSeq'])
+    xyz = coordinates(chainAtoms)
+    weights = atomicNumbers(chainAtoms)
+    lastStart = max(len(residues) - windowSize, 0)
+    starts = list(range(0, lastStart + 1, step))
+    if starts[-1] != lastStart:  # the last residues are always scanned
+        starts.append(lastStart)
+    records = np.zeros(len(starts), dtype=WINDOW_DTYPE)
+    for row, start in zip(records, starts):
+        window = residues[start:start + windowSize]
+        mask = np.isin(chainAtoms['resSeq'], window)
+        row['first'], row['last'] = window[0], window[-1]
+        (row['scale'], row['voxels'], row['mapMean'], row['diffMean'],
+         row['diffStd'], row['diffMax']) = windowStats(
+            minuend, full, xyz[mask], weights[mask], resolution, radius,
+            sums)
+    return records
+
+
+def residueProfile(records):
+    """ (residues, values): mean of diffMean over the windows that contain
+    each residue """
+    residues = np.arange(records['first'].min(), records['last'].max() + 1)
+    total = np.zeros(len(residues))
+    count = np.zeros(len(residues))
+    for row in records:
+        if np.isfinite(row['diffMean']):
+            inside = (residues >= row['first']) & (residues <= row['last'])
+            total[inside] += row['diffMean']
+            count[inside] += 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return residues, total / count
+
+
+def writeScan(fileName, records):
+    """ Write the windows as comma separated values """
+    np.savetxt(fileName, records, delimiter=',',
+               header=','.join(WINDOW_DTYPE.names), comments='',
+               fmt=['%d', '%d', '%.6g', '%d', '%.6g', '%.6g', '%.6g', '%.6g'])
+
+
+def writeProfile(fileName, records):
+    """ Write the per residue profile as comma separated values """
+    residues, values = residueProfile(records)
+    np.savetxt(fileName, np.column_stack((residues, values)), delimiter=',',
+               header='residue,diffMean', comments='', fmt=['%d', '%.6g'])
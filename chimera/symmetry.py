@@ -0,0 +1,260 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Native symmetry expansion of atomic structures (ChimeraX sym).
+
+Rotation matrices are generated for the groups of CHIMERA_SYM_NAME with
+the orientations of the ChimeraX sym command:
+
+- Cn: n-fold axis along z. Dn: n-fold along z and 2-fold along x.
+- T222: 2-folds along x, y and z. TZ3: 3-fold along z and another 3-fold
+  in the yz plane along -y.
+- O: 4-folds along x, y and z.
+- I222: 2-folds along x, y and z with 5-folds in the yz plane, I222r the
+  same rotated 90 degrees about z. I2n5 (In25): 2-fold along x (y) and
+  5-fold along z, I2n3: 2-fold along x and 3-fold along z. The 'r'
+  variants are rotated 180 degrees about y (x for In25r).
+
+The identity is always the first matrix. Symmetry is applied about a
+center, (0, 0, 0) by default as in ChimeraX.
+"""
+
+from functools import lru_cache
+
+import numpy as np
+
+from . import atoms as atomsModule
+
+GOLDEN = (1 + np.sqrt(5)) / 2
+# version of the symmetry copies, part of their cache keys
+VERSION = 1
+
+
+def rotation(axis, angle):
+    """ Matrix of a rotation of angle degrees about axis """
+    axis = np.asarray(axis, dtype=np.float64)
+    x, y, z = axis / np.linalg.norm(axis)
+    a = np.radians(angle)
+    c, s = np.cos(a), np.sin(a)
+    t = 1 - c
+    return np.array([[t * x * x + c, t * x * y - s * z, t * x * z + s * y],
+                     [t * x * y + s * z, t * y * y + c, t * y * z - s * x],
+                     [t * x * z - s * y, t * y * z + s * x, t * z * z + c]])
+
+
+def vectorRotation(fromVector, toVector):
+    """ Rotation that takes the direction of fromVector to toVector """
+    u = np.asarray(fromVector, dtype=np.float64)
+    v = np.asarray(toVector, dtype=np.float64)
+    u, v = u / np.linalg.norm(u), v / np.linalg.norm(v)
+    axis = np.cross(u, v)
+    if np.linalg.norm(axis) < 1e-12:
+        if np.dot(u, v) > 0:
+            return np.eye(3)
+        axis = np.cross(u, (1, 0, 0) if abs(u[0]) < 0.9 else (0, 1, 0))
+        return rotation(axis, 180)
+    angle = np.degrees(np.arctan2(np.linalg.norm(axis), np.dot(u, v)))
+    return rotation(axis, angle)
+
+
+def _key(matrix):
+    return (np.round(matrix, 5) + 0.).tobytes()  # + 0. turns -0. into 0.
+
+
+def closure(generators):
+    """ Group generated by rotation matrices, identity first """
+    group = [np.eye(3)]
+    keys = {_key(np.eye(3))}
+    frontier = [np.eye(3)]
+    while frontier:
+        newFrontier = []
+        for m in frontier:
+            for g in generators:
+                product = g @ m
+                key = _key(product)
+                if key not in keys:
+                    keys.add(key)
+                    group.append(product)
+                    newFrontier.append(product)
+        frontier = newFrontier
+    return np.array(group)
+
+
+def _conjugate(group, transform):
+    return np.einsum('ij,njk,lk->nil', transform, group, transform)
+
+
+def cyclicMatrices(order):
+    return np.array([rotation((0, 0, 1), 360. * i / order)
+                     for i in range(order)])
+
+
+def dihedralMatrices(order):
+    cyclic = cyclicMatrices(order)
+    flip = rotation((1, 0, 0), 180)
+    return np.concatenate((cyclic, flip @ cyclic))
+
+
+def tetrahedralMatrices(orientation='222'):
+    group = closure([rotation((0, 0, 1), 180), rotation((1, 0, 0), 180),
+                     rotation((1, 1, 1), 120)])
+    if orientation == 'z3':
+        # 3-fold (1, 1, 1) on z, then the 3-fold (1, 1, -1), that points
+        # upwards after the first rotation, in the yz plane along -y
+        toZ = vectorRotation((1, 1, 1), (0, 0, 1))
+        other = toZ @ np.array([1., 1., -1.])
+        angle = -90. - np.degrees(np.arctan2(other[1], other[0]))
+        group = _conjugate(group, rotation((0, 0, 1), angle) @ toZ)
+    return group
+
+
+def octahedralMatrices():
+    return closure([rotation((0, 0, 1), 90), rotation((1, 0, 0), 90)])
+
+
+def icosahedralMatrices(orientation='222'):
+    """ :param orientation: '222', '222r', '2n5', '2n5r', 'n25', 'n25r',
+    '2n3' or '2n3r' """
+    group = closure([rotation((0, 0, 1), 180), rotation((1, 0, 0), 180),
+                     rotation((1, 1, 1), 120),
+                     rotation((0, 1, GOLDEN), 72)])
+    base = orientation.rstrip('r')
+    if base == '222':
+        transform = np.eye(3)
+        flip = rotation((0, 0, 1), 90)
+    elif base in ('2n5', 'n25'):
+        # 5-fold (0, 1, golden) on z keeping the 2-fold on x
+        transform = vectorRotation((0, 1, GOLDEN), (0, 0, 1))
+        if base == 'n25':
+            transform = rotation((0, 0, 1), 90) @ transform
+        flip = rotation((1, 0, 0) if base == 'n25' else (0, 1, 0), 180)
+    elif base == '2n3':
+        # 3-fold (0, golden, 1/golden) on z keeping the 2-fold on x
+        transform = vectorRotation((0, GOLDEN, 1 / GOLDEN), (0, 0, 1))
+        flip = rotation((0, 1, 0), 180)
+    else:
+        raise ValueError("Unknown icosahedral orientation %s" % orientation)
+    if orientation.endswith('r'):
+        transform = flip @ transform
+    return _conjugate(group, transform)
+
+
+@lru_cache(maxsize=32)
+def _symmetryMatrices(symName, order):
+    if symName == 'Cn':
+        return cyclicMatrices(order)
+    if symName == 'Dn':
+        return dihedralMatrices(order)
+    if symName == 'T222':
+        return tetrahedralMatrices('222')
+    if symName == 'TZ3':
+        return tetrahedralMatrices('z3')
+    if symName == 'O':
+        return octahedralMatrices()
+    if symName.startswith('I'):
+        return icosahedralMatrices(symName[1:])
+    raise ValueError("Unknown symmetry %s" % symName)
+
+
+def symmetryMatrices(symName, order=1):
+    """ (n, 3, 3) rotations of a group of CHIMERA_SYM_NAME
+
+    :param order: order of Cn and Dn groups
+    """
+    return _symmetryMatrices(symName, int(order)).copy()
+
+
+def expand(xyz, matrices, center=(0, 0, 0)):
+    """ (n copies, n atoms, 3) coordinates of the symmetry copies """
+    center = np.asarray(center, dtype=np.float64)
+    xyz = np.asarray(xyz, dtype=np.float64) - center
+    return np.einsum('nij,aj->nai', matrices, xyz) + center
+
+
+def boxCenter(xyz):
+    """ Center of the bounding box, as used by sym range """
+    return (np.min(xyz, axis=-2) + np.max(xyz, axis=-2)) / 2
+
+
+def copiesInRange(copies, rangeDist):
+    """ Indices of the copies whose center is within rangeDist of the
+    center of the first copy (the original structure) """
+    centers = boxCenter(copies)
+    distances = np.linalg.norm(centers - centers[0], axis=-1)
+    return np.flatnonzero(distances <= rangeDist)
+
+
+def atomsInRange(copies, rangeDist):
+    """ Boolean (n copies, n atoms) mask of the atoms that are within
+    rangeDist of any atom of the original structure, as the
+    'delete #copies & #original #>rangeDist' of the ChimeraX scripts """
+    from scipy.spatial import cKDTree
+
+    tree = cKDTree(copies[0])
+    distances, _ = tree.query(copies.reshape(-1, 3),
+                              distance_upper_bound=rangeDist, workers=-1)
+    return np.isfinite(distances).reshape(copies.shape[:2])
+
+
+def _widenChains(atoms, digits):
+    """ atoms with room for digits more characters in the chain ids """
+    width = atoms.dtype['chain'].itemsize // np.dtype('U1').itemsize
+    dtype = np.dtype([(name, 'U%d' % (width + digits) if name == 'chain'
+                       else atoms.dtype[name])
+                      for name in atoms.dtype.names])
+    return atoms.astype(dtype)
+
+
+def symmetrize(atoms, symName, order=1, center=(0, 0, 0), rangeDist=None,
+               byAtom=False):
+    """ Atoms of the symmetry copies (structured array as in
+    chimera.atoms). The original structure is the first copy and each
+    copy keeps its chains with the copy number appended (A, A1, A2...).
+
+    :param rangeDist: keep only the copies whose center is within this
+                      distance of the center of the original structure,
+                      as sym range (or the atoms within this distance of
+                      the original structure if byAtom)
+    """
+    matrices = symmetryMatrices(symName, order)
+    atoms = _widenChains(atoms, len(str(len(matrices) - 1)))
+    copies = expand(atomsModule.coordinates(atoms), matrices, center)
+    if rangeDist is None:
+        keep = np.ones(copies.shape[:2], dtype=bool)
+    elif byAtom:
+        keep = atomsInRange(copies, rangeDist)
+    else:
+        keep = np.zeros(copies.shape[:2], dtype=bool)
+        keep[copiesInRange(copies, rangeDist)] = True
+    keep[0] = True
+    result = []
+    for index in np.flatnonzero(keep.any(axis=1)):
+        copy = atoms[keep[index]].copy()
+        xyz = copies[index][keep[index]]
+        copy['x'], copy['y'], copy['z'] = xyz[:, 0], xyz[:, 1], xyz[:, 2]
+        if index:
+            copy['chain'] = np.char.add(copy['chain'], str(index))
+        result.append(copy)
+    return np.concatenate(result)
@@ -32,3 +32,11 @@ from .test_protocol_contact import TestChimeraContact
 from .test_protocol_chimera_map_subtraction import TestChimeraSubtractMap
 from .test_alpha_fold import TestChimeraAlphafoldImport
 from .test_objects import TestPAE
+from .test_contacts_index import TestInterfaceLibrary
+from .test_contacts_db import TestContactsDB
+from .test_maps import TestNativeMaps, TestMapCache
+from .test_symmetry import TestSymmetry
+from .test_workers import TestChimeraWorkers
+from .test_launches import TestLaunches
+from .test_commands import TestCommands
+from .test_manifest import TestManifest
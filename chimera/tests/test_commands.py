@@ -0,0 +1,149 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import sys
+import types
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+from chimera.commands import (Command, Open, Close, Volume, Sym, Molmap,
+                              Contacts, Save, Rename, NewModel, ScipionWrite,
+                              Script, mergeScripts, quote, spec, symGroup)
+
+
+class TestCommands(BaseTest):
+    " Test the ChimeraX command builder"
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_text(self):
+        self.assertEqual(quote('/data/my map.mrc'), '"/data/my map.mrc"')
+        self.assertEqual(spec((1, 2)), '#1,2')
+        self.assertEqual(Open('/data/a.mrc').text(), 'open /data/a.mrc')
+        self.assertEqual(Volume(2, style='surface', voxelSize=1.5,
+                                origin=(0., -1.25, 3.)).text(),
+                         'volume #2 style surface voxelSize 1.5 '
+                         'origin 0,-1.25,3')
+        self.assertEqual(Sym(1, 'C3', copies=True).text(),
+                         'sym #1 C3 copies true')
+        self.assertEqual(Molmap('#1/A', 3, gridSpacing=1.).text(),
+                         'molmap #1/A 3 gridSpacing 1')
+        self.assertEqual(Contacts('#1/A', saveFile='/a b.over',
+                                  intramol=False, restrict='any').text(),
+                         'contacts #1/A saveFile "/a b.over" intramol false '
+                         'restrict any')
+        self.assertEqual(Save('out.cif', models=2).text(),
+                         'save out.cif models #2')
+        self.assertEqual(Close().text(), 'close')
+        self.assertEqual(Command('cofr', (0, 0, 0)).python(),
+                         "run(session, 'cofr 0,0,0')")
+
+    def test_newModel(self):
+        self.assertEqual(Rename(3, 7).text(), 'rename #3 id #7')
+        self.assertEqual(ScipionWrite(8, 'difference_').text(),
+                         'scipionwrite #8 prefix difference_')
+        self.assertEqual(ScipionWrite(3).text(), 'scipionwrite #3')
+        self.assertEqual(symGroup('Cn', 1), None)
+        self.assertEqual(symGroup('Dn', 7), 'D7')
+        self.assertEqual(symGroup('I222r'), 'i,222r')
+        command = NewModel(Molmap(5, 3, gridSpacing=1.2), 7)
+        with self.assertRaises(ValueError):
+            Script([command]).cxc()
+
+        # the id given by ChimeraX is only known when the command runs
+        class Model:
+            id_string = '6'
+        calls = []
+
+        def run(session, text):
+            calls.append(text)
+            return Model()
+        exec(command.python(), {'run': run, 'session': None})
+        self.assertEqual(calls, ['molmap #5 3 gridSpacing 1.2',
+                                 'rename #6 id #7'])
+
+    def test_script(self):
+        script = Script([Open('a.pdb')]).add('cofr', (0, 0, 0)).add(Close(1))
+        self.assertEqual(script.cxc(), 'open a.pdb\ncofr 0,0,0\nclose #1\n')
+        fileName = script.write(self.getOutputPath('script.py'))
+        with open(fileName) as f:
+            self.assertEqual(f.read(),
+                             "from chimerax.core.commands import run\n"
+                             "run(session, 'open a.pdb')\n"
+                             "run(session, 'cofr 0,0,0')\n"
+                             "run(session, 'close #1')\n")
+
+    def test_merge(self):
+        # run the merged script with a stand-in for chimerax
+        calls = []
+
+        class Model:
+            id_string = '4'
+
+        def run(session, command):
+            if command == 'fail':
+                raise ValueError('failed')
+            calls.append((os.getcwd(), os.environ.get('SCIPION_JOB'),
+                          command))
+            return Model()
+
+        commands = types.ModuleType('chimerax.core.commands')
+        commands.run = run
+        modules = {name: types.ModuleType(name)
+                   for name in ('chimerax', 'chimerax.core')}
+        modules['chimerax.core.commands'] = commands
+        saved = {name: sys.modules.get(name) for name in modules}
+        sys.modules.update(modules)
+        first, second = (self.getOutputPath('job1'),
+                         self.getOutputPath('job2'))
+        for directory in (first, second):
+            os.makedirs(directory, exist_ok=True)
+        cwd = os.getcwd()
+        try:
+            code = mergeScripts([
+                Script([Open('a.pdb')], cwd=first, env={'SCIPION_JOB': '1'}),
+                Script(['fail', Open('b.pdb')], cwd=second),
+                Script([Open('c.pdb'),
+                        NewModel(Molmap(1, 3, gridSpacing=1.2), 7)],
+                       cwd=second, env={'SCIPION_JOB': '3'})])
+            with self.assertRaises(RuntimeError) as error:
+                exec(code, {'session': None})
+        finally:
+            for name, module in saved.items():
+                if module is None:
+                    del sys.modules[name]
+                else:
+                    sys.modules[name] = module
+        self.assertIn('failed', str(error.exception))
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertEqual(calls, [(first, '1', 'open a.pdb'),
+                                 (cwd, None, 'close session'),
+                                 (cwd, None, 'close session'),
+                                 (second, '3', 'open c.pdb'),
+                                 (second, '3', 'molmap #1 3 gridSpacing 1.2'),
+                                 (second, '3', 'rename #4 id #7'),
+                                 (cwd, None, 'close session')])
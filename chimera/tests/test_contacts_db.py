@@ -0,0 +1,103 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import shutil
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+from chimera.protocols.protocol_contacts import connectDB
+from chimera.contacts_db import ContactsDB
+
+
+class TestContactsDB(BaseTest):
+    " Test the query API over the contacts database"
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.dbName = cls.getOutputPath('overlaps.sqlite')
+        c, conn = connectDB(cls.dbName, "contacts")
+        rows = [('A', 'His', 87, 'B', 'Glu', 10, 0.5, 2.5),
+                ('A', 'Arg', 90, 'B', 'Glu', 12, 0.1, 3.1),
+                ('A', 'Arg', 90, 'B', 'Asp', 13, 0.2, 2.9),
+                ('A', 'Leu', 95, 'C', 'Val', 40, 0.3, 3.3)]
+        for chain1, aa1, n1, chain2, aa2, n2, overlap, distance in rows:
+            c.execute("""INSERT INTO contacts (modelId_1, protId_1, chainId_1,
+                           aaName_1, aaNumber_1, atomId_1, modelId_2, protId_2,
+                           chainId_2, aaName_2, aaNumber_2, atomId_2, overlap,
+                           distance)
+                         VALUES ('#1', 'h1', ?, ?, ?, 'CA',
+                                 '#1', 'h2', ?, ?, ?, 'CB', ?, ?)""",
+                      (chain1, aa1, n1, chain2, aa2, n2, overlap, distance))
+        conn.commit()
+        conn.close()
+
+    def test_select(self):
+        with ContactsDB(self.dbName) as db:
+            array = db.select(['aaName_1', 'aaNumber_1', 'distance'],
+                              where={'chainId_2': 'B',
+                                     'distance': ('<', 3.0)},
+                              orderBy=['distance']).array()
+            self.assertEqual(list(array['aaName_1']), ['His', 'Arg'])
+            self.assertEqual(array['aaNumber_1'].dtype.kind, 'i')
+            # values are bound, never formatted into the SQL text
+            array = db.select(where={'aaName_1': "His' OR '1'='1"}).array()
+            self.assertEqual(len(array), 0)
+            with self.assertRaises(ValueError):
+                db.select(['distance; DROP TABLE contacts'])
+
+    def test_aggregates(self):
+        with ContactsDB(self.dbName) as db:
+            counts = db.aggregate(['chainId_2'])
+            self.assertEqual(counts['count'].tolist(), [3, 1])
+            self.assertEqual(db.pairChains(),
+                             [(3, '#1', 'h1', 'A', '#1', 'h2', 'B'),
+                              (1, '#1', 'h1', 'A', '#1', 'h2', 'C')])
+            rows = db.interactions('#1', 'h1', 'A', '#1', 'h2', 'B')
+            self.assertEqual(rows[0][4], 'His87')
+            self.assertEqual(len(rows), 3)
+
+    def test_in(self):
+        with ContactsDB(self.dbName) as db:
+            where = {'aaName_2': ('IN', ['Glu', 'Val'])}
+            counts = db.aggregate(['chainId_2'], where=where)
+            self.assertEqual(counts['count'].tolist(), [2, 1])
+            # cached, the same filter as a tuple or a list value
+            self.assertIs(db.aggregate(['chainId_2'],
+                                       where={'aaName_2': ['Glu', 'Val']}),
+                          counts)
+            array = db.select(['aaNumber_2'], where=where,
+                              orderBy=['aaNumber_2']).array()
+            self.assertEqual(array['aaNumber_2'].tolist(), [10, 12, 40])
+
+    def test_specialPath(self):
+        # characters with a meaning in URIs
+        directory = self.getOutputPath('run 1 #2 ?x=100%')
+        os.makedirs(directory, exist_ok=True)
+        fileName = os.path.join(directory, 'overlaps.sqlite')
+        shutil.copyfile(self.dbName, fileName)
+        with ContactsDB(fileName) as db:
+            self.assertEqual(db.aggregate(['chainId_2'])['count'].tolist(),
+                             [3, 1])
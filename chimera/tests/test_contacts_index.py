@@ -0,0 +1,89 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import random
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+from chimera.protocols.protocol_contacts import connectDB
+from chimera.contacts_index import InterfaceLibrary
+
+AMINOACIDS = ['Arg', 'Lys', 'Glu', 'Asp', 'His', 'Leu',
+              'Ile', 'Val', 'Ala', 'Gly', 'Ser', 'Thr']
+
+
+class TestInterfaceLibrary(BaseTest):
+    " Test the interface fingerprint library of contacts databases"
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _createDataBase(self, fileName, residues):
+        c, conn = connectDB(self.getOutputPath(fileName), "contacts")
+        for aaName1, aaNumber1, aaName2, aaNumber2 in residues:
+            c.execute("""INSERT INTO contacts (modelId_1, protId_1, chainId_1,
+                           aaName_1, aaNumber_1, atomId_1, modelId_2, protId_2,
+                           chainId_2, aaName_2, aaNumber_2, atomId_2, overlap,
+                           distance)
+                         VALUES ('#1', 'h1', 'A', ?, ?, 'CA',
+                                 '#1', 'h2', 'B', ?, ?, 'CB', 0.1, 3.0)""",
+                      (aaName1, aaNumber1, aaName2, aaNumber2))
+        conn.commit()
+        conn.close()
+        return os.path.abspath(self.getOutputPath(fileName))
+
+    def _randomResidues(self, seed, n=80):
+        r = random.Random(seed)
+        return [(r.choice(AMINOACIDS), r.randint(1, 200),
+                 r.choice(AMINOACIDS), r.randint(1, 200)) for _ in range(n)]
+
+    def test_query(self):
+        residues = self._randomResidues(0)
+        queryDB = self._createDataBase('query.sqlite', residues)
+        similarDB = self._createDataBase('similar.sqlite', residues[:70])
+        library = InterfaceLibrary(self.getOutputPath('library.sqlite'))
+        self.assertEqual(library.addDatabase(similarDB), 1)
+        for seed in range(1, 20):
+            library.addDatabase(self._createDataBase('other%d.sqlite' % seed,
+                                                     self._randomResidues(seed)))
+        self.assertEqual(len(library), 20)
+        # unchanged databases are not parsed again
+        self.assertEqual(library.addDatabase(similarDB), 0)
+
+        for exhaustive in [False, True]:
+            results = library.query(queryDB, top=3, exhaustive=exhaustive)
+            hits = results[('#1', 'h1', 'A', '#1', 'h2', 'B')]
+            self.assertEqual(hits[0][1], similarDB)
+            self.assertGreater(hits[0][0], 0.8)
+        # the interfaces of the queried file are never hits
+        library.addDatabase(queryDB)
+        for exhaustive in [False, True]:
+            results = library.query(queryDB, top=3, exhaustive=exhaustive)
+            hits = results[('#1', 'h1', 'A', '#1', 'h2', 'B')]
+            self.assertEqual(hits[0][1], similarDB)
+            self.assertNotIn(queryDB, [path for _, path, _ in hits])
+        self.assertEqual(len(hits), 3)
+        library.close()
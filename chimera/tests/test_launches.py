@@ -0,0 +1,151 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import sys
+import time
+import types
+
+from pyworkflow.object import String
+from pyworkflow.tests import BaseTest, setupTestOutput
+from chimera import launches
+
+
+class LaunchStep:
+    """ Function step of a protocol, as in its _steps """
+
+    def __init__(self, funcName, running):
+        self.funcName = String(funcName)
+        self.running = running
+
+    def isRunning(self):
+        return self.running
+
+
+class TestLaunches(BaseTest):
+    " Test the metrics of the ChimeraX launches"
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_scriptFile(self):
+        self.assertEqual(launches.scriptFile(' --nogui --script s.cxc',
+                                             '/data'), '/data/s.cxc')
+        self.assertEqual(launches.scriptFile(' /tmp/s.py'), '/tmp/s.py')
+        self.assertIsNone(launches.scriptFile('/tmp/session.cxs'))
+        self.assertIsNone(launches.scriptFile(' s.cxc &'))
+        # scripts that run without user interaction
+        self.assertEqual(launches.scriptFile(' --nogui --exit --script s.py',
+                                             '/data', headless=True),
+                         '/data/s.py')
+        self.assertEqual(launches.scriptFile(' --nogui /tmp/a.cxc',
+                                             headless=True), '/tmp/a.cxc')
+        self.assertIsNone(launches.scriptFile(' --script s.py',
+                                              headless=True))  # gui
+        self.assertIsNone(launches.scriptFile(' --nogui --cmd s.py',
+                                              headless=True))
+
+    def test_wrapper(self):
+        script = self.getOutputPath('launched.py')
+        with open(script, 'w') as f:
+            f.write("session.append(__file__)\n")
+        marker = launches.markerFileName()
+        args, wrapper = launches.wrapScript(' --nogui --script %s' % script,
+                                            script, marker)
+        self.assertEqual(args, ' '.join(['--nogui', '--script', wrapper]))
+        # what ChimeraX does with the wrapper
+        session = []
+        before = time.time()
+        with open(wrapper) as f:
+            exec(f.read(), {'session': session})
+        self.assertEqual(session, [script])
+        self.assertGreaterEqual(launches.readMarker(marker), before)
+        self.assertFalse(os.path.exists(marker))
+        self.assertIsNone(launches.readMarker(marker))
+        os.remove(wrapper)
+
+    def test_runCommand(self):
+        status, rss = launches.runCommand(
+            '%s -c "x = bytearray(100 * 1024 ** 2)"' % sys.executable)
+        self.assertEqual(status, 0)
+        self.assertGreater(rss, 100 * 1024 ** 2)
+        status, _ = launches.runCommand('%s -c "import sys; sys.exit(3)"'
+                                        % sys.executable)
+        self.assertEqual(status, 3)
+        self.assertGreater(launches.peakRss(os.getpid()), 0)
+
+    def test_records(self):
+        fileName = self.getOutputPath('logs', launches.LAUNCHES_FILE)
+        record = launches.launchRecord('ChimeraX', ' --nogui s.py', '/data',
+                                       10., 14.5, 0, 300 * 1024 ** 2, 1234,
+                                       12.)
+        self.assertEqual(record['startup'], 2.)
+        self.assertEqual(record['wallTime'], 4.5)
+        for _ in range(2):
+            launches.writeRecord(fileName, record)
+        self.assertEqual(launches.readRecords(fileName), [record] * 2)
+        self.assertEqual(launches.formatRecord(record),
+                         "ChimeraX launch: startup 2.0 s, wall time 4.5 s, "
+                         "peak RSS 300 MB, exit status 0, script 1234 bytes")
+        # the peak RSS of a worker covers its whole life
+        record = launches.launchRecord('ChimeraX', ' --nogui s.py', '/data',
+                                       10., 14.5, 0, 300 * 1024 ** 2, 1234,
+                                       12., worker=True)
+        self.assertIsNone(record['peakRss'])
+        self.assertEqual(record['workerPeakRss'], 300 * 1024 ** 2)
+        self.assertIn("worker peak RSS since it started 300 MB",
+                      launches.formatRecord(record))
+
+    def test_step(self):
+        step = LaunchStep('runChimeraStep', True)
+        protocol = types.SimpleNamespace(_steps=[
+            LaunchStep('prerequisitesStep', False),
+            LaunchStep('runChimeraStep', False), step])
+        self.assertIs(launches.protocolStep(protocol, 'runChimeraStep'),
+                      step)
+        self.assertIsNone(launches.protocolStep(protocol,
+                                                'prerequisitesStep'))
+        self.assertIsNone(launches.protocolStep(protocol, None))
+        self.assertEqual(launches.stepLaunches(step), [])
+        for wallTime in (1., 2.):
+            launches.addToStep(step, {'wallTime': wallTime})
+        self.assertEqual(launches.stepLaunches(step),
+                         [{'wallTime': 1.}, {'wallTime': 2.}])
+
+    def test_projectLaunchesFile(self):
+        cwd = os.getcwd()
+        directory = self.getOutputPath('project')
+        os.makedirs(directory, exist_ok=True)
+        try:
+            os.chdir(directory)
+            # not in a project
+            self.assertIsNone(launches.projectLaunchesFile())
+            os.mkdir('Logs')
+            self.assertEqual(launches.projectLaunchesFile(),
+                             os.path.abspath(os.path.join(
+                                 'Logs', launches.LAUNCHES_FILE)))
+        finally:
+            os.chdir(cwd)
@@ -0,0 +1,113 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import hashlib
+import importlib.util
+import os
+
+import mrcfile
+import numpy as np
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+from chimera import manifest
+
+# checksum of the scipionwrite command, the bundle cannot be imported
+BUNDLE_CHECKSUM = os.path.join(os.path.dirname(manifest.__file__),
+                               'Bundles', 'scipion', 'src', 'checksum.py')
+
+
+class TestManifest(BaseTest):
+    " Test the manifest of the models saved by scipionwrite"
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _folder(self, name):
+        directory = self.getOutputPath(name)
+        os.makedirs(directory, exist_ok=True)
+        data = np.zeros((10, 8, 6), dtype=np.float32)
+        with mrcfile.new(os.path.join(directory, 'map__2_000001.mrc'), data,
+                         overwrite=True) as mrc:
+            mrc.voxel_size = 1.5
+            mrc.header.origin = (3., 4.5, 6.)
+        with open(os.path.join(directory, 'atom.struct__1.cif'), 'w') as f:
+            f.write('data_test\n')
+        with open(os.path.join(directory, 'chimera.cxc'), 'w') as f:
+            f.write('open map__2_000001.mrc\n')
+        return directory
+
+    def test_scanDirectory(self):
+        directory = self._folder('scan')
+        self.assertIsNone(manifest.readManifest(directory))
+        structEntry, mapEntry = manifest.outputEntries(directory)
+        self.assertEqual(structEntry['path'], 'atom.struct__1.cif')
+        self.assertEqual(structEntry['type'], manifest.ATOM_STRUCT)
+        self.assertEqual(manifest.outputName(structEntry), 'atom_struct__1')
+        self.assertEqual(mapEntry['path'], 'map__2_000001.mrc')
+        self.assertEqual(mapEntry['type'], manifest.MAP)
+        self.assertEqual(mapEntry['sampling'], 1.5)
+        self.assertEqual(mapEntry['origin'], [3., 4.5, 6.])
+        self.assertEqual(mapEntry['dims'], [6, 8, 10])
+        self.assertIsNone(mapEntry['checksum'])
+        self.assertEqual(manifest.outputName(mapEntry), 'map__2_000001')
+
+    def test_readManifest(self):
+        directory = self._folder('manifest')
+        fileName = os.path.join(directory, 'map__2_000001.mrc')
+        entry = manifest.fileEntry(fileName, directory)
+        with open(fileName, 'rb') as f:
+            self.assertEqual(entry['checksum'],
+                             hashlib.sha256(f.read()).hexdigest())
+        # the model is saved again, a model that was removed and an
+        # interrupted write
+        manifest.writeEntry(directory, dict(entry, sampling=2.))
+        manifest.writeEntry(directory, dict(entry, path='removed.mrc'))
+        manifest.writeEntry(directory, entry)
+        with open(manifest.manifestFileName(directory), 'a') as f:
+            f.write('{"path": ')
+        # the cif file is not in the manifest
+        self.assertEqual(manifest.outputEntries(directory), [entry])
+
+        # maps saved by scipionwrite without header
+        os.remove(manifest.manifestFileName(directory))
+        manifest.writeEntry(directory, dict(entry, sampling=None,
+                                            origin=None, dims=None))
+        self.assertEqual(manifest.outputEntries(directory),
+                         [dict(entry, checksum=None)])
+
+    def test_bundleChecksum(self):
+        # scipionwrite and the protocols give the same checksums
+        spec = importlib.util.spec_from_file_location('bundleChecksum',
+                                                      BUNDLE_CHECKSUM)
+        bundle = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(bundle)
+        self.assertEqual(bundle.CHUNK_SIZE, manifest.CHUNK_SIZE)
+        fileName = self.getOutputPath('checksum.bin')
+        with open(fileName, 'wb') as f:
+            f.write(np.arange(10000, dtype=np.int64).tobytes())
+        for chunkSize in (manifest.CHUNK_SIZE, 4096):
+            self.assertEqual(bundle.fileChecksum(fileName, chunkSize),
+                             manifest.fileChecksum(fileName, chunkSize))
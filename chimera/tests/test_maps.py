@@ -0,0 +1,539 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import mrcfile
+import numpy as np
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+from chimera import (maps, molmap, mapcache, filters, atoms, scan, blobs,
+                     symmetry)
+
+
+class TestNativeMaps(BaseTest):
+    " Test the native (ChimeraX free) map operations"
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        rng = np.random.default_rng(0)
+        cls.subtrahend = rng.normal(size=(40, 30, 20)).astype(np.float32)
+        cls.minuend = rng.normal(size=(40, 30, 20)).astype(np.float32) + \
+            0.7 * cls.subtrahend
+        cls.minuendFn = cls._writeMap('minuend.mrc', cls.minuend)
+        cls.subtrahendFn = cls._writeMap('subtrahend.mrc', cls.subtrahend)
+
+    @classmethod
+    def _writeMap(cls, fileName, data, voxelSize=1.5):
+        fileName = cls.getOutputPath(fileName)
+        with mrcfile.new(fileName, data, overwrite=True) as mrc:
+            mrc.voxel_size = voxelSize
+        return fileName
+
+    def test_subtractMinRms(self):
+        outFn = self.getOutputPath('difference.mrc')
+        scale = maps.subtractMaps(self.minuendFn, self.subtrahendFn, outFn,
+                                  slabSize=7)
+        m = self.minuend.ravel().astype(np.float64)
+        s = self.subtrahend.ravel().astype(np.float64)
+        self.assertAlmostEqual(scale, np.dot(m, s) / np.dot(s, s), places=5)
+        with mrcfile.open(outFn) as mrc:
+            expected = self.minuend - np.float32(scale) * self.subtrahend
+            self.assertTrue(np.allclose(mrc.data, expected, atol=1e-5))
+            self.assertAlmostEqual(float(mrc.header.rms), expected.std(),
+                                   places=4)
+
+    def test_stats(self):
+        # sidecar written with the map, and computed for other maps
+        outFn = self.getOutputPath('difference_stats.mrc')
+        maps.subtractMaps(self.minuendFn, self.subtrahendFn, outFn,
+                          slabSize=7)
+        stats = maps.readStats(outFn)
+        with mrcfile.open(outFn) as mrc:
+            data = mrc.data.astype(np.float64)
+            self.assertAlmostEqual(stats['rms'], float(mrc.header.rms),
+                                   places=4)
+        self.assertEqual(stats['n'], data.size)
+        self.assertEqual(sum(stats['histogram']['counts']), data.size)
+        # the range of the bins grows by doubling, up to about 4 times
+        # the data range
+        width = (data.max() - data.min()) / maps.HISTOGRAM_BINS
+        for q, value in stats['percentiles'].items():
+            self.assertLess(abs(value - np.percentile(data, float(q))),
+                            4 * width)
+        with maps.openMap(outFn) as mapFile:
+            self.assertAlmostEqual(maps.defaultLevel(mapFile),
+                                   stats['level'])
+        self.assertIsNone(maps.readStats(self.minuendFn))
+        stats = maps.mapStats(self.minuendFn)
+        self.assertAlmostEqual(stats['mean'], self.minuend.mean(), places=5)
+        self.assertEqual(maps.readStats(self.minuendFn), stats)
+
+    def test_nonFiniteStats(self):
+        # inf (float16 overflow) and NaN values are counted apart
+        data = np.arange(24, dtype=np.float32).reshape(2, 3, 4)
+        data[0, 0, :2] = np.inf
+        data[1, 2, 3] = -np.inf
+        data[1, 0, 0] = np.nan
+        stats = maps.RunningStats()
+        stats.update(data[:1])
+        stats.update(data[1:])
+        stats.update(np.full((1, 3, 4), np.nan, dtype=np.float32))
+        finite = data[np.isfinite(data)].astype(np.float64)
+        self.assertEqual(stats.n, finite.size)
+        self.assertEqual(stats.nonFinite, 4 + 12)
+        self.assertEqual((stats.min, stats.max), (finite.min(), finite.max()))
+        self.assertAlmostEqual(stats.mean, finite.mean())
+        self.assertAlmostEqual(stats.rms, finite.std(), places=5)
+        self.assertEqual(stats.histogram.counts.sum(), finite.size)
+        self.assertTrue(np.isfinite(stats.histogram.high))
+        self.assertEqual(stats.toDict()['nonFinite'], 16)
+
+    def test_outputFormats(self):
+        # half precision and compressed maps read back transparently
+        outFn = self.getOutputPath('difference32.mrc')
+        maps.subtractMaps(self.minuendFn, self.subtrahendFn, outFn,
+                          slabSize=7)
+        for outputFormat in range(len(maps.OUTPUT_FORMATS)):
+            fn = maps.outputFileName(
+                self.getOutputPath('difference_%d.mrc' % outputFormat),
+                outputFormat, output=False)
+            # outputs are never compressed
+            self.assertEqual(maps.outputFileName('difference.mrc',
+                                                 outputFormat),
+                             'difference.mrc')
+            maps.subtractMaps(self.minuendFn, self.subtrahendFn, fn,
+                              slabSize=7,
+                              mrcMode=maps.outputMode(outputFormat))
+            with maps.openMap(fn) as mapFile, maps.openMap(outFn) as full:
+                self.assertEqual(mapFile.shape, full.shape)
+                self.assertTrue(np.allclose(mapFile.slab(0, 40),
+                                            full.data, atol=1e-2))
+                self.assertTrue(np.allclose(mapFile.voxelSize, 1.5))
+            self.assertIsNotNone(maps.readStats(fn))
+            if outputFormat:
+                self.assertLess(os.path.getsize(fn),
+                                0.6 * os.path.getsize(outFn))
+        self.assertFalse(os.path.exists(
+            self.getOutputPath('difference_2.tmp')))
+
+    def test_blobs(self):
+        data = np.zeros((20, 20, 20), dtype=np.float32)
+        data[2:5, 2:5, 2:5] = 1.  # small blob
+        data[10:14, 10:16, 10:12] = 2.  # large blob
+        data[12, 12, 10] = 4.
+        fileName = self._writeMap('blobs.mrc', data, voxelSize=2.)
+        # SER 9 is within contact of the large blob but never the atom
+        # closest to one of its voxels
+        structure = np.zeros(3, dtype=atoms.ATOM_DTYPE)
+        structure['chain'] = 'A'
+        structure['resName'] = ['GLY', 'ALA', 'SER']
+        structure['resSeq'] = [7, 8, 9]
+        structure['x'] = [22., 60., 22.]
+        structure['y'] = [22., 60., 22.]
+        structure['z'] = [18., 60., 17.]
+        with maps.openMap(fileName) as mapFile:
+            result = blobs.findBlobs(mapFile, 0.5, structure, contact=5.)
+        self.assertEqual(len(result), 2)
+        large, small = result
+        self.assertEqual(large['voxels'], 48)
+        self.assertAlmostEqual(large['volume'], 48 * 8.)
+        self.assertAlmostEqual(large['density'], (47 * 2. + 4.) * 8.)
+        self.assertEqual(large['maximum'], 4.)
+        # density weighted centroid
+        k, j, i = np.nonzero(data >= 2.)
+        weights = data[k, j, i] - 0.5
+        for axis, index in zip('xyz', (i, j, k)):
+            self.assertAlmostEqual(large[axis],
+                                   2. * np.average(index, weights=weights))
+        self.assertEqual(large['residues'], 'A:GLY 7 A:SER 9')
+        self.assertAlmostEqual(large['distance'], 2.)
+        self.assertEqual(small['residues'], '')
+        self.assertAlmostEqual(small['x'], 6.)
+        with maps.openMap(fileName) as mapFile:
+            self.assertEqual(len(blobs.findBlobs(mapFile, 0.5,
+                                                 minVolume=300.)), 1)
+        markersFn = self.getOutputPath('blobs.cmm')
+        blobs.writeMarkers(markersFn, result)
+        with open(markersFn) as f:
+            self.assertEqual(f.read().count('<marker '), 2)
+
+    def test_bin(self):
+        outFn = self.getOutputPath('binned.mrc')
+        voxelSize, origin = maps.binMap(self.minuendFn, outFn, 4,
+                                        origin=(1., 2., 3.), slabSize=3)
+        self.assertTrue(np.allclose(voxelSize, 6.))
+        self.assertTrue(np.allclose(origin, (3.25, 4.25, 5.25)))
+        expected = self.minuend[:, :28].reshape(10, 4, 7, 4, 5, 4).mean(
+            axis=(1, 3, 5))
+        with maps.openMap(outFn) as binned:
+            self.assertEqual(binned.shape, (10, 7, 5))
+            self.assertTrue(np.allclose(binned.data, expected, atol=1e-6))
+            self.assertTrue(np.allclose(binned.origin, origin))
+
+    def test_localZscore(self):
+        # noise 3 times larger in the upper half
+        data = self.minuend.copy()
+        data[20:] *= 3
+        noisyFn = self._writeMap('noisy.mrc', data)
+        outFn = self.getOutputPath('zscore.mrc')
+        sdFn = self.getOutputPath('localsd.mrc')
+        maps.localZscoreMap(noisyFn, outFn, 7.5, 'box', sdFn=sdFn,
+                            slabSize=4, threads=3)
+        # box of 5 voxels, normalized by the voxels inside the map
+        from scipy import ndimage
+        values = data.astype(np.float64)
+        weight = ndimage.uniform_filter(np.ones_like(values), 5,
+                                        mode='constant')
+        mean = ndimage.uniform_filter(values, 5, mode='constant') / weight
+        square = ndimage.uniform_filter(values ** 2, 5,
+                                        mode='constant') / weight
+        sd = np.sqrt(square - mean ** 2)
+        with maps.openMap(outFn) as zscore, maps.openMap(sdFn) as localSd:
+            self.assertTrue(np.allclose(localSd.data, sd, atol=1e-5))
+            self.assertTrue(np.allclose(zscore.data, (values - mean) / sd,
+                                        atol=1e-4))
+            # same significance in both halves
+            self.assertAlmostEqual(np.std(zscore.data[3:17]),
+                                   np.std(zscore.data[23:37]), delta=0.05)
+        # independent of the slab size, flat regions are 0
+        data[:10] = 0.
+        flatFn = self._writeMap('flat.mrc', data)
+        for slabSize in (3, 40):
+            maps.localZscoreMap(flatFn, outFn, 6., 'gaussian',
+                                slabSize=slabSize)
+            with maps.openMap(outFn) as zscore:
+                result = np.array(zscore.data)
+            if slabSize == 3:
+                first = result
+        self.assertTrue(np.allclose(result, first, atol=1e-5))
+        self.assertTrue(np.all(result[:2] == 0))  # farther than 4 sd
+
+    def test_boundedMap(self):
+        submitted = []
+
+        def items():
+            for i in range(20):
+                submitted.append(i)
+                yield i
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            results = []
+            for result in maps.boundedMap(executor, lambda i: i * i,
+                                          items(), 3):
+                # 3 calls in flight besides the one of this result
+                self.assertLessEqual(len(submitted) - len(results), 4)
+                results.append(result)
+        self.assertEqual(results, [i * i for i in range(20)])
+
+    def test_crop(self):
+        xyz = np.array([[6., 9., 12.], [15., 12., 30.]])
+        with maps.openMap(self.minuendFn) as mapFile:
+            low, high = maps.cropBox(mapFile, xyz, 3.)
+        self.assertEqual(list(low), [6, 4, 2])
+        self.assertEqual(list(high), [23, 11, 13])
+        cropFn = self.getOutputPath('crop.mrc')
+        origin = maps.cropMap(self.minuendFn, cropFn, low, high)
+        self.assertTrue(np.allclose(origin, (3., 6., 9.)))
+        region = tuple(slice(l, h) for l, h in zip(low, high))
+        with maps.openMap(cropFn) as crop:
+            self.assertTrue(np.allclose(crop.origin, origin))
+            self.assertTrue(np.array_equal(crop.data, self.minuend[region]))
+        # paste a modified crop back, with and without background
+        with mrcfile.open(cropFn, mode='r+') as mrc:
+            mrc.data[:] = -1.
+        pastedFn = self.getOutputPath('pasted.mrc')
+        for background in (True, False):
+            maps.pasteMap(cropFn, self.minuendFn, pastedFn, background,
+                          slabSize=7)
+            expected = self.minuend.copy() if background else \
+                np.zeros_like(self.minuend)
+            expected[region] = -1.
+            with mrcfile.open(pastedFn) as mrc:
+                self.assertTrue(np.array_equal(mrc.data, expected))
+
+    def test_subtractOnGrid(self):
+        # subtrahend shifted two voxels along x, interpolated on the
+        # minuend grid
+        outFn = self.getOutputPath('difference_shifted.mrc')
+        maps.subtractMaps(self.minuendFn, self.subtrahendFn, outFn,
+                          minRms=False, subtrahendOrigin=(3., 0., 0.),
+                          slabSize=7)
+        expected = self.minuend.copy()
+        expected[:, :, 2:] -= self.subtrahend[:, :, :-2]
+        with mrcfile.open(outFn) as mrc:
+            self.assertTrue(np.allclose(mrc.data, expected, atol=1e-5))
+
+    def test_mask(self):
+        outFn = self.getOutputPath('masked.mrc')
+        maps.maskMap(self.minuendFn, self.subtrahendFn, outFn, level=0.5,
+                     slabSize=7)
+        expected = np.where(self.subtrahend > 0.5, 0., self.minuend)
+        with mrcfile.open(outFn) as mrc:
+            self.assertTrue(np.allclose(mrc.data, expected))
+
+    def test_filterTiled(self):
+        # slabs with halo give the same result as the whole map
+        from scipy import ndimage
+        outFn = self.getOutputPath('filtered.mrc')
+        memory = 20 * 30 * 20 * maps.VOXEL_BYTES  # a few sections
+        for filterType in ['gaussian', 'laplacian']:
+            maps.filterMap(self.minuendFn, outFn, filterType, sd=3.,
+                           memory=memory)
+            if filterType == 'gaussian':
+                expected = ndimage.gaussian_filter(self.minuend, 2.,
+                                                   mode='constant')
+            else:
+                expected = ndimage.laplace(self.minuend, mode='constant')
+            with mrcfile.open(outFn) as mrc:
+                self.assertTrue(np.allclose(mrc.data, expected, atol=1e-5))
+
+    def test_zone(self):
+        rng = np.random.default_rng(2)
+        xyz = rng.uniform(5., 25., size=(30, 3))
+        outFn = self.getOutputPath('zone.mrc')
+        maps.zoneMap(self.minuendFn, outFn, xyz, 4., slabSize=7)
+        k, j, i = np.indices(self.minuend.shape)
+        grid = np.stack((i, j, k), axis=-1) * 1.5
+        distances = np.linalg.norm(grid[..., None, :] - xyz, axis=-1)
+        expected = np.where(distances.min(axis=-1) <= 4., self.minuend, 0.)
+        with mrcfile.open(outFn) as mrc:
+            self.assertTrue(np.array_equal(mrc.data, expected))
+
+    def test_fftFilter(self):
+        from scipy import ndimage
+        sigma = (3., 2.5, 4.)
+        self.assertTrue(np.allclose(
+            filters.fftFilter(self.minuend, 'gaussian', sigma, workers=2),
+            ndimage.gaussian_filter(self.minuend, sigma, mode='constant'),
+            atol=1e-5))
+        self.assertTrue(np.allclose(
+            filters.fftFilter(self.minuend, 'laplacian'),
+            ndimage.laplace(self.minuend, mode='constant'), atol=1e-4))
+
+    def test_fsc(self):
+        # against the full spectrum
+        frequencies, fsc = filters.shellCorrelation(self.minuend,
+                                                    self.subtrahend)
+        f1, f2 = np.fft.fftn(self.minuend), np.fft.fftn(self.subtrahend)
+        k = np.meshgrid(*[np.fft.fftfreq(n) for n in self.minuend.shape],
+                        indexing='ij')
+        shells = np.rint(np.sqrt(sum(f ** 2 for f in k)) * 40).astype(int)
+        for shell in (0, 3, 12, 20):
+            inside = shells == shell
+            expected = (np.sum((f1 * f2.conj()).real[inside]) /
+                        np.sqrt(np.sum(np.abs(f1[inside]) ** 2) *
+                                np.sum(np.abs(f2[inside]) ** 2)))
+            self.assertAlmostEqual(fsc[shell], expected, places=5)
+        self.assertEqual(len(fsc), 21)
+        self.assertAlmostEqual(frequencies[-1], 0.5)
+        # white noise: 0.7 / sqrt(1 + 0.7^2) at every shell
+        self.assertAlmostEqual(np.mean(fsc[5:]), 0.57, delta=0.03)
+        frequencies, fsc = maps.mapFsc(self.minuendFn, self.minuendFn)
+        self.assertTrue(np.allclose(fsc, 1.))
+        self.assertAlmostEqual(frequencies[1], 1. / 60.)
+        self.assertIsNone(maps.fscResolution(frequencies, fsc))
+        curve = np.array([1., 0.9, 0.5, 0.1, 0.])
+        self.assertAlmostEqual(
+            maps.fscResolution(np.arange(5) / 10., curve), 1 / 0.28925,
+            places=3)
+        fscFn = self.getOutputPath('fsc.csv')
+        maps.writeFsc(fscFn, np.arange(5) / 10., curve)
+        self.assertTrue(np.allclose(maps.readFsc(fscFn)[1], curve))
+
+    def test_molmap(self):
+        # splatted map against a direct sum of the atom gaussians
+        rng = np.random.default_rng(1)
+        xyz = rng.uniform(5., 25., size=(50, 3))
+        weights = rng.integers(1, 17, size=50).astype(np.float32)
+        shape = (24, 22, 20)
+        voxelSize = np.array([1.5, 1.5, 1.5])
+        origin = np.array([-2., 1., 0.5])
+        resolution = 4.
+        result = molmap.molmapOnGrid(xyz, weights, resolution, shape,
+                                     voxelSize, origin, slabSize=5,
+                                     threads=2)
+        sigma = molmap.SIGMA_FACTOR * resolution
+        k, j, i = np.indices(shape)
+        grid = origin + np.stack((i, j, k), axis=-1) * voxelSize
+        expected = np.zeros(shape)
+        for center, weight in zip(xyz, weights):
+            d2 = ((grid - center) ** 2).sum(axis=-1)
+            expected += weight * np.exp(-0.5 * d2 / sigma ** 2)
+        expected *= (2 * np.pi) ** -1.5 * sigma ** -3
+        self.assertTrue(np.allclose(result, expected, atol=1e-6))
+        # atoms splatted a few at a time within a small memory budget
+        radius = np.ceil(molmap.CUTOFF_RANGE * sigma / voxelSize).astype(int)
+        memory = 2 * 3 * np.prod(2 * radius + 2) * molmap.WINDOW_VOXEL_BYTES
+        self.assertEqual(molmap.atomChunk(radius, memory, 2), 3)
+        result = molmap.molmapOnGrid(xyz, weights, resolution, shape,
+                                     voxelSize, origin, threads=2,
+                                     memory=memory)
+        self.assertTrue(np.allclose(result, expected, atol=1e-6))
+        # atoms at the same place add up in the same voxels
+        twice = molmap.molmapOnGrid(np.concatenate((xyz, xyz)),
+                                    np.concatenate((weights, weights)),
+                                    resolution, shape, voxelSize, origin,
+                                    threads=2)
+        self.assertTrue(np.allclose(twice, 2 * expected, atol=1e-6))
+
+    def test_altlocs(self):
+        # only the first alternate location of each atom is read
+        pdbFn = self.getOutputPath('altlocs.pdb')
+        atom = ('ATOM  %5d  %-3s%s%3s A  %2d      %6.3f   0.000   0.000'
+                '  %4.2f 10.00           %s\n')
+        with open(pdbFn, 'w') as f:
+            f.write(atom % (1, 'N', ' ', 'SER', 1, 0., 1., 'N'))
+            f.write(atom % (2, 'OG', 'B', 'SER', 1, 1., .6, 'O'))
+            f.write(atom % (3, 'OG', 'C', 'SER', 1, 2., .4, 'O'))
+            f.write(atom % (4, 'OG', 'A', 'SER', 2, 3., .5, 'O'))
+        structure = atoms.readAtoms(pdbFn)
+        self.assertEqual(structure['x'].tolist(), [0., 1., 3.])
+        cifFn = self.getOutputPath('altlocs.cif')
+        with open(cifFn, 'w') as f:
+            f.write('data_test\nloop_\n')
+            for column in ['group_PDB', 'id', 'type_symbol', 'label_atom_id',
+                           'label_alt_id', 'label_comp_id', 'label_asym_id',
+                           'label_seq_id', 'Cartn_x', 'Cartn_y', 'Cartn_z']:
+                f.write('_atom_site.%s\n' % column)
+            f.write('ATOM 1 N N . SER A 1 0 0 0\n'
+                    'ATOM 2 O OG B SER A 1 1 0 0\n'
+                    'ATOM 3 O OG C SER A 1 2 0 0\n'
+                    'ATOM 4 O OG A SER A 2 3 0 0\n#\n')
+        structure = atoms.readAtoms(cifFn)
+        self.assertEqual(structure['x'].tolist(), [0., 1., 3.])
+
+    def test_molmapGroups(self):
+        # maps of each group in one pass, and all atoms but each group
+        rng = np.random.default_rng(2)
+        xyz = rng.uniform(5., 25., size=(60, 3))
+        weights = rng.integers(1, 17, size=60).astype(np.float32)
+        groups = rng.integers(0, 3, size=60)
+        args = (4., (24, 22, 20), 1.5, (-2., 1., 0.5))
+        result = molmap.molmapGroupsOnGrid(xyz, weights, groups, *args,
+                                           slabSize=7, threads=2)
+        complement = molmap.molmapGroupsOnGrid(xyz, weights, groups, *args,
+                                               complement=True, threads=2)
+        full = molmap.molmapOnGrid(xyz, weights, *args)
+        for group in range(3):
+            mask = groups == group
+            expected = molmap.molmapOnGrid(xyz[mask], weights[mask], *args)
+            self.assertTrue(np.allclose(result[group], expected, atol=1e-6))
+            self.assertTrue(np.allclose(complement[group], full - expected,
+                                        atol=1e-5))
+
+    def test_windowScan(self):
+        # incremental window removal against a full subtraction
+        rng = np.random.default_rng(3)
+        structure = np.zeros(30, dtype=atoms.ATOM_DTYPE)
+        structure['chain'] = 'A'
+        structure['resSeq'] = np.repeat(np.arange(1, 11), 3)
+        structure['element'] = 'C'
+        xyz = rng.uniform(5., 25., size=(30, 3))
+        structure['x'], structure['y'], structure['z'] = xyz.T
+        fullFn = self.getOutputPath('scan_full.mrc')
+        with maps.openMap(self.minuendFn) as minuend:
+            molmap.molmap(structure, 5., fullFn, minuend)
+            with maps.openMap(fullFn) as full:
+                records = scan.windowScan(minuend, full, structure, 'A', 3,
+                                          5., radius=3., step=2)
+        self.assertEqual(list(records['first']), [1, 3, 5, 7, 8])
+        row = records[1]
+        keep = (structure['resSeq'] < 3) | (structure['resSeq'] > 5)
+        s = molmap.molmapOnGrid(xyz[keep], np.full(keep.sum(), 6.), 5.,
+                                self.minuend.shape, 1.5, (0., 0., 0.))
+        m = self.minuend.astype(np.float64)
+        scale = np.vdot(m, s) / np.vdot(s, s.astype(np.float64))
+        self.assertAlmostEqual(row['scale'], scale, places=4)
+        k, j, i = np.indices(self.minuend.shape)
+        grid = np.stack((i, j, k), axis=-1) * 1.5
+        distances = np.linalg.norm(grid[..., None, :] - xyz[~keep], axis=-1)
+        zone = distances.min(axis=-1) <= 3.
+        diff = m - scale * s
+        self.assertEqual(row['voxels'], zone.sum())
+        self.assertAlmostEqual(row['diffMean'], diff[zone].mean(), places=4)
+        residues, profile = scan.residueProfile(records)
+        self.assertEqual(len(residues), 10)
+        self.assertAlmostEqual(profile[0], records[0]['diffMean'])
+
+
+class TestMapCache(BaseTest):
+    " Test the cache of simulated maps"
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _file(self, name, size):
+        fileName = self.getOutputPath(name)
+        with open(fileName, 'wb') as f:
+            f.write(b'x' * size)
+        return fileName
+
+    def test_key(self):
+        key = mapcache.cacheKey(resolution=3.0, voxelSize=np.array([1.05] * 3))
+        self.assertEqual(key, mapcache.cacheKey(voxelSize=[1.05000001] * 3,
+                                                resolution=3))
+        self.assertNotEqual(key, mapcache.cacheKey(resolution=3.5,
+                                                   voxelSize=[1.05] * 3))
+
+    def test_lru(self):
+        cache = mapcache.MapCache(self.getOutputPath('cache'), maxSize=250)
+        cache.clear()
+        for key in 'abc':
+            cache.put(key, self._file(key, 100))
+            os.utime(cache.get(key), (0, {'a': 1, 'b': 2, 'c': 3}[key]))
+        # a and b do not fit with c, a is evicted first
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('b'))  # b becomes the newest entry
+        cache.put('d', self._file('d', 100))
+        self.assertIsNone(cache.get('c'))
+        outFn = self.getOutputPath('fetched')
+        self.assertTrue(cache.fetch('d', outFn))
+        self.assertEqual(os.path.getsize(outFn), 100)
+        self.assertFalse(cache.fetch('c', outFn))
+        # entry evicted by another process between get and the copy
+        path = cache.get('d')
+        cache.get = lambda key, suffix='.mrc': path
+        os.remove(path)
+        self.assertFalse(cache.fetch('d', outFn))
+
+    def test_symmetrized(self):
+        # symmetry copies are cached as .npy, next to the maps
+        structure = np.zeros(3, dtype=atoms.ATOM_DTYPE)
+        structure['chain'] = 'ABCD'
+        structure['x'] = [10., 11., 12.]
+        copies = symmetry.symmetrize(structure, 'Cn', 12)
+        cache = mapcache.MapCache(self.getOutputPath('symcache'))
+        key = mapcache.cacheKey(symmetry='Cn', symmetryOrder=12)
+        fileName = self.getOutputPath('symmetry.npy')
+        np.save(fileName, copies)
+        cache.put(key, fileName, '.npy')
+        self.assertFalse(cache.fetch(key, fileName))  # not a map
+        os.remove(fileName)
+        self.assertTrue(cache.fetch(key, fileName, '.npy'))
+        self.assertTrue(np.array_equal(np.load(fileName), copies))
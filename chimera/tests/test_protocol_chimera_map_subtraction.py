@@ -179,6 +179,25 @@ class TestChimeraSubtractMap(TestImportData):
 
         self.assertTrue(os.path.exists(result))
 
+        # same subtraction computed without ChimeraX
+        result = eval("protChimera2.DONOTSAVESESSION_Map__3_%06d"
+                      % protChimera2.getObjId())
+        args = {'inputVolume': volume,
+                'mapOrModel': 0,
+                'inputVolume2': result,
+                'useNativeEngine': True
+                }
+        protChimera4 = self.newProtocol(ChimeraSubtractionMaps, **args)
+        protChimera4.setObjLabel('native subtract\n map -\n'
+                                 'model-derived map\n')
+        self.launchProtocol(protChimera4)
+        for prefix, modelId in [('difference', 8), ('filtered', 9)]:
+            result = getattr(protChimera4, "%s_Map__%d_%06d"
+                             % (prefix, modelId, protChimera4.getObjId()))
+            self.assertTrue(os.path.exists(result.getFileName()))
+            self.assertAlmostEqual(result.getSamplingRate(),
+                                   volume.getSamplingRate(), places=3)
+
     def testChimeraSubtract2(self):
         """ This test checks the subtraction in Chimera of a
         model with control mutations from an imported map """
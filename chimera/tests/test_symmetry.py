@@ -0,0 +1,146 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import numpy as np
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+from chimera import atoms, symmetry
+from chimera.constants import CHIMERA_SYM_NAME
+
+
+def axes(matrices, fold):
+    """ Unit rotation axes of the fold-fold rotations """
+    result = []
+    for m in matrices:
+        angle = np.degrees(np.arccos(np.clip((np.trace(m) - 1) / 2, -1, 1)))
+        if abs(angle - 360. / fold) < 1e-6:
+            w, v = np.linalg.eig(m)
+            result.append(np.real(v[:, np.argmin(abs(w - 1))]))
+    return np.array(result)
+
+
+def hasAxis(matrices, fold, axis):
+    return any(abs(abs(np.dot(a, axis)) - 1) < 1e-6
+               for a in axes(matrices, fold))
+
+
+class TestSymmetry(BaseTest):
+    " Test the native symmetry expansion"
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_groups(self):
+        sizes = {'Cn': 5, 'Dn': 10, 'T222': 12, 'TZ3': 12, 'O': 24}
+        for symName in CHIMERA_SYM_NAME.values():
+            matrices = symmetry.symmetryMatrices(symName, 5)
+            self.assertEqual(len(matrices), sizes.get(symName, 60), symName)
+            self.assertTrue(np.allclose(matrices[0], np.eye(3)))
+            # closed under products
+            keys = {(np.round(m, 5) + 0.).tobytes() for m in matrices}
+            product = matrices[1] @ matrices[-1]
+            self.assertIn((np.round(product, 5) + 0.).tobytes(), keys)
+
+    def test_orientations(self):
+        x, y, z = np.eye(3)
+        # the second 3-fold of TZ3 in the yz plane, along -y
+        matrices = symmetry.symmetryMatrices('TZ3')
+        self.assertTrue(hasAxis(matrices, 3, z))
+        self.assertTrue(hasAxis(matrices, 3, (0, -np.sqrt(8) / 3, 1 / 3)))
+        self.assertFalse(hasAxis(matrices, 3, (0, np.sqrt(8) / 3, 1 / 3)))
+        self.assertTrue(hasAxis(symmetry.symmetryMatrices('O'), 4, x))
+        for symName in ['I222', 'I222r']:
+            matrices = symmetry.symmetryMatrices(symName)
+            for axis in (x, y, z):
+                self.assertTrue(hasAxis(matrices, 2, axis), symName)
+        # 5-folds that tell each orientation from its 'r' variant: in the
+        # yz plane for I222 and in the xz plane for I222r, and the 5-fold
+        # next to z (2n5, n25) or nearest to the 3-fold on z (2n3)
+        g = symmetry.GOLDEN
+        near5 = np.arccos(1 / np.sqrt(5))  # angle between 5-folds
+        near3 = np.arccos(g ** 2 / np.sqrt(3 * (1 + g ** 2)))
+        fiveFolds = {
+            'I222': (0, 1, g), 'I222r': (1, 0, g),
+            'I2n5': (0, -np.sin(near5), np.cos(near5)),
+            'I2n5r': (0, np.sin(near5), np.cos(near5)),
+            'In25': (np.sin(near5), 0, np.cos(near5)),
+            'In25r': (-np.sin(near5), 0, np.cos(near5)),
+            'I2n3': (0, -np.sin(near3), np.cos(near3)),
+            'I2n3r': (0, np.sin(near3), np.cos(near3))}
+        for symName, axis in fiveFolds.items():
+            matrices = symmetry.symmetryMatrices(symName)
+            flipped = symName[:-1] if symName.endswith('r') \
+                else symName + 'r'
+            axis = np.array(axis) / np.linalg.norm(axis)
+            other = np.array(fiveFolds[flipped])
+            other /= np.linalg.norm(other)
+            self.assertTrue(hasAxis(matrices, 5, axis), symName)
+            self.assertFalse(hasAxis(matrices, 5, other), symName)
+        for symName, twoFold, axis, fold in [('I2n5', x, z, 5),
+                                             ('I2n5r', x, z, 5),
+                                             ('In25', y, z, 5),
+                                             ('In25r', y, z, 5),
+                                             ('I2n3', x, z, 3),
+                                             ('I2n3r', x, z, 3)]:
+            matrices = symmetry.symmetryMatrices(symName)
+            self.assertTrue(hasAxis(matrices, 2, twoFold), symName)
+            self.assertTrue(hasAxis(matrices, fold, axis), symName)
+
+    def test_symmetrize(self):
+        structure = np.zeros(3, dtype=atoms.ATOM_DTYPE)
+        structure['chain'] = 'A'
+        structure['element'] = 'C'
+        structure['name'] = ['CA', "C1'", 'N']
+        structure['resSeq'] = [1, 1, 2]
+        structure['x'] = [10., 11., 12.]
+        copies = symmetry.symmetrize(structure, 'Cn', 4)
+        self.assertEqual(list(np.unique(copies['chain'])),
+                         ['A', 'A1', 'A2', 'A3'])
+        self.assertTrue(np.allclose(copies['y'][3:6], [10., 11., 12.],
+                                    atol=1e-5))
+        # the copies at 90 and 270 degrees have their centers at 15.6 A
+        near = symmetry.symmetrize(structure, 'Cn', 4, rangeDist=16.)
+        self.assertEqual(list(np.unique(near['chain'])), ['A', 'A1', 'A3'])
+        self.assertEqual(len(near), 9)  # whole copies
+        self.assertEqual(len(symmetry.symmetrize(structure, 'Cn', 4,
+                                                 rangeDist=15.)), 3)
+        # only the first atom of those copies is within 14.5 A of an atom
+        # of the original structure
+        near = symmetry.symmetrize(structure, 'Cn', 4, rangeDist=14.5,
+                                   byAtom=True)
+        self.assertEqual(list(near['chain']), ['A'] * 3 + ['A1', 'A3'])
+        # long chain ids and copy numbers are not truncated
+        structure['chain'] = 'ABCD'
+        copies = symmetry.symmetrize(structure, 'Cn', 12)
+        self.assertEqual(len(np.unique(copies['chain'])), 12)
+        self.assertIn('ABCD11', copies['chain'])
+        fileName = self.getOutputPath('copies.cif')
+        atoms.writeCif(copies, fileName)
+        back = atoms.readAtoms(fileName)
+        self.assertEqual(list(back['chain']), list(copies['chain']))
+        self.assertEqual(list(back['name'][:3]), ['CA', "C1'", 'N'])
+        self.assertTrue(np.allclose(atoms.coordinates(back),
+                                    atoms.coordinates(copies), atol=1e-3))
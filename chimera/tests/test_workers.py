@@ -0,0 +1,186 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import signal
+import stat
+import sys
+import time
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+from chimera import workers
+
+# stand-in for 'ChimeraX --nogui --cmd "remotecontrol rest start ..."': a
+# REST server that runs the commands used by the pool
+FAKE_CHIMERAX = '''#!%(python)s
+import json
+import os
+import shlex
+import sys
+import types
+import urllib.parse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+port = int(sys.argv[sys.argv.index('--cmd') + 1].split()[4])
+log = []
+
+
+class UI:
+    def quit(self):
+        os._exit(0)
+
+
+class Session:
+    ui = UI()
+    models = []
+
+
+def run(session, command):
+    name, _, arg = command.partition(' ')
+    if name == 'version':
+        log.append('UCSF ChimeraX version: fake')
+    elif name == 'close':
+        session.models.clear()
+    elif name == 'open':
+        session.models.append(shlex.split(arg)[0])
+    elif name == 'runscript':
+        fileName = shlex.split(arg)[0]
+        with open(fileName) as f:
+            exec(compile(f.read(), fileName, 'exec'), {'session': session})
+    elif name == 'exit':
+        session.ui.quit()
+    else:
+        raise ValueError('Unknown command ' + name)
+
+
+commands = types.ModuleType('chimerax.core.commands')
+commands.run = run
+for module in ('chimerax', 'chimerax.core'):
+    sys.modules[module] = types.ModuleType(module)
+sys.modules['chimerax.core.commands'] = commands
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        del log[:]
+        error = None
+        try:
+            run(Session, query['command'][0])
+        except Exception as e:
+            error = {'type': type(e).__name__, 'message': str(e)}
+        body = json.dumps({'log messages': {'info': list(log)},
+                           'error': error}).encode()
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+HTTPServer(('127.0.0.1', port), Handler).serve_forever()
+'''
+
+SCRIPT = '''import os
+from chimerax.core.commands import run
+run(session, 'open model.pdb')
+with open('result.txt', 'w') as f:
+    f.write('%s %s %d' % (os.getcwd(), os.environ['SCIPION_TEST'],
+                          len(session.models)))
+run(session, 'exit')
+'''
+
+
+class TestChimeraWorkers(BaseTest):
+    " Test the pool of ChimeraX workers with a stand-in REST server"
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.program = cls.getOutputPath('fakeChimeraX')
+        with open(cls.program, 'w') as f:
+            f.write(FAKE_CHIMERAX % {'python': sys.executable})
+        os.chmod(cls.program, os.stat(cls.program).st_mode | stat.S_IEXEC)
+        cls.script = cls.getOutputPath('script.py')
+        with open(cls.script, 'w') as f:
+            f.write(SCRIPT)
+
+    def _result(self, cwd):
+        with open(os.path.join(cwd, 'result.txt')) as f:
+            return f.read().split()
+
+    def test_pool(self):
+        directory = self.getOutputPath('workers')
+        pool = workers.ChimeraWorkerPool(self.program, 1, directory,
+                                         startTimeout=30, jobTimeout=30)
+        try:
+            pool.start()
+            pid = pool.workers[0].pid
+            for job in range(2):
+                # the session is reset and exit does not stop the worker
+                cwd = self.getOutputPath('job%d' % job)
+                os.makedirs(cwd, exist_ok=True)
+                marker = os.path.join(cwd, 'start.txt')
+                pool.run(self.script, cwd, {'SCIPION_TEST': str(job)},
+                         marker)
+                self.assertEqual(self._result(cwd), [cwd, str(job), '1'])
+                self.assertEqual(pool.workers[0].pid, pid)
+                self.assertEqual(pool.lastPid, pid)
+                self.assertTrue(os.path.exists(marker))
+            # other processes see the worker
+            other = workers.ChimeraWorkerPool(self.program, 1, directory)
+            self.assertEqual(other.workers[0].pid, pid)
+            # busy workers
+            self.assertTrue(other.workers[0].acquire())
+            self.assertIsNone(pool.run(self.script, cwd, {}))
+            other.workers[0].release()
+            # script errors
+            with self.assertRaises(workers.ChimeraScriptError):
+                pool.run(self.script, cwd, {})  # no SCIPION_TEST
+            # restart of a dead worker
+            os.kill(pid, signal.SIGKILL)
+            time.sleep(0.2)
+            pool.run(self.script, cwd, {'SCIPION_TEST': 'restarted'})
+            self.assertEqual(self._result(cwd), [cwd, 'restarted', '1'])
+            self.assertNotEqual(pool.workers[0].pid, pid)
+        finally:
+            pool.stop()
+        self.assertFalse(pool.workers[0].isAlive())
+
+    def test_jobTimeout(self):
+        script = self.getOutputPath('slow.py')
+        with open(script, 'w') as f:
+            f.write("import time\ntime.sleep(5)\n")
+        pool = workers.ChimeraWorkerPool(
+            self.program, 1, self.getOutputPath('workersTimeout'),
+            startTimeout=30, jobTimeout=1)
+        try:
+            # the worker is stopped, the caller launches ChimeraX instead
+            with self.assertRaises(workers.ChimeraWorkerError):
+                pool.run(script, self.getOutputPath())
+            self.assertFalse(pool.workers[0].isAlive())
+        finally:
+            pool.stop()
@@ -5,6 +5,7 @@ import sys
 from pwem.viewers.viewer_chimera import chimeraPdbTemplateFileName, chimeraMapTemplateFileName, sessionFile
 
 from chimera.Bundles.scipion.src.constants import *
+from chimera.manifest import MANIFEST_FILE
 
 
 def getEnvDictionary(prot):
@@ -19,6 +20,7 @@ def getEnvDictionary(prot):
     envDict = {CHIMERA_PDB_TEMPLATE_FILE_NAME: _chimeraPdbTemplateFileName % protId,
                CHIMERA_MAP_TEMPLATE_FILE_NAME: _chimeraMapTemplateFileName % protId,
                SESSIONFILE: _sessionFile,
+               CHIMERA_MANIFEST_FILE_NAME: os.path.abspath(prot._getExtraPath(MANIFEST_FILE)),
                PROTID: str(prot.getObjId()),
                SCIPIONPYTHON: sys.executable}
     return envDict
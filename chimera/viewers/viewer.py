@@ -27,10 +27,7 @@
 
 import os
 
-from pwem.convert import Ccp4Header
 from pwem.emlib.image import ImageHandler
-from pwem.objects import Volume
-from pwem.objects import Transform
 import pyworkflow.viewer as pwviewer
 
 from ..protocols import ChimeraSubtractionMaps
@@ -44,6 +41,8 @@ from pwem.viewers.viewer_chimera import (Chimera,
                                          sessionFile)
 from pyworkflow.viewer import DESKTOP_TKINTER, Viewer
 from chimera.objects import PAE
+from chimera import maps, manifest, commands
+from chimera.commands import Script, Open, quote
 
 class ChimeraViewerBase(Viewer):
     """ Visualize the output of protocols protocol_fit and protocol_operate """
@@ -65,13 +64,9 @@ class ChimeraViewerBase(Viewer):
                 elif self.protocol.inputVolumes[0] is not None:
                     _inputVol = self.protocol.inputVolumes[0].get()
             except:
-                output3DMapList = []
-                for filename in sorted(os.listdir(directory)):
-                    if filename.endswith(".mrc"):
-                        output3DMapList.append(filename.split('.')[0])
-                        output3DMap = str(output3DMapList[0])
-                        if len(output3DMap) > 0:
-                            _inputVol = self.protocol.output3DMap
+                if any(entry['type'] == manifest.MAP
+                       for entry in self.getOutputEntries(directory)):
+                    _inputVol = self.protocol.output3DMap
         except:
             # TODO: I do not know if we still need this part
             # Remark that inputProtocol does not longer exist, it has been replaced by inputProtocolDict
@@ -95,18 +90,17 @@ class ChimeraViewerBase(Viewer):
                                          bildFileName=bildFileName,
                                          sampling=sampling)
         fnCmd = self.protocol._getExtraPath("chimera_output.cxc")
-        f = open(fnCmd, 'w')
         # change to workingDir
         # If we do not use cd and the project name has an space
         # the protocol fails even if we pass absolute paths
-        f.write('cd %s\n' % os.getcwd())
-        f.write("open %s\n" % bildFileName)
-        f.write("cofr 0,0,0\n")  # set center of coordinates
+        script = Script().add('cd', quote(os.getcwd()))
+        script.add(Open(bildFileName))
+        script.add('cofr', (0, 0, 0))  # set center of coordinates
         inputVolFileName = ''
         counter = 2
         if _inputVol is not None:
             # In case we have PDBs only, _inputVol is None:
-            self.visInputVolume(f, _inputVol, counter)
+            self.visInputVolume(script, _inputVol, counter)
         else:
             counter = 1
 
@@ -114,52 +108,55 @@ class ChimeraViewerBase(Viewer):
                 self.protocol.inputVolume2.get() is not None):
             counter += 1
             _inputVol2 = self.protocol.inputVolume2.get()
-            self.visInputVolume(f, _inputVol2, counter)
+            self.visInputVolume(script, _inputVol2, counter)
 
-        for filename in sorted(os.listdir(directory)):
-            if filename.endswith(".mrc") and filename != inputVolFileName:
+        entries = self.getOutputEntries(directory)
+        for entry in entries:
+            if entry['type'] == manifest.MAP and \
+                    entry['path'] != inputVolFileName:
                 counter += 1
-                volFileName = os.path.join(directory, filename)
-                vol = Volume()
-                vol.setFileName(volFileName)
-
-                # fix mrc header
-                ccp4header = Ccp4Header(volFileName, readHeader=True)
-                sampling = ccp4header.computeSampling()
-                origin = Transform()
-                shifts = ccp4header.getOrigin()
-                origin.setShiftsTuple(shifts)
-                f.write("open %s\n" % volFileName)
-                f.write("volume #%d style surface voxelSize %f\n"
-                        "volume #%d origin %0.2f,%0.2f,%0.2f\n"
-                        % (counter, sampling, counter, shifts[0], shifts[1], shifts[2]))
-                f.write("volume #%d level %0.3f\n"
-                        % (counter, 0.001))
-
-        for filename in os.listdir(directory):
-            if filename.endswith(".pdb") or filename.endswith(".cif"):
+                volFileName = os.path.join(directory, entry['path'])
+                sampling = entry['sampling']
+                shifts = entry['origin']
+                script.add(Open(volFileName))
+                script.add(commands.Volume(counter, style='surface',
+                                           voxelSize=sampling))
+                script.add(commands.Volume(counter, origin=shifts))
+                # level from the statistics sidecar, if any
+                stats = maps.readStats(volFileName)
+                level = stats['level'] if stats and stats['n'] else 0.001
+                script.add(commands.Volume(counter, level=level))
+
+        for entry in entries:
+            if entry['type'] == manifest.ATOM_STRUCT:
+                filename = os.path.basename(entry['path'])
                 if not (filename.startswith("Atom_struct_out_") or
                         filename.startswith("tmp_")):
-                    path = os.path.join(directory, filename)
-                    f.write("open %s\n" % path)
-                    
-        f.write("view\n")
-        f.close()
+                    path = os.path.join(directory, entry['path'])
+                    script.add(Open(path))
+
+        script.add('view')
+        script.write(fnCmd)
 
         # run in the background
         Chimera.runProgram(Chimera.getProgram(), fnCmd + "&")
         return []
 
-    def visInputVolume(self, f, vol, counter):
+    def getOutputEntries(self, directory):
+        """ Maps and atomic structures saved by the protocol
+        (see chimera.manifest) """
+        return manifest.outputEntries(directory)
+
+    def visInputVolume(self, script, vol, counter):
         inputVolFileName = ImageHandler.removeFileType(vol.getFileName())
-        f.write("open %s\n" % inputVolFileName)
+        script.add(Open(inputVolFileName))
         if vol.hasOrigin():
             x, y, z = vol.getOrigin().getShifts()
         else:
             x, y, z = vol.getOrigin(force=True).getShifts()
-        f.write("volume #%d style surface voxelSize %f\n"
-                "volume #%d origin %0.2f,%0.2f,%0.2f\n"
-                % (counter, vol.getSamplingRate(), counter, x, y, z))
+        script.add(commands.Volume(counter, style='surface',
+                                   voxelSize=vol.getSamplingRate()))
+        script.add(commands.Volume(counter, origin=(x, y, z)))
 
 class ChimeraRestoreViewer(Viewer):
     """ Visualize the output of protocols protocol_fit and protocol_operate """
@@ -168,11 +165,10 @@ class ChimeraRestoreViewer(Viewer):
 
     def _visualize(self, obj, **args):
         fnCmd = self.protocol._getExtraPath("chimera_restore_session.cxc")
-        f = open(fnCmd, 'w')
         # change to workingDir
         # If we do not use cd and the project name has an space
         # the protocol fails even if we pass absolute paths
-        f.write('cd %s\n' % os.getcwd())
+        script = Script().add('cd', quote(os.getcwd()))
         path1 = os.path.join(self.protocol._getExtraPath(), sessionFile)
         if os.path.exists(path1):
             # restored SESSION
@@ -182,7 +178,8 @@ class ChimeraRestoreViewer(Viewer):
             path2 = os.path.join(
                 self.protocol.inputProtocol.get()._getExtraPath(), sessionFile)
             path = path2
-        f.write("open %s\n" % path)
+        script.add(Open(path))
+        script.write(fnCmd)
 
         Chimera.runProgram(Chimera.getProgram(), fnCmd + "&")
         return []
@@ -246,21 +243,20 @@ class ChimeraAlphafoldViewer(Viewer):
                                          sampling=sampling)
 
         fnCmd = self.protocol._getExtraPath("chimera_alphafold.cxc")
-        f = open(fnCmd, 'w')
-        f.write("open %s\n" % extraFileName)
+        script = Script([Open(extraFileName)])
         models +=1
-        f.write("cofr 0,0,0\n")  # set center of coordinates
+        script.add('cofr', (0, 0, 0))  # set center of coordinates
         # change to workingDir
         # If we do not use cd and the project name has an space
         # the protocol fails even if we pass absolute paths
-        f.write('cd %s\n' % os.getcwd())
+        script.add('cd', quote(os.getcwd()))
 
         # get path to atomstructs
         for output in self.protocol._outputs:
             # if the file is an atomic struct show it in chimera
             fileName = os.path.abspath(eval(f'self.protocol.{output}.getFileName()'))
             if fileName.endswith(".cif") or fileName.endswith(".pdb"):
-                f.write("open %s\n" % fileName)
+                script.add(Open(fileName))
                 models +=1
         # if exists upload other results files 
         # model_?_unrelaxed.pdb
@@ -271,9 +267,9 @@ class ChimeraAlphafoldViewer(Viewer):
         #    f.write(f"hide #{models} models\n")
         #    models +=1
         # set alphafold colormap
-        f.write("color bfactor palette alphafold\n")
-        f.write("key red:low orange: yellow: cornflowerblue: blue:high\n")
-        f.close()
+        script.add('color', 'bfactor', palette='alphafold')
+        script.add('key', 'red:low orange: yellow: cornflowerblue: blue:high')
+        script.write(fnCmd)
         Chimera.runProgram(Chimera.getProgram(), fnCmd + "&")
         # plot coverage
         if self.protocol.source == self.protocol.IMPORT_REMOTE_ALPHAFOLD and \
@@ -5,6 +5,8 @@ from pyworkflow.viewer import DESKTOP_TKINTER, WEB_DJANGO, ProtocolViewer
 from pwem import Domain
 
 from ..protocols.protocol_contacts import ChimeraProtContacts
+from ..contacts_db import ContactsDB
+from ..commands import Script, Open, quote
 from pyworkflow.gui.text import _open_cmd
 import os
 
@@ -17,7 +19,7 @@ class ChimeraProtContactsViewer(ProtocolViewer):
     def __init__(self, **kwargs):
 
         ProtocolViewer.__init__(self, **kwargs)
-        self.c, self.conn = self.protocol.prepareDataBase(drop=False)
+        self.db = ContactsDB(self.protocol.getDataBaseName())
         # compute all pairs of chains that interact
         # this information is needed for the menu
         self.pairChains = self._displayPairChains()
@@ -82,22 +84,19 @@ class ChimeraProtContactsViewer(ProtocolViewer):
                                          sampling=sampling)
 
         fnCmd = self.protocol._getExtraPath("chimera_output.cxc")
-        f = open(fnCmd, 'w')
         # change to workingDir
         # If we do not use cd and the project name has an space
         # the protocol fails even if we pass absolute paths
-        f.write('cd %s\n' % os.getcwd())
+        script = Script().add('cd', quote(os.getcwd()))
         # reference axis model = 0
-        f.write("open %s\n" % bildFileName)
-        f.write("cofr 0,0,0\n")  # set center of coordinates
-        # f.write("open %s\n" % os.path.abspath(
-        #     self.protocol.pdbFileToBeRefined.get().getFileName()))
-        f.write("open %s\n" % self.protocol.pdbFileToBeRefined.get().getFileName())
+        script.add(Open(bildFileName))
+        script.add('cofr', (0, 0, 0))  # set center of coordinates
+        script.add(Open(self.protocol.pdbFileToBeRefined.get().getFileName()))
 
         if self.protocol.SYMMETRY.get() and \
                 os.path.exists(self.protocol.getSymmetrizedModelName()):
-            f.write("open %s\n" % self.protocol.getSymmetrizedModelName())
-        f.close()
+            script.add(Open(self.protocol.getSymmetrizedModelName()))
+        script.write(fnCmd)
         # run in the background
         chimeraPlugin = Domain.importFromPlugin('chimera', 'Plugin', doRaise=True)
         chimeraPlugin.runChimeraProgram(chimeraPlugin.getProgram(), fnCmd + "&",
@@ -109,54 +108,14 @@ class ChimeraProtContactsViewer(ProtocolViewer):
         _open_cmd(self.getPairChainsFileName(), self.getTkRoot())
 
     def _chainPair(self, e=None):
-        if self.doInvert.get():
-            commandDisplayInteractions = """
-SELECT count(*), protId_2, modelId_2, chainId_2,
-       aaName_2 || aaNumber_2, protId_1, modelId_1,
-       chainId_1,  aaName_1 || aaNumber_1, salineBridge
-FROM view_ND_2
-WHERE modelId_1='{}' AND protId_1='{}' AND chainId_1='{}'
-  AND modelId_2='{}' AND protId_2='{}' AND chainId_2='{}'
-GROUP BY protId_1, modelId_1, chainId_1,
-         aaNumber_1, aaName_1, protId_2,
-         modelId_2, chainId_2, aaNumber_2,
-         aaName_2, salineBridge
-ORDER BY protId_2, modelId_2, chainId_2,
-        protId_1, modelId_1, chainId_1,
-        aaNumber_2, aaName_2,  aaNumber_1, aaName_1;
-"""
-        else:
-            commandDisplayInteractions = """
-SELECT count(*), protId_1, modelId_1, chainId_1,
-       aaName_1 || aaNumber_1, protId_2, modelId_2,
-       chainId_2,  aaName_2 || aaNumber_2, salineBridge
-FROM   view_ND_2
-WHERE modelId_1='{}' AND protId_1='{}' AND chainId_1='{}'
-  AND modelId_2='{}' AND protId_2='{}' AND chainId_2='{}'
-GROUP BY protId_1, modelId_1, chainId_1,
-         aaNumber_1, aaName_1, protId_2,
-         modelId_2, chainId_2, aaNumber_2,
-         aaName_2, salineBridge
-ORDER BY protId_1, modelId_1, chainId_1,
-         protId_2, modelId_2, chainId_2,
-         aaNumber_1, aaName_1,  aaNumber_2, aaName_2;
-"""
         f = open(self.getInteractionFileName(), 'w')
         if len(self.all_pair_chains) == self.chainPair.get():
             f.write("No contacts found by applying symmetry: Is the symmetry "
                     "center equal to the origin of coordinates?")
         else:
             row = self.all_pair_chains[self.chainPair.get()]
-            command = commandDisplayInteractions.format(row[1],
-                                                        row[2],
-                                                        row[3],
-                                                        row[4],
-                                                        row[5],
-                                                        row[6]
-                                                        )
-            # print command
-            rows_count = self.c.execute(command)
-            all_rows = self.c.fetchall()
+            all_rows = self.db.interactions(*row[1:7],
+                                            invert=self.doInvert.get())
 
             f.write("RESULTS for: {}\n".format(', '.join(str(s) for s in row)))
             f.write("# atoms, prot_1, model_1, chain_1, AA_1, prot_2, model_2, chain2, AA_2 salineBridge\n")
@@ -228,51 +187,13 @@ ORDER BY protId_1, modelId_1, chainId_1,
         _open_cmd(self.getInteractionFileName(), self.getTkRoot())
 
     def _displayPairChains(self, ):
-        # auxiliary view name
-        viewPairChain = 'atoms_interacting_per_pair_of_chains'
-
-        # drop auxiliary view if exists
-        sqlCommand = self.protocol.commandDropView. \
-            format(viewName=viewPairChain)
-        self.c.execute(sqlCommand)
-
-        # create view with pair of chains
-        commandDisplayPairChains = """
-CREATE VIEW {viewName} AS
-SELECT count(*) as AAs,  modelId_1, protId_1, chainId_1, modelId_2,  protId_2,  chainId_2
-FROM view_ND_2
-GROUP BY modelId_1, protId_1, chainId_1, modelId_2, protId_2,  chainId_2
--- ORDER BY modelId_1, protId_1, chainId_1, modelId_2, protId_2,  chainId_2;
-""".format(viewName=viewPairChain)
-        self.c.execute(commandDisplayPairChains)
-
-        # remove duplicates and execute command
-        commandDisplayPairChainsNR = """
-SELECT *
-FROM {viewName}
-
-EXCEPT
-
-SELECT ca.*
-FROM {viewName} ca, {viewName} cb
-WHERE
-      ca.protId_1    = cb.protId_2
-  AND cb.protId_1    = ca.protId_2
-  AND ca.chainId_1   = cb.chainId_2
-  AND cb.chainId_1   = ca.chainId_2
-  AND ca.AAs  = cb.AAs
-  AND ca.protId_1 > cb.protId_1
-
-ORDER BY modelId_1, protId_1, chainId_1, modelId_2, protId_2,  chainId_2;
-""".format(viewName=viewPairChain)
-        rows_count = self.c.execute(commandDisplayPairChainsNR)
+        # non redundant pairs of interacting chains
+        self.all_pair_chains = self.db.pairChains()
 
         # create text file and list with pairs of chains
         f = open(self.getPairChainsFileName(), 'w')
         choices = []
 
-        self.all_pair_chains = self.c.fetchall()
-
         formatted_row = '{:<4} {:>3} {:<11} {:<3} {:>4} {:<11} {:<3}\n'
         f.write("# atoms, model_1, prot_1, chain_1,  model_2, prot_2, chain_2\n")
 
@@ -26,7 +26,8 @@
 # **************************************************************************
 
 from pwem.wizards import SelectChainWizard, SelectResidueWizard
-from .protocols import ChimeraModelFromTemplate, ChimeraSubtractionMaps
+from .protocols import (ChimeraModelFromTemplate, ChimeraSubtractionMaps,
+                         ChimeraSubtractionMapsScan)
 from .editList import EntryGrid
 from .protocols.protocol_contacts import ChimeraProtContacts
 from pyworkflow.wizard import Wizard
@@ -42,6 +43,11 @@ SelectChainWizard().addTarget(protocol=ChimeraSubtractionMaps,
                               inputs=['pdbFileToBeRefined'],
                               outputs=['inputStructureChain'])
 
+SelectChainWizard().addTarget(protocol=ChimeraSubtractionMapsScan,
+                              targets=['inputStructureChain'],
+                              inputs=['pdbFileToBeRefined'],
+                              outputs=['inputStructureChain'])
+
 SelectChainWizard().addTarget(protocol=ChimeraModelFromTemplate,
                               targets=['selectStructureChain'],
                               inputs=['pdbFileToBeRefined'],
@@ -0,0 +1,361 @@
+# **************************************************************************
+# *
+# * Authors:     Roberto Marabini (roberto@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+""" Pool of pre-started headless ChimeraX workers.
+
+Each worker is a 'ChimeraX --nogui' process running the REST server of
+remotecontrol on a local port. Scripts that ChimeraX would run without
+user interaction are executed by an idle worker instead of starting a
+new ChimeraX, and the session is closed after every job.
+
+Workers outlive the process that started them so that any Scipion
+process can reuse them. The pool directory holds one slot per worker: a
+JSON file with the pid and port of the process and a lock file. A slot
+is used by one job at a time (flock). Workers are health checked before
+every job and restarted when they do not answer. Jobs that do not end in
+jobTimeout stop their worker, the caller can then start a new ChimeraX.
+"""
+
+import fcntl
+import json
+import os
+import shlex
+import signal
+import socket
+import subprocess
+import textwrap
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from .launches import scriptBody
+
+REST_COMMAND = 'remotecontrol rest start port %d json true'
+HEALTH_COMMAND = 'version'
+RESET_COMMAND = 'close session'
+HEALTH_TIMEOUT = 5  # seconds
+START_TIMEOUT = 120  # seconds
+JOB_TIMEOUT = 3600  # seconds
+
+# run by the worker for each job: time at which the job begins,
+# environment, working directory, the script as with --script (see
+# launches.scriptBody, exit only ends the job) and a clean session
+JOB_TEMPLATE = '''import os
+import time
+from chimerax.core.commands import run
+
+if %(marker)r:
+    with open(%(marker)r, 'w') as f:
+        f.write(repr(time.time()))
+
+
+class JobExit(Exception):
+    pass
+
+
+def jobExit(*args, **kwargs):
+    raise JobExit()
+
+
+environ, cwd = dict(os.environ), os.getcwd()
+uiQuit = session.ui.quit
+os.environ.update(%(env)r)
+os.chdir(%(cwd)r)
+session.ui.quit = jobExit
+try:
+%(body)s
+except JobExit:
+    pass
+finally:
+    session.ui.quit = uiQuit
+    os.chdir(cwd)
+    os.environ.clear()
+    os.environ.update(environ)
+    run(session, %(reset)r)
+'''
+
+
+class ChimeraWorkerError(Exception):
+    """ A worker could not be started or did not answer """
+    pass
+
+
+class ChimeraScriptError(Exception):
+    """ The script of a job raised an error in the worker """
+    pass
+
+
+def freePort():
+    """ A TCP port of localhost that is free now """
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def restCommand(port, command, timeout=None):
+    """ Run a ChimeraX command through the REST server of a worker.
+    Return the log messages. """
+    url = 'http://127.0.0.1:%d/run?%s' % (
+        port, urllib.parse.urlencode({'command': command}))
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            result = json.loads(response.read().decode())
+    except (OSError, ValueError) as e:  # URLError, timeouts, bad answers
+        raise ChimeraWorkerError("Worker on port %d: %s" % (port, e))
+    error = result.get('error')
+    if error:
+        raise ChimeraScriptError(error.get('message') or str(error))
+    return result.get('log messages') or {}
+
+
+def jobScript(script, cwd, env=None, marker=None):
+    """ Python code that runs script in a worker
+
+    :param marker: file where the time at which the job begins is written
+    """
+    return JOB_TEMPLATE % {'env': dict(env or {}), 'cwd': cwd,
+                           'marker': marker,
+                           'body': textwrap.indent(scriptBody(script),
+                                                   '    ').rstrip(),
+                           'reset': RESET_COMMAND}
+
+
+def _pidAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ChimeraWorker:
+    """ Slot of the pool and the ChimeraX process that serves it """
+
+    def __init__(self, directory, index):
+        self.directory = directory
+        self.index = index
+        self.stateFileName = os.path.join(directory, 'worker_%d.json' % index)
+        self.logFileName = os.path.join(directory, 'worker_%d.log' % index)
+        self.lockFile = None
+        self.process = None  # if started by this process
+        self.pid = self.port = None
+        self._readState()
+
+    def _readState(self):
+        try:
+            with open(self.stateFileName) as f:
+                state = json.load(f)
+            self.pid, self.port = state['pid'], state['port']
+        except (OSError, ValueError, KeyError):
+            self.pid = self.port = None
+
+    def _writeState(self):
+        tmpFileName = self.stateFileName + '.tmp'
+        with open(tmpFileName, 'w') as f:
+            json.dump({'pid': self.pid, 'port': self.port}, f)
+        os.replace(tmpFileName, self.stateFileName)
+
+    def acquire(self, block=False):
+        """ Lock the slot, return False if another job is using it """
+        lockFile = open(os.path.join(self.directory,
+                                     'worker_%d.lock' % self.index), 'w')
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX |
+                        (0 if block else fcntl.LOCK_NB))
+        except BlockingIOError:
+            lockFile.close()
+            return False
+        self.lockFile = lockFile
+        self._readState()  # may have been restarted by another process
+        return True
+
+    def release(self):
+        if self.lockFile is not None:
+            fcntl.flock(self.lockFile, fcntl.LOCK_UN)
+            self.lockFile.close()
+            self.lockFile = None
+
+    def isAlive(self):
+        if self.process is not None and self.process.pid == self.pid:
+            return self.process.poll() is None  # also reaps it
+        return self.pid is not None and _pidAlive(self.pid)
+
+    def isHealthy(self):
+        """ True if the process is alive and answers commands """
+        if not self.isAlive():
+            return False
+        try:
+            restCommand(self.port, HEALTH_COMMAND, HEALTH_TIMEOUT)
+        except (ChimeraWorkerError, ChimeraScriptError):
+            return False
+        return True
+
+    def start(self, program, env=None, timeout=START_TIMEOUT):
+        """ Start a new ChimeraX process for the slot, stopping the
+        previous one """
+        self.stop()
+        port = freePort()
+        # the text interface of --nogui reads stdin: a fifo opened for
+        # reading and writing by the worker itself never ends
+        fifo = os.path.join(self.directory, 'worker_%d.stdin' % self.index)
+        if not os.path.exists(fifo):
+            os.mkfifo(fifo)
+        stdin = os.open(fifo, os.O_RDWR)
+        try:
+            with open(self.logFileName, 'ab') as log:
+                process = subprocess.Popen(
+                    [program, '--nogui', '--cmd', REST_COMMAND % port],
+                    stdin=stdin, stdout=log, stderr=subprocess.STDOUT,
+                    env=env, cwd=self.directory, start_new_session=True)
+        finally:
+            os.close(stdin)
+        self.process = process
+        self.pid, self.port = process.pid, port
+        deadline = time.time() + timeout
+        while not self.isHealthy():
+            if process.poll() is not None:
+                raise ChimeraWorkerError(
+                    "ChimeraX worker exited with code %d, see %s"
+                    % (process.returncode, self.logFileName))
+            if time.time() > deadline:
+                self.stop()
+                raise ChimeraWorkerError(
+                    "ChimeraX worker did not start in %d s, see %s"
+                    % (timeout, self.logFileName))
+            time.sleep(0.2)
+        self._writeState()
+
+    def stop(self):
+        if self.isAlive():
+            try:
+                os.killpg(self.pid, signal.SIGTERM)
+            except OSError:
+                pass
+            if self.process is not None and self.process.pid == self.pid:
+                try:
+                    self.process.wait(timeout=HEALTH_TIMEOUT)
+                except subprocess.TimeoutExpired:
+                    os.killpg(self.pid, signal.SIGKILL)
+                    self.process.wait()
+        self.process = None
+        self.pid = self.port = None
+        if os.path.exists(self.stateFileName):
+            os.remove(self.stateFileName)
+
+    def run(self, script, cwd, env=None, timeout=None, marker=None):
+        """ Run a script, return the log messages of ChimeraX """
+        jobFileName = os.path.join(self.directory,
+                                   'worker_%d_job.py' % self.index)
+        with open(jobFileName, 'w') as f:
+            f.write(jobScript(script, cwd, env, marker))
+        return restCommand(self.port,
+                           'runscript %s' % shlex.quote(jobFileName), timeout)
+
+
+class ChimeraWorkerPool:
+    """ Slots of pre-started ChimeraX workers in a directory """
+
+    def __init__(self, program, size, directory, env=None,
+                 startTimeout=START_TIMEOUT, jobTimeout=JOB_TIMEOUT):
+        """
+        :param program: ChimeraX binary
+        :param size: number of workers
+        :param env: environment of the workers
+        :param jobTimeout: seconds to wait for a job before stopping its
+                           worker
+        """
+        self.program = program
+        self.size = size
+        self.directory = directory
+        self.env = env
+        self.startTimeout = startTimeout
+        self.jobTimeout = jobTimeout
+        os.makedirs(directory, exist_ok=True)
+        self.workers = [ChimeraWorker(directory, i) for i in range(size)]
+        self.lastPid = None  # worker of the last job
+
+    def _acquire(self):
+        """ An idle worker that answers commands (locked), None if all
+        the workers are busy """
+        for worker in self.workers:
+            if worker.acquire():
+                try:
+                    if not worker.isHealthy():
+                        worker.start(self.program, self.env,
+                                     self.startTimeout)
+                except ChimeraWorkerError:
+                    worker.release()
+                    raise
+                return worker
+        return None
+
+    def start(self):
+        """ Start the idle workers that are not running """
+        for worker in self.workers:
+            if worker.acquire():
+                try:
+                    if not worker.isHealthy():
+                        worker.start(self.program, self.env,
+                                     self.startTimeout)
+                finally:
+                    worker.release()
+
+    def stop(self):
+        """ Stop all the workers, waiting for the running jobs """
+        for worker in self.workers:
+            worker.acquire(block=True)
+            try:
+                worker.stop()
+            finally:
+                worker.release()
+
+    def run(self, script, cwd=None, env=None, marker=None):
+        """ Run a script in an idle worker, as 'ChimeraX --nogui --script'
+        in cwd with the variables of env. Return the log messages, or None
+        if all the workers are busy. A job whose worker stops answering is
+        run again once in a restarted worker. Jobs that time out stop
+        their worker and raise ChimeraWorkerError.
+
+        :param marker: file where the time at which the job begins is
+                       written
+        """
+        cwd = os.path.abspath(cwd or os.getcwd())
+        for attempt in range(2):
+            worker = self._acquire()
+            if worker is None:
+                return None
+            self.lastPid = worker.pid
+            try:
+                return worker.run(script, cwd, env, self.jobTimeout, marker)
+            except ChimeraWorkerError:
+                crashed = not worker.isAlive()
+                worker.stop()  # restarted by the next job
+                if attempt or not crashed:
+                    raise
+            finally:
+                worker.release()